@@ -0,0 +1,74 @@
+"""
+Append-only archive of feed items removed from the database by compaction.py.
+
+Items are written to segment files of gzip-compressed JSON lines. Every append adds one gzip member to the current
+segment, so nothing already written is ever rewritten, and a new segment is started once the current one reaches
+"archive_segment_bytes". The segments holding the items of each feed are recorded in rss_archive_segments (see
+db_service.get_archived_items), so that a feed's archived items are read on demand from its segments only.
+
+Example usage:
+
+segment = archive.Archive(config.config['archive_path']).append(items)
+"""
+import gzip
+import json
+import os
+import re
+import threading
+import config
+
+
+SEGMENT_FILE = re.compile(r'^segment-(\d{6})\.jsonl\.gz$')
+
+
+class Archive:
+    """
+    A directory of archive segments.
+    Args:
+     - path: The directory, created if needed.
+     - segment_bytes: Size after which a new segment is started.
+    """
+
+    def __init__(self, path: str, segment_bytes=None):
+        self.path = path
+        self.segment_bytes = segment_bytes or config.config['archive_segment_bytes']
+        self._lock = threading.Lock()
+
+    def segments(self) -> list:
+        """
+        Returns the names of the segments, oldest first.
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path) if SEGMENT_FILE.match(name))
+
+    def append(self, items: list) -> str:
+        """
+        Appends items, dictionaries that can be serialized to JSON, to the current segment and syncs it to disk.
+        Returns:
+         - The name of the segment the items were written to.
+        """
+        lines = ''.join(json.dumps(item, separators=(',', ':')) + '\n' for item in items).encode()
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            segments = self.segments()
+            name = segments[-1] if segments else 'segment-000001.jsonl.gz'
+            if segments and os.path.getsize(os.path.join(self.path, name)) >= self.segment_bytes:
+                name = f"segment-{int(SEGMENT_FILE.match(name).group(1)) + 1:06d}.jsonl.gz"
+            with open(os.path.join(self.path, name), 'ab') as segment:
+                segment.write(gzip.compress(lines))
+                segment.flush()
+                os.fsync(segment.fileno())
+        return name
+
+    def read(self, name: str, feed_id=None):
+        """
+        Generator over the items of a segment, optionally only the ones of a feed.
+        """
+        if not SEGMENT_FILE.match(name):
+            raise ValueError(f"Invalid segment name {name}")
+        with gzip.open(os.path.join(self.path, name), 'rt') as segment:
+            for line in segment:
+                item = json.loads(line)
+                if feed_id is None or item['feed_id'] == feed_id:
+                    yield item
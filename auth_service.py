@@ -1,10 +1,170 @@
 import jwt
 import config
-import traceback
+import logging
+import metrics
+import re
+import threading
+import time
+from collections import OrderedDict, deque
 from flask import request
 from functools import wraps
 
 
+MAX_TOKEN_LENGTH = 4096
+TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+$')
+DECODE_SECONDS = metrics.Histogram('rss_auth_token_decode_seconds', "Time spent verifying tokens that were not cached.")
+
+
+class TokenCache:
+    """
+    A bounded LRU cache of verified tokens, so that a client sending the same token over and over only pays for the
+    signature verification once. An entry expires at the "exp" of its token, or ttl seconds after it was verified if
+    the token has no expiry. Hits, misses and rejected tokens are counted.
+    Args:
+     - maxsize: Maximum number of tokens kept.
+     - ttl: Seconds a token without "exp" is kept.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.rejects = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        """
+        Returns the payload of a cached, unexpired token, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token: str, payload: dict) -> None:
+        expires_at = payload.get('exp') if isinstance(payload.get('exp'), (int, float)) else time.time() + self.ttl
+        with self._lock:
+            self._entries[token] = (expires_at, payload)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def reject(self) -> None:
+        with self._lock:
+            self.rejects += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'rejects': self.rejects}
+
+
+class LoginThrottle:
+    """
+    Counts failed logins per user and per client address over a sliding window, so that password guessing is refused
+    before it reaches the password hasher. A successful login clears the failures of its user. Expired failures are
+    swept once per window, so that only the users and addresses that failed within the last window are kept.
+    Args:
+     - per_user: Failed logins allowed per user within the window.
+     - per_ip: Failed logins allowed per client address within the window.
+     - window: Length of the window in seconds.
+    """
+
+    def __init__(self, per_user: int, per_ip: int, window: float):
+        self.limits = {'user': per_user, 'ip': per_ip}
+        self.window = window
+        self._failures = {}
+        self._next_sweep = time.time() + window
+        self._lock = threading.Lock()
+
+    def _recent(self, key: tuple, now: float) -> deque:
+        failures = self._failures.get(key)
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if failures is not None and not failures:
+            del self._failures[key]
+            return None
+        return failures
+
+    def retry_after(self, user_id, ip) -> float:
+        """
+        Returns the seconds until the user or address may try again, or 0 if it is not throttled.
+        """
+        now = time.time()
+        wait = 0
+        with self._lock:
+            for key in (('user', user_id), ('ip', ip)):
+                failures = self._recent(key, now)
+                if failures and len(failures) >= self.limits[key[0]]:
+                    wait = max(wait, failures[-self.limits[key[0]]] + self.window - now)
+        return wait
+
+    def failed(self, user_id, ip) -> None:
+        now = time.time()
+        with self._lock:
+            if now >= self._next_sweep:
+                for key in list(self._failures):
+                    self._recent(key, now)
+                self._next_sweep = now + self.window
+            for key in (('user', user_id), ('ip', ip)):
+                self._recent(key, now)
+                self._failures.setdefault(key, deque(maxlen=self.limits[key[0]])).append(now)
+
+    def succeeded(self, user_id) -> None:
+        with self._lock:
+            self._failures.pop(('user', user_id), None)
+
+
+token_cache = TokenCache(config.config['token_cache_size'], config.config['token_cache_ttl'])
+login_throttle = LoginThrottle(config.config['login_failures_per_user'], config.config['login_failures_per_ip'],
+                               config.config['login_throttle_window'])
+
+
+def is_well_formed(token) -> bool:
+    """
+    Cheap structural check of a JWT (three base64url segments of bounded length), run before any cryptography.
+    """
+    return isinstance(token, str) and len(token) <= MAX_TOKEN_LENGTH and TOKEN_PATTERN.match(token) is not None
+
+
+def verify_token(token: str):
+    """
+    Returns the payload of a valid token, from the cache when the token was verified before, or None if it is invalid.
+    """
+    if not is_well_formed(token):
+        token_cache.reject()
+        return None
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+    try:
+        with DECODE_SECONDS.time():
+            payload = jwt.decode(token, config.config['secret_key'], algorithms=config.config['algorithms'])
+    except jwt.exceptions.InvalidTokenError:
+        token_cache.reject()
+        return None
+    except Exception as e:
+        logging.warning("Unexpected error decoding token: %s", e)
+        token_cache.reject()
+        return None
+    if 'user_id' not in payload:
+        token_cache.reject()
+        return None
+    token_cache.put(token, payload)
+    return payload
+
+
 def authenticate(auth_object):
     """
     A decorator that authenticates the user by verifying a JWT token in the Authorization header of the request.
@@ -13,6 +173,7 @@ def authenticate(auth_object):
     Returns:
         A decorated version of auth_object that performs authentication before calling it.
     The decorator checks for the presence of an Authorization header in the request, extracts the JWT token from it, and decodes the token using a secret key and a set of allowed algorithms specified in the application's configuration file. If the token is missing or invalid, the decorator returns a response with an error message. Otherwise, it calls auth_object with the user_id extracted from the token and the arguments passed to the decorated function.
+    Tokens that are malformed are rejected before any signature check, and verified tokens are cached until they expire, see TokenCache.
 
     Example usage:
 
@@ -27,12 +188,8 @@ def authenticate(auth_object):
         if not token:
             response = {"success": False, "message": "Token missing"}
             return response
-        try:
-            data = jwt.decode(token, config.config['secret_key'], algorithms=config.config['algorithms'])
-        except jwt.exceptions.DecodeError as e:
-            return {"success": False, "message": "Invalid token"}
-        except Exception as e:
-            traceback.print_exc(e)
+        data = verify_token(token)
+        if data is None:
             return {"success": False, "message": "Invalid token"}
         return auth_object(data['user_id'], *args, **kwargs)
-    return decorated
\ No newline at end of file
+    return decorated
@@ -0,0 +1,290 @@
+"""
+Benchmarks the API and the refresh pipeline against a local feed stub and a seeded database.
+
+The stub serves synthetic feeds of a configurable size, and a share of them gets new items before each refresh cycle.
+The database is seeded with every user following every feed and the items of the feeds already stored. The scenarios
+run in order, each one as a number of operations spread over worker threads:
+
+- follow: POST /feeds of a feed nobody follows yet (fetch, parse and insert)
+- list: GET /feeds of a page of items of a followed feed
+- mark_read: PUT /markread of a single item
+- filter: GET /feeds of a page of unread items
+- refresh: db_service.refresh_feed of every feed, over several cycles
+
+Throughput and p50/p99 latencies are printed and saved to a JSON file; given the JSON of a previous run with --baseline,
+the change of each figure is printed as well.
+
+Usage: python benchmarks/bench_api.py [--users 100] [--feeds 50] [--items 100] [--ops 1000] [--threads 4]
+                                      [--output bench_api.json] [--baseline previous.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../tests")
+import jwt
+import builder
+import config
+import db_pool
+import db_service
+import response_cache
+from app_main import app
+from feed_stub import FeedStub, make_rss
+
+WORDS = ['market', 'election', 'weather', 'football', 'science', 'health', 'music', 'travel', 'economy', 'climate',
+         'energy', 'housing', 'traffic', 'cinema', 'school', 'budget', 'storm', 'festival', 'museum', 'startup']
+
+
+class SyntheticFeeds:
+    """
+    Synthetic feeds served by a FeedStub. Feed number n lists its items newest first, "items" of them at a time, and
+    every change publishes "new_items" more.
+    """
+
+    def __init__(self, stub: FeedStub, items: int, summary_bytes: int, new_items: int, seed: int = 1):
+        self.stub = stub
+        self.items = items
+        self.summary_bytes = summary_bytes
+        self.new_items = new_items
+        self.random = random.Random(seed)
+        self.published = {}
+
+    def path(self, feed: str) -> str:
+        return f'/feed/{feed}'
+
+    def url(self, feed: str) -> str:
+        return self.stub.url(self.path(feed))
+
+    def publish(self, feed: str, count=None) -> None:
+        """
+        Publishes count new items in a feed, or creates it with "items" items.
+        """
+        total = self.published.get(feed, 0) + (count if count is not None else self.items)
+        self.published[feed] = total
+        items = [(f'{feed} item {number}', f'http://example.com/{feed}/{number}', self.summary(feed, number))
+                 for number in range(total - 1, max(total - self.items, 0) - 1, -1)]
+        self.stub.set_feed(self.path(feed), make_rss(f'Feed {feed}', items))
+
+    def summary(self, feed: str, number: int) -> str:
+        words = random.Random(f'{feed}/{number}').choices(WORDS, k=max(1, self.summary_bytes // 8))
+        return ' '.join(words)[:self.summary_bytes]
+
+    def change(self, feeds: list, change_rate: float) -> list:
+        """
+        Publishes new items in a share of the feeds, and returns the feeds that changed.
+        """
+        changed = self.random.sample(feeds, round(len(feeds) * change_rate))
+        for feed in changed:
+            self.publish(feed, self.new_items)
+        return changed
+
+
+def seed(feeds: SyntheticFeeds, users: int, feed_count: int) -> list:
+    """
+    Seeds the database: every user follows every feed, whose items are already stored along with the validators of the
+    stub, so that unchanged feeds are answered with 304 on refresh.
+    Returns:
+     - The URLs of the feeds.
+    """
+    urls = []
+    with db_pool.writer() as (db_connection, cursor):
+        for number in range(feed_count):
+            feed = f'seed{number}'
+            feeds.publish(feed)
+            url = feeds.url(feed)
+            hash_key = builder.generate_hash(url)
+            body, etag, last_modified = feeds.stub.feeds[feeds.path(feed)]
+            new_items, updated_items = db_service.diff_feed_items(hash_key, builder.parse_feed(body), cursor)
+            db_service.write_feed_items(hash_key, new_items, updated_items, cursor)
+            db_service.save_feed_validators(hash_key, {'etag': etag, 'last_modified': last_modified,
+                                                       'digest': builder.content_digest(body)}, cursor)
+            cursor.executemany("INSERT INTO rss_feeds (user_id, url, feed_id, updated_date) VALUES (?,?,?,?)",
+                               [(user_id, url, hash_key, int(time.time())) for user_id in range(1, users + 1)])
+            urls.append(url)
+        db_connection.commit()
+    return urls
+
+
+def percentile(timings: list, fraction: float) -> float:
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def run(operations: list, threads: int) -> dict:
+    """
+    Runs operations, functions returning an HTTP status, on threads worker threads.
+    Returns:
+     - The throughput in operations per second, latencies in milliseconds, and the number of failed operations.
+    """
+    timings = []
+    errors = []
+
+    def timed(operation):
+        started = time.perf_counter()
+        try:
+            status = operation()
+        except Exception:
+            status = 599
+        timings.append((time.perf_counter() - started) * 1000)
+        if status >= 400:
+            errors.append(status)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(timed, operations))
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    return {
+        'ops': len(timings),
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(timings) / elapsed, 1) if elapsed else None,
+        'mean_ms': round(statistics.mean(timings), 3) if timings else None,
+        'p50_ms': round(percentile(timings, 0.5), 3) if timings else None,
+        'p99_ms': round(percentile(timings, 0.99), 3) if timings else None,
+    }
+
+
+class Clients:
+    """
+    A Flask test client per thread, and the tokens of the users.
+    """
+
+    def __init__(self, users: int):
+        app.config['TESTING'] = True
+        self._local = threading.local()
+        self.headers = {user_id: {'Authorization': 'Bearer ' + jwt.encode({'user_id': user_id}, config.config['secret_key'],
+                                                                         algorithm='HS256')}
+                        for user_id in range(1, users + 1)}
+
+    def get(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = app.test_client()
+        return self._local.client
+
+
+def scenarios(args, feeds: SyntheticFeeds, urls: list, clients: Clients) -> dict:
+    """
+    Returns the operations of each scenario by name, in the order they run. Operations are drawn from a seeded random
+    generator so that runs with the same arguments are comparable.
+    """
+    choose = random.Random(2)
+    users = list(range(1, args.users + 1))
+    with db_pool.cursor() as (db_connection, cursor):
+        item_ids = {url: [row[0] for row in cursor.execute("SELECT feed_item_id FROM rss_feedData WHERE feed_id=?",
+                                                           (builder.generate_hash(url),))] for url in urls}
+
+    def follow(number):
+        feed = f'new{number}'
+        feeds.publish(feed)
+        user_id = choose.choice(users)
+        return lambda: clients.get().post('/feeds', json={'feedUrl': feeds.url(feed)},
+                                          headers=clients.headers[user_id]).status_code
+
+    def listing(marked=None):
+        user_id, url = choose.choice(users), choose.choice(urls)
+        query = {'feedUrl': url, 'limit': args.page_size}
+        if marked:
+            query['marked'] = marked
+        return lambda: clients.get().get('/feeds', query_string=query, headers=clients.headers[user_id]).status_code
+
+    def mark_read():
+        user_id, url = choose.choice(users), choose.choice(urls)
+        body = {'feedUrl': url, 'itemId': choose.choice(item_ids[url])}
+        return lambda: clients.get().put('/markread', json=body, headers=clients.headers[user_id]).status_code
+
+    def refresh(hash_key):
+        return lambda: db_service.refresh_feed(hash_key)[1]
+
+    return {
+        'follow': lambda: [follow(number) for number in range(args.follows)],
+        'list': lambda: [listing() for _ in range(args.ops)],
+        'mark_read': lambda: [mark_read() for _ in range(args.ops)],
+        'filter': lambda: [listing('unread') for _ in range(args.ops)],
+        'refresh': lambda: [refresh(builder.generate_hash(url)) for url in urls],
+    }
+
+
+def compare(results: dict, baseline: dict) -> None:
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        changes = []
+        for key in ('throughput', 'p50_ms', 'p99_ms'):
+            if result.get(key) and previous.get(key):
+                changes.append(f"{key} {(result[key] / previous[key] - 1) * 100:+.1f}%")
+        print(f"  {name:10} vs baseline: {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--feeds', type=int, default=50, help="feeds followed by every user")
+    parser.add_argument('--items', type=int, default=100, help="items per feed")
+    parser.add_argument('--summary-bytes', type=int, default=300, help="size of the summary of an item")
+    parser.add_argument('--ops', type=int, default=1000, help="operations of the list, mark_read and filter scenarios")
+    parser.add_argument('--follows', type=int, default=50, help="operations of the follow scenario")
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--cycles', type=int, default=3, help="refresh cycles")
+    parser.add_argument('--change-rate', type=float, default=0.2, help="share of the feeds changing per refresh cycle")
+    parser.add_argument('--new-items', type=int, default=5, help="items published by a feed that changes")
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated feed server latency in seconds")
+    parser.add_argument('--no-response-cache', action='store_true', help="serve every GET /feeds from the database")
+    parser.add_argument('--scenarios', default='follow,list,mark_read,filter,refresh')
+    parser.add_argument('--output', default='bench_api.json')
+    parser.add_argument('--baseline', help="JSON of a previous run to compare with")
+    args = parser.parse_args()
+
+    config.config['db_path'] = os.path.join(tempfile.mkdtemp(), 'bench_api.db')
+    config.config['refresh_min_interval'] = 0
+    if args.no_response_cache:
+        response_cache.set_backend(response_cache.MemoryBackend(0))
+
+    results = {}
+    with FeedStub(delay=args.latency) as stub:
+        feeds = SyntheticFeeds(stub, args.items, args.summary_bytes, args.new_items)
+        started = time.perf_counter()
+        urls = seed(feeds, args.users, args.feeds)
+        print(f"seeded {args.users} users x {args.feeds} feeds x {args.items} items in {time.perf_counter() - started:.1f}s")
+
+        operations = scenarios(args, feeds, urls, clients=Clients(args.users))
+        for name in args.scenarios.split(','):
+            if name == 'refresh':
+                cycles = []
+                for _ in range(args.cycles):
+                    feeds.change([url.rsplit('/', 1)[1] for url in urls], args.change_rate)
+                    cycles.append(run(operations[name](), args.threads))
+                result = dict(cycles[-1], cycles=cycles)
+            else:
+                result = run(operations[name](), args.threads)
+            results[name] = result
+            print(f"{name:10} ops={result['ops']:5} errors={result['errors']:3} {result['throughput']:9.1f} ops/s "
+                  f"p50={result['p50_ms']:8.2f}ms p99={result['p99_ms']:8.2f}ms")
+
+    report = {
+        'arguments': vars(args),
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                        'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f"results saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Compares refreshing feeds one at a time with builder.rss_feeder against the concurrent fetcher, using a local HTTP stub
+that serves canned feeds.
+
+Usage: python benchmarks/bench_fetcher.py [--feeds 500] [--items 50] [--concurrency 200] [--per-host 50] [--latency 0.05]
+"""
+import argparse
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../tests")
+import builder
+import fetcher
+from feed_stub import FeedStub, make_rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--feeds', type=int, default=500)
+    parser.add_argument('--items', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--per-host', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help="simulated server latency in seconds")
+    args = parser.parse_args()
+
+    items = [(f'Item {number}', f'http://example.com/{number}', 'Summary ' * 20) for number in range(args.items)]
+    with FeedStub(delay=args.latency) as stub:
+        urls = []
+        for number in range(args.feeds):
+            stub.set_feed(f'/rss/{number}', make_rss(f'Feed {number}', items))
+            urls.append(stub.url(f'/rss/{number}'))
+
+        started = time.perf_counter()
+        for url in urls:
+            builder.rss_feeder(url)
+        sequential = time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = fetcher.fetch_feeds(urls, max_concurrency=args.concurrency, per_host_limit=args.per_host)
+        concurrent = time.perf_counter() - started
+
+    print(f"feeds={args.feeds} items={args.items} fetched={len(results)}")
+    print(f"sequential: {sequential:.2f}s ({args.feeds / sequential:.0f} feeds/s)")
+    print(f"concurrent: {concurrent:.2f}s ({args.feeds / concurrent:.0f} feeds/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Measures the latency of db_service.search_items on a database seeded with synthetic feed items, one million by default.
+Titles and summaries are drawn from a vocabulary with a Zipf-like distribution, so that the queries cover common words
+(many matches to rank), rare words and prefixes.
+
+Usage: python benchmarks/bench_search.py [--items 1000000] [--feeds 1000] [--followed 100] [--runs 50] [--db /tmp/bench.db]
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import config
+import db_service
+import migrations
+
+VOCABULARY = [f'word{number}' for number in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+
+
+def seed(db_path, items, feeds, followed):
+    db_connection = sqlite3.connect(db_path)
+    migrations.migrate(db_connection)
+    random.seed(1)
+    db_connection.execute("BEGIN")
+    db_connection.executemany("INSERT INTO rss_feeds (user_id, url, feed_id, updated_date) VALUES (?,?,?,0)",
+                              [(1 if number < followed else 2, f'http://example.com/{number}', f'feed{number}')
+                               for number in range(feeds)])
+    batch = []
+    for number in range(items):
+        words = random.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=30)
+        batch.append((f'feed{number % feeds}', f'item{number}', number // feeds + 1, ' '.join(words[:6]),
+                      f'http://example.com/item/{number}', ' '.join(words[6:]), 1678096800 + number))
+        if len(batch) == 10000:
+            insert_items(db_connection, batch)
+            batch = []
+    insert_items(db_connection, batch)
+    db_connection.commit()
+    db_connection.execute("INSERT INTO rss_feedData_fts (rss_feedData_fts) VALUES ('optimize')")
+    db_connection.commit()
+    db_connection.close()
+
+
+def insert_items(db_connection, batch):
+    db_connection.executemany("""INSERT INTO rss_feedData (feed_id, feed_item_id, item_no, title, link, summary, published)
+                                 VALUES (?,?,?,?,?,?,?)""", batch)
+
+
+def measure(function, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=1000000)
+    parser.add_argument('--feeds', type=int, default=1000)
+    parser.add_argument('--followed', type=int, default=100, help="feeds followed by the searching user")
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--db', help="database to seed, or to reuse if it exists")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), 'bench_search.db')
+    if not os.path.exists(db_path):
+        started = time.perf_counter()
+        seed(db_path, args.items, args.feeds, args.followed)
+        print(f"seeded {args.items} items in {time.perf_counter() - started:.1f}s ({db_path})")
+    config.config['db_path'] = db_path
+
+    first_page, _ = db_service.search_items(1, 'word3', 20)
+    queries = {
+        'common word': lambda: db_service.search_items(1, 'word3', 20),
+        'rare word': lambda: db_service.search_items(1, 'word15000', 20),
+        'two words': lambda: db_service.search_items(1, 'word10 word200', 20),
+        'prefix': lambda: db_service.search_items(1, 'word199*', 20),
+        'second page': lambda: db_service.search_items(1, 'word3', 20, first_page[-1]['cursor']),
+    }
+    for name, query in queries.items():
+        p50, p99 = measure(query, args.runs)
+        print(f"{name:12} results={len(query()[0]):3} p50={p50:8.2f}ms p99={p99:8.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
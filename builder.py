@@ -1,7 +1,35 @@
 import json
+import email.utils
 import feedparser
 import hashlib
+import itertools
+import logging
 import re
+import time
+from datetime import datetime, timezone
+import urllib.error
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+import metrics
+
+
+FETCH_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+DIGEST_FORMAT = re.compile(r'(?P<size>\d+)(?P<partial>\+?):[0-9a-f]+')
+# Local names of the elements holding an entry (RSS 2.0 and 1.0, Atom), and of the fields read from them.
+ENTRY_TAGS = ('item', 'entry')
+ENTRY_FIELDS = {
+    'title': ('title',),
+    'summary': ('description', 'summary', 'content', 'encoded'),
+    'link': ('link',),
+    'published': ('pubDate', 'published', 'date', 'updated'),
+    'guid': ('guid', 'id'),
+}
+USER_AGENT = "rss-feed-scraper/1.0 (+https://github.com/roshnipeter/rss_feed_scraper)"
+FETCH_SECONDS = metrics.Histogram('rss_feed_fetch_seconds', "Time spent downloading feeds. For streamed feeds, the time "
+                                  "until the response headers, the body is read while it is parsed.", ['source'])
+PARSE_SECONDS = metrics.Histogram('rss_feed_parse_seconds', "Time spent parsing feed documents.", ['parser'])
+
 
 def rss_feeder(feed_url) -> tuple:
     """
@@ -17,22 +45,388 @@ def rss_feeder(feed_url) -> tuple:
                 - "summary" - Summary of the entry
                 - "link" - The link associatied with the entry
                 - "published" - The published date of the entry.
+                - "guid" - The unique identifier of the entry, if the feed provides one.
             These are a sample subset of the data taken from RSS parser.
     Example usage:
 
     hash_key, feed_data = rss_feeder("https://www.example.com/rss.xml")
     """
-    feed = feedparser.parse(feed_url)
-    feed_data = [{ 
-                    "title": entry.title,
-                    "summary": entry.summary,
-                    "link": entry.link,
-                    "published": entry.published,
-                } for entry in feed.entries]
-    hash_key = generate_hash(feed_url)
+    try:
+        hash_key, feed_data, _ = conditional_rss_feeder(feed_url)
+    except (urllib.error.URLError, OSError) as e:
+        logging.warning("Could not fetch %s: %s", feed_url, e)
+        return generate_hash(feed_url), []
     return hash_key, feed_data
 
 
+def conditional_rss_feeder(feed_url, validators=None) -> tuple:
+    """
+    Fetches an RSS Feed using the validators stored from the previous fetch, and parses it only if it has changed.
+    Args:
+        feed_url: The URL which needs to be parsed.
+        validators: Optional dict with the "etag", "last_modified" and "digest" of the previous fetch.
+
+    Returns:
+        A tuple containing:
+            - The hash-key of URL
+            - A list of dictionaries as returned by rss_feeder, or None if the feed is unchanged since the previous fetch.
+            - A dict with the validators to store for the next fetch.
+    Raises:
+        urllib.error.URLError / OSError if the feed could not be downloaded.
+    Example usage:
+
+    hash_key, feed_data, validators = conditional_rss_feeder("https://www.example.com/rss.xml", validators)
+    if feed_data is None:
+        # nothing changed, skip parsing and storing
+    """
+    validators = validators or {}
+    response = fetch_feed(feed_url, validators.get('etag'), validators.get('last_modified'), validators.get('digest'))
+    new_validators = {
+        'etag': response['etag'],
+        'last_modified': response['last_modified'],
+        'digest': response['digest'],
+    }
+    hash_key = generate_hash(feed_url)
+    if response['not_modified']:
+        return hash_key, None, new_validators
+    return hash_key, parse_feed(response['body']), new_validators
+
+
+def stream_rss_feeder(feed_url, validators=None, max_bytes=None, max_entries=None) -> tuple:
+    """
+    Streaming variant of conditional_rss_feeder for feeds that may be very large: the document is downloaded in chunks
+    and parsed incrementally, and the entries are yielded one at a time as they are parsed (see iter_feed_entries), so
+    memory stays bounded by the size of one entry instead of the whole document. The consumer can stop early, e.g. once
+    it reaches entries it already knows, which also stops the download. When the server ignores the conditional headers,
+    the part of the document read on the previous fetch is downloaded first and compared against its digest, so that
+    unchanged feeds are not parsed again.
+    Args:
+        feed_url: The URL which needs to be parsed.
+        validators: Optional dict with the "etag", "last_modified" and "digest" of the previous fetch.
+        max_bytes: Optional maximum number of bytes read from the document, the rest is ignored.
+        max_entries: Optional maximum number of entries yielded.
+
+    Returns:
+        A tuple containing:
+            - The hash-key of URL
+            - A generator of dictionaries as returned by rss_feeder, or None if the feed is unchanged since the previous
+              fetch.
+            - A dict with the validators to store for the next fetch. Its "digest" is only set once the entries are
+              consumed or closed, and covers the part of the document read until then (see read_body).
+    Raises:
+        urllib.error.URLError / OSError if the feed could not be downloaded.
+    Example usage:
+
+    hash_key, entries, validators = stream_rss_feeder("https://www.example.com/rss.xml", validators, max_entries=1000)
+    for entry in entries:
+        ...
+    """
+    validators = validators or {}
+    request = urllib.request.Request(feed_url, headers=conditional_headers(validators.get('etag'), validators.get('last_modified')))
+    hash_key = generate_hash(feed_url)
+    try:
+        with FETCH_SECONDS.time('stream'):
+            response = urllib.request.urlopen(request, timeout=FETCH_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        return hash_key, None, {
+            'etag': e.headers.get('ETag') or validators.get('etag'),
+            'last_modified': e.headers.get('Last-Modified') or validators.get('last_modified'),
+            'digest': validators.get('digest'),
+        }
+    new_validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'digest': None,
+    }
+    # Servers that ignore the conditional headers: compare the part of the document read on the previous fetch.
+    head, unchanged = read_head(response, validators.get('digest'))
+    if unchanged:
+        response.close()
+        new_validators['digest'] = validators['digest']
+        return hash_key, None, new_validators
+    return hash_key, iter_feed_entries(read_body(response, new_validators, max_bytes, head), max_entries), new_validators
+
+
+def read_head(response, digest) -> tuple:
+    """
+    Reads as much of the body of an HTTP response as the previous fetch did, according to its digest (see read_body),
+    and compares it. A digest of a whole document only matches a body of the same size.
+    Args:
+        response: The HTTP response, positioned at the start of the body.
+        digest: The digest of the previous fetch, if any. Plain digests from before sizes were recorded never match.
+
+    Returns:
+        A tuple of the chunks read, to be passed on to read_body, and whether they match the digest.
+    """
+    match = DIGEST_FORMAT.fullmatch(digest or '')
+    if not match:
+        return [], False
+    size, partial = int(match.group('size')), bool(match.group('partial'))
+    head, read = [], 0
+    while read <= size:
+        chunk = response.read(CHUNK_SIZE if read < size else 1)
+        if not chunk:
+            break
+        head.append(chunk)
+        read += len(chunk)
+    if read < size or (read > size and not partial):
+        return head, False
+    return head, format_digest(hashlib.sha256(b''.join(head)[:size]), size, partial) == digest
+
+
+def read_body(response, validators: dict, max_bytes=None, head=()):
+    """
+    Generator over the body of an HTTP response in chunks of at most CHUNK_SIZE bytes, stopping after max_bytes, that
+    starts with the chunks already read by read_head. The response is closed when the generator finishes or is closed.
+    The digest of the bytes yielded until then is stored in validators, marked as partial unless the whole body was read.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    partial = True
+    try:
+        with response:
+            for chunk in itertools.chain(head, iter(lambda: response.read(CHUNK_SIZE), b'')):
+                if max_bytes is not None and size + len(chunk) > max_bytes:
+                    logging.warning("Feed %s is larger than %s bytes, the rest is ignored", response.url, max_bytes)
+                    chunk = chunk[:max_bytes - size]
+                    size += len(chunk)
+                    digest.update(chunk)
+                    yield chunk
+                    return
+                size += len(chunk)
+                digest.update(chunk)
+                yield chunk
+            partial = False
+    finally:
+        validators['digest'] = format_digest(digest, size, partial)
+
+
+def iter_feed_entries(chunks, max_entries=None):
+    """
+    Incrementally parses a feed document given as an iterable of byte chunks, yielding each entry as soon as its closing
+    tag is parsed, in the format of parse_feed. Parsed entries are removed from the tree, so memory is bounded by the
+    size of one entry. Documents that are not well-formed XML (e.g. HTML entities, unsupported encodings) are handed to
+    feedparser instead, as long as no entry was yielded yet; the chunks read until then are kept for that purpose.
+    Args:
+        chunks: An iterable of bytes, e.g. read_body. It is closed when the generator is.
+        max_entries: Optional maximum number of entries yielded.
+
+    Yields:
+        dict: An entry with the keys "title", "summary", "link", "published" and "guid".
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    parents = []
+    buffered = []
+    count = 0
+    parse_time = 0.0
+    chunks = iter(chunks)
+    try:
+        try:
+            for chunk in chunks:
+                if buffered is not None:
+                    buffered.append(chunk)
+                started = time.perf_counter()
+                parser.feed(chunk)
+                parse_time += time.perf_counter() - started
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        parents.append(element)
+                        continue
+                    parents.pop()
+                    if local_name(element.tag) not in ENTRY_TAGS:
+                        continue
+                    entry = entry_from_element(element)
+                    if parents:
+                        parents[-1].remove(element)
+                    count += 1
+                    buffered = None
+                    yield entry
+                    if max_entries is not None and count >= max_entries:
+                        return
+            parser.close()
+        except ElementTree.ParseError as e:
+            if buffered is None:
+                logging.warning("Feed document is not well-formed after %s entries: %s", count, e)
+                return
+            buffered.extend(chunks)
+            yield from parse_feed(b''.join(buffered))[:max_entries]
+    finally:
+        PARSE_SECONDS.observe(parse_time, 'stream')
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+
+def local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def entry_from_element(element) -> dict:
+    """
+    Returns the fields of an RSS <item> or Atom <entry> element, the first child listed in ENTRY_FIELDS winning.
+    """
+    children = {}
+    for child in element:
+        name = local_name(child.tag)
+        if name == 'link' and child.get('href') is not None:
+            if child.get('rel', 'alternate') == 'alternate':
+                children.setdefault('link', child.get('href'))
+        elif name not in children:
+            children[name] = ''.join(child.itertext()).strip()
+    return {field: next((children[name] for name in names if children.get(name)), None)
+            for field, names in ENTRY_FIELDS.items()}
+
+
+def fetch_feed(feed_url, etag=None, last_modified=None, digest=None) -> dict:
+    """
+    Downloads a feed with conditional request headers. The server may answer 304 Not Modified; when it ignores the
+    validators the digest of the body is compared against the previous one instead.
+    Args:
+        feed_url: The URL of the feed.
+        etag: ETag header received on the previous fetch, if any.
+        last_modified: Last-Modified header received on the previous fetch, if any.
+        digest: Content digest of the previous body, if any.
+
+    Returns:
+        A dict with the keys:
+            - "not_modified" - True if the feed did not change since the previous fetch
+            - "status" - HTTP status code of the response
+            - "etag", "last_modified", "digest" - Validators to send on the next fetch
+            - "body" - The raw feed document, or None if not_modified
+    """
+    request = urllib.request.Request(feed_url, headers=conditional_headers(etag, last_modified))
+    try:
+        with FETCH_SECONDS.time('urllib'), urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+            status = response.status
+            headers = response.headers
+            body = response.read()
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        return {
+            "not_modified": True,
+            "status": 304,
+            "etag": e.headers.get('ETag') or etag,
+            "last_modified": e.headers.get('Last-Modified') or last_modified,
+            "digest": digest,
+            "body": None,
+        }
+    body_digest = content_digest(body)
+    not_modified = digest is not None and body_digest == digest
+    return {
+        "not_modified": not_modified,
+        "status": status,
+        "etag": headers.get('ETag'),
+        "last_modified": headers.get('Last-Modified'),
+        "digest": body_digest,
+        "body": None if not_modified else body,
+    }
+
+
+def conditional_headers(etag=None, last_modified=None) -> dict:
+    """
+    Returns the request headers for a conditional GET of a feed.
+    Args:
+        etag: ETag of the previous response, sent as If-None-Match.
+        last_modified: Last-Modified of the previous response, sent as If-Modified-Since.
+
+    Returns:
+        A dict of HTTP request headers.
+    """
+    headers = {'User-Agent': USER_AGENT}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+@PARSE_SECONDS.time('feedparser')
+def parse_feed(document) -> list:
+    """
+    Parses a downloaded feed document into the list of dictionaries described in rss_feeder. Fields an entry does not
+    have are None, as in iter_feed_entries.
+    Args:
+        document: The raw feed document (bytes or str).
+
+    Returns:
+        A list of dictionaries, one per entry.
+    """
+    feed = feedparser.parse(document)
+    return [{
+                "title": entry.get('title'),
+                "summary": entry.get('summary'),
+                "link": entry.get('link'),
+                "published": entry.get('published'),
+                "guid": entry.get('id'),
+            } for entry in feed.entries]
+
+
+def content_digest(document) -> str:
+    """
+    Returns a digest of a feed document, used to detect unchanged feeds when the server ignores conditional headers.
+    Args:
+        document: The raw feed document in bytes.
+
+    Returns:
+        A string digest, see format_digest.
+    """
+    return format_digest(hashlib.sha256(document), len(document))
+
+
+def format_digest(digest, size: int, partial=False) -> str:
+    """
+    Returns the string form of a digest: the number of bytes it covers, "+" if the document continues after them, and
+    the hex digest, e.g. "1024+:9f86d0...".
+    Args:
+        digest: A hashlib hash of the first size bytes of the document.
+        size: The number of bytes hashed.
+        partial: Whether only the beginning of the document was hashed.
+    """
+    return f"{size}{'+' if partial else ''}:{digest.hexdigest()}"
+
+
+def published_epoch(published):
+    """
+    Returns the published date of a feed item, as found in RSS (RFC 822) or Atom (ISO 8601) documents, as an epoch.
+    Args:
+        published: The "published" string of a parsed item.
+
+    Returns:
+        An integer epoch, or None if the date is missing or cannot be parsed. Dates without a timezone are taken as UTC.
+    """
+    if not published:
+        return None
+    try:
+        date = email.utils.parsedate_to_datetime(published)
+    except (TypeError, ValueError):
+        try:
+            date = datetime.fromisoformat(published.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp())
+
+
+def generate_item_id(item) -> str:
+    """
+    Returns a stable identifier for a parsed feed item, so that an item keeps its identity when the feed is reordered
+    or the item is edited. The guid is used when the feed provides one, the link otherwise, then the title and the
+    published date, and the summary for an item that has none of them. Fields missing from the item may be None.
+    Args:
+        item: A dictionary as returned by rss_feeder.
+
+    Returns:
+        A string representing the hashed identity of the item
+    """
+    identity = (item.get('guid') or item.get('link') or ((item.get('title') or '') + (item.get('published') or ''))
+                or item.get('summary') or '')
+    return hashlib.md5(identity.encode('UTF-8')).hexdigest()
+
+
 def generate_hash(feed_url):
     """
     Returns a hashed value of the URL passed
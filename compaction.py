@@ -0,0 +1,120 @@
+"""
+Background job enforcing the retention policy of feed items.
+
+Items beyond "retention_max_items" per feed, or published more than "retention_max_age_days" ago, are removed from the
+database, except the items still unread by a follower of the feed if "retention_keep_unread". Removed items are first
+appended to the archive (see archive.py) when "archive_enabled", and stay readable through GET /feeds/archive. Items
+are removed in batches of "compaction_batch_size", each in its own short write transaction, with a pause in between so
+that the API and the refreshes are never held up for long. The pages freed are returned to the file system with an
+incremental vacuum, which requires the database to be in auto_vacuum=INCREMENTAL mode: new databases are created in it
+(see db_pool.connect), an existing one is converted once with python compaction.py --convert, which rewrites the whole
+file. Retention is only enforced with the sqlite storage backend, see storage.py.
+
+Run with: python compaction.py [--once] [--convert]
+"""
+import argparse
+import logging
+import threading
+import time
+import archive
+import config
+import db_pool
+import db_service
+import storage
+
+
+def compact(store=None, batch_size=None, pause=None) -> dict:
+    """
+    Runs one compaction over every feed with stored items.
+    Args:
+     - store: The archive.Archive removed items are appended to, None not to archive them.
+     - batch_size: Maximum number of items removed per write transaction.
+     - pause: Seconds to wait between two batches.
+    Returns:
+     - A dict with the number of feeds compacted, of items archived and deleted, and of free pages left.
+    """
+    batch_size = batch_size or config.config['compaction_batch_size']
+    pause = config.config['compaction_pause'] if pause is None else pause
+    stats = {'feeds': 0, 'archived': 0, 'deleted': 0, 'free_pages': 0}
+    if storage.backend.name != 'sqlite':
+        logging.info("The retention policy is only enforced with the sqlite storage backend")
+        return stats
+    for hash_key in db_service.get_stored_feed_ids():
+        compacted = False
+        while True:
+            items = db_service.get_expired_items(hash_key, batch_size)
+            if not items:
+                break
+            # Archived before they are deleted: a crash in between only leaves items both archived and stored.
+            segment = store.append(items) if store else None
+            deleted = db_service.delete_expired_items(hash_key, items, segment)
+            stats['archived'] += len(items) if store else 0
+            stats['deleted'] += deleted
+            compacted = True
+            if deleted < len(items) or len(items) < batch_size:
+                break
+            time.sleep(pause)
+        stats['feeds'] += compacted
+    stats['free_pages'] = vacuum(pause)
+    return stats
+
+
+def vacuum(pause: float) -> int:
+    """
+    Returns the free pages of the database file to the file system, "compaction_vacuum_pages" at a time.
+    Returns:
+     - int: The number of free pages left, which stays above 0 unless the database is in incremental mode.
+    """
+    with db_pool.cursor() as (db_connection, cursor):
+        mode = cursor.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if mode != 2:
+        logging.info("The database is not in auto_vacuum=INCREMENTAL mode, run python compaction.py --convert once")
+        with db_pool.cursor() as (db_connection, cursor):
+            return cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    while True:
+        free_pages = db_service.incremental_vacuum(config.config['compaction_vacuum_pages'])
+        if not free_pages:
+            return 0
+        time.sleep(pause)
+
+
+def convert() -> None:
+    """
+    Switches the database to auto_vacuum=INCREMENTAL. This rewrites the whole file while holding the write lock, so it
+    is run once, when the application is idle.
+    """
+    with db_pool.writer() as (db_connection, cursor):
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.execute("VACUUM")
+
+
+def run_forever(stop_event=None) -> None:
+    """
+    Runs a compaction every "compaction_interval" seconds until stop_event is set.
+    """
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        store = archive.Archive(config.config['archive_path']) if config.config['archive_enabled'] else None
+        started = time.monotonic()
+        stats = compact(store)
+        logging.info("Compaction done in %.1fs: %s", time.monotonic() - started, stats)
+        stop_event.wait(config.config['compaction_interval'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Enforces the retention policy of feed items.")
+    parser.add_argument('--once', action='store_true', help="run a single compaction and exit")
+    parser.add_argument('--convert', action='store_true', help="switch the database to incremental vacuum first")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.convert:
+        convert()
+    try:
+        if args.once:
+            store = archive.Archive(config.config['archive_path']) if config.config['archive_enabled'] else None
+            logging.info("Compaction done: %s", compact(store))
+        else:
+            logging.info("Compaction started. To exit press CTRL+C")
+            run_forever()
+    except KeyboardInterrupt:
+        logging.info("Compaction stopped")
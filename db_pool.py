@@ -0,0 +1,250 @@
+"""
+Thread-safe pool of SQLite connections shared by db_service.
+
+Connections are opened once and reused, so the connection setup and the per-connection statement cache are not paid on
+every request. The database runs in WAL mode: readers never block behind the writer and the writer does not wait for
+readers. Writes are additionally serialized in-process through writer(), so concurrent writers queue on a lock instead
+of spinning on SQLite's busy handler.
+
+Example usage:
+
+with db_pool.cursor() as (db_connection, cursor):
+    cursor.execute("SELECT url FROM rss_feeds WHERE user_id=?", (user_id,))
+
+with db_pool.writer() as (db_connection, cursor):
+    cursor.execute("UPDATE ...")
+    db_connection.commit()
+
+Every statement is timed by class (verb and table, e.g. "select rss_feedData") in rss_db_statement_seconds, see
+metrics.py, along with the time spent waiting for a connection or for the write lock and the time the lock is held.
+"""
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+import config
+import metrics
+import migrations
+import read_state
+
+
+_pool = None
+_pool_lock = threading.Lock()
+STATEMENT_SECONDS = metrics.Histogram('rss_db_statement_seconds', "Time spent executing SQL statements, by statement "
+                                      "class. For queries, the time until the first row.", ['statement'])
+WAIT_SECONDS = metrics.Histogram('rss_db_pool_wait_seconds', "Time spent waiting for a pooled connection or for the "
+                                 "write lock.", ['resource'])
+WRITE_LOCK_SECONDS = metrics.Histogram('rss_db_write_lock_held_seconds', "Time the write lock is held.")
+STATEMENT_TARGET = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|INDEX)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?"?(\w+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def statement_class(sql: str) -> str:
+    """
+    Returns the class of a statement: its verb and the first table it reads or writes, e.g. "insert rss_feedData".
+    """
+    words = sql.split(None, 1)
+    if not words:
+        return 'empty'
+    target = STATEMENT_TARGET.search(sql)
+    return f"{words[0].lower()} {target.group(1)}" if target else words[0].lower()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    A cursor recording the time each statement takes in STATEMENT_SECONDS.
+    """
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            STATEMENT_SECONDS.observe(time.perf_counter() - started, statement_class(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            STATEMENT_SECONDS.observe(time.perf_counter() - started, statement_class(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    A connection whose cursors are TimedCursors. The execute() shortcuts of the connection, only used by migrations,
+    are not timed.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """
+    Opens a connection to the database with the pragmas used by the application.
+    Args:
+     - db_path: Path of the SQLite database file.
+    Returns:
+     - A sqlite3 connection that may be used from any thread, one thread at a time.
+    """
+    new = not os.path.exists(db_path) or not os.path.getsize(db_path)
+    db_connection = sqlite3.connect(db_path, timeout=10, check_same_thread=False, factory=TimedConnection,
+                                    cached_statements=config.config['db_cached_statements'])
+    if new:
+        # Has to be set before the first table is created, see compaction.py for existing databases.
+        db_connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    db_connection.execute("PRAGMA journal_mode=WAL")
+    db_connection.execute("PRAGMA synchronous=NORMAL")
+    db_connection.execute(f"PRAGMA cache_size=-{int(config.config['db_cache_size_kib'])}")
+    db_connection.execute(f"PRAGMA mmap_size={int(config.config['db_mmap_size'])}")
+    db_connection.execute("PRAGMA temp_store=MEMORY")
+    db_connection.create_function('read_bit', 3, read_state.read_bit, deterministic=True)
+    return db_connection
+
+
+class ConnectionPool:
+    """
+    A bounded pool of connections to one database file. Connections are created lazily up to size; when all of them
+    are in use, callers wait up to timeout seconds for one to be returned.
+    """
+
+    def __init__(self, db_path: str, size: int, timeout: float = 10):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self.write_lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.in_use = 0
+        self._closed = False
+
+    def _checkout(self) -> sqlite3.Connection:
+        started = time.perf_counter()
+        with self._lock:
+            if self._idle.empty() and self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                db_connection = connect(self.db_path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        else:
+            try:
+                db_connection = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise sqlite3.OperationalError("Timed out waiting for a database connection from the pool")
+        with self._lock:
+            self.in_use += 1
+        WAIT_SECONDS.observe(time.perf_counter() - started, 'connection')
+        return db_connection
+
+    def _checkin(self, db_connection: sqlite3.Connection) -> None:
+        with self._lock:
+            self.in_use -= 1
+        if db_connection.in_transaction:
+            # The caller neither committed nor rolled back, do not leak its transaction to the next user.
+            db_connection.rollback()
+        if self._closed:
+            db_connection.close()
+        else:
+            self._idle.put(db_connection)
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the with block.
+        """
+        db_connection = self._checkout()
+        try:
+            yield db_connection
+        finally:
+            self._checkin(db_connection)
+
+    @contextmanager
+    def cursor(self):
+        """
+        Checks out a connection and yields a (connection, cursor) tuple. The cursor is closed on exit.
+        """
+        with self.connection() as db_connection:
+            cursor = db_connection.cursor()
+            try:
+                yield db_connection, cursor
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def writer(self):
+        """
+        Like cursor(), holding the pool's write lock so that only one thread of the process writes at a time. Keep the
+        block short: do not fetch or parse feeds while holding it.
+        """
+        started = time.perf_counter()
+        with self.write_lock:
+            acquired = time.perf_counter()
+            WAIT_SECONDS.observe(acquired - started, 'write_lock')
+            try:
+                with self.cursor() as connection_and_cursor:
+                    yield connection_and_cursor
+            finally:
+                WRITE_LOCK_SECONDS.observe(time.perf_counter() - acquired)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of connections in use, opened, and allowed, for the pool saturation gauge.
+        """
+        with self._lock:
+            return {('in_use',): self.in_use, ('open',): self._created, ('size',): self.size}
+
+    def close(self) -> None:
+        """
+        Closes the idle connections; connections in use are closed when they are returned.
+        """
+        self._closed = True
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the pool for the configured database, creating it and applying pending migrations on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_path != config.config['db_path']:
+            if _pool is not None:
+                _pool.close()
+            pool = ConnectionPool(config.config['db_path'], config.config['db_pool_size'])
+            with pool.connection() as db_connection:
+                migrations.migrate(db_connection)
+            _pool = pool
+        return _pool
+
+
+def pool_stats() -> dict:
+    return _pool.stats() if _pool is not None else {}
+
+
+POOL_CONNECTIONS = metrics.Gauge('rss_db_pool_connections', "Connections of the pool, by state.", ['state'], pool_stats)
+
+
+def connection():
+    return get_pool().connection()
+
+
+def cursor():
+    return get_pool().cursor()
+
+
+def writer():
+    return get_pool().writer()
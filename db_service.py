@@ -1,4 +1,10 @@
+import asyncio
 import sqlite3
+import time
+import email.utils
+import itertools
+import re
+import zlib
 import traceback
 import json
 import jwt
@@ -6,41 +12,50 @@ import logging
 from flask import jsonify
 from dramatiq import actor
 from datetime import datetime, timedelta
-from  werkzeug.security import generate_password_hash, check_password_hash
 import config
 import builder
+import db_pool
+import archive
+import fetcher
+import notifier
+import password_hasher
+import read_state
+import response_cache
+import storage
 
 
-DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+MARKED_STATUS = storage.MARKED_STATUS
+READ_PREDICATE = storage.READ_PREDICATE
+DIFF_BATCH_SIZE = 50
+ITEM_COLUMNS = storage.ITEM_COLUMNS
+ORDERS = ('seq', 'published')
+SEARCH_TITLE_WEIGHT = 4.0
 
 
 def get_db_cursor():
     """
-    This function returns a tuple of a database connection and a cursor. The database connection is established with the
-    sqlite3.connect() method to the local database file "rss_feeds.db" with a timeout of 10 seconds to avoid locking.
-    The cursor is created from the database connection to execute SQL statements. The caller function is expected to handle
-    closing the cursor and committing or rolling back the changes made with the connection.
+    This function returns a tuple of a database connection and a cursor. The connection is a dedicated one, opened to the
+    database of the storage backend with the same settings as the pooled connections, and is not returned to the pool:
+    the caller function is expected to handle closing the cursor and the connection, and committing or rolling back the
+    changes made with it. The application code uses the pooled connections of storage.backend instead.
     Returns:
-
+     - A tuple of the connection and a cursor.
     """
-    db_connection = sqlite3.connect("rss_feeds.db", timeout=10)
-    cursor = db_connection.cursor()
-    return db_connection, cursor
+    return storage.backend.connect()
 
 
 @actor()
-def update_all_feeds(user_id: int, url: str):
+def update_all_feeds(hash_key: str):
     """
-    Updates all the RSS feeds associated with a given user by calling the force_feed_update function for each feed
+    Updates an RSS feed for all the users following it by calling the force_feed_update function for the feed
     Args:
-     - user_id: ID of the user
-     - url: URL given by the user
+     - hash_key: Hashed key of the feed URL
 
     Returns:
      - None
     """
     logging.info("Started")
-    force_feed_update.send(user_id, url)
+    force_feed_update.send(hash_key)
     logging.info("Ended")
 
 
@@ -56,107 +71,479 @@ def create_user(user_id: int, password: str) -> tuple:
     if not user_id or not password:
         response = {"success": False, "message": "UserID / Password missing."}, 400
         return response
-    response = insert_data_to_user(user_id, generate_password_hash(password))
+    try:
+        password_hash = password_hasher.get_hasher().hash(password)
+    except password_hasher.HasherBusy:
+        return {"success": False, "message": "Server busy, try again later."}, 503
+    response = insert_data_to_user(user_id, password_hash)
     return response
 
 
 def insert_feeds_to_db(user_id: int, url: str) -> tuple:
     """
+    Follows a feed for a user. The feed is fetched and diffed against the stored items before taking the write lock, and
+    the follow row, the validators and the feed items are then written in a single transaction.
     Args:
      - user_id: User id for the user who is following the RSS feed
      - url: URL of the RSS feed
 
     Returns:
-     - A tuple containing the result of the operation and the HTTP status code.
+     - A tuple containing the result of the operation and the HTTP status code. On success, "inserted" holds the number of
+       rows written.
 
     """
     try:
-        db_connection, cursor = get_db_cursor()
-        hash_key, feed_data = builder.rss_feeder(url)
+        hash_key = builder.generate_hash(url)
+        with storage.backend.cursor() as (db_connection, cursor):
+            feed_followed = is_feed_followed(hash_key, cursor)
+            validators = None if feed_followed else get_feed_validators(hash_key, cursor)
+        feed_items = None
+        if not feed_followed:
+            # Fetch and diff before taking the write lock, so that slow feeds do not hold up other writers.
+            try:
+                feed_items, validators = fetch_feed_items(url, validators)
+            except OSError as e:
+                logging.warning("Could not fetch %s: %s", url, e)
+                feed_items, validators = ([], []), None
 
-        feed_table_entry, duplicate = insert_data_to_feeds(user_id, url, hash_key, db_connection, cursor)
-        if feed_table_entry is False and duplicate is False:
-            return {"success": False, 'message': 'Error in updating data'}, 500
-        if duplicate:
-            return {"success": True, 'message': 'URL already followed by user'}, 200
+        with storage.backend.writer() as (db_connection, cursor):
+            try:
+                item_rows = follow_feed(user_id, url, hash_key, feed_items, validators, db_connection, cursor)
+                if item_rows is None:
+                    return {"success": True, 'message': 'URL already followed by user'}, 200
+                db_connection.commit()
+            except Exception:
+                db_connection.rollback()
+                raise
+        invalidate_followed_feed(user_id, hash_key, item_rows)
+        return {'success': True, 'message': 'Inserted successfully', 'inserted': 1 + item_rows}, 200
+    except storage.backend.OperationalError as e:
+        traceback.print_exc()
+        return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
+    except Exception as e:
+        traceback.print_exc()
+        return {"success": False, "message": "Insertion error!", "error": str(e)}, 500
 
-        feed_items_table_entry = insert_data_to_feed_items_table(user_id, hash_key, feed_data, db_connection, cursor)
-        if not feed_items_table_entry:
-            return {"success": False, 'message': 'Error in database updation'}, 500
 
-        return {'success': True, 'message': 'Inserted successfully'}, 200
+def follow_feed(user_id: int, url: str, hash_key: str, feed_items, validators, db_connection: sqlite3.Connection,
+                cursor: sqlite3.Cursor):
+    """
+    Writes the follow row of a user for a feed, and the fetched items and validators of the feed. The caller is
+    expected to commit, and then to call invalidate_followed_feed.
+    Args:
+     - user_id: ID of the user following the feed.
+     - url: URL of the feed.
+     - hash_key: Hashed key of the feed URL.
+     - feed_items: The result of diff_feed_items, or None when the feed is already stored for its other followers or
+       has not changed since the last fetch: its items are then shared with the new follower.
+     - validators: The validators of the fetch, see save_feed_validators.
+     - db_connection: Database connection object of storage.backend.
+     - cursor: Cursor object for executing SQL queries.
+    Returns:
+     - The number of item rows written, or None if the user already follows the feed.
+    """
+    if not insert_data_to_feeds(user_id, url, hash_key, db_connection, cursor):
+        return None
+    if feed_items is None:
+        return 0
+    if validators:
+        save_feed_validators(hash_key, validators, cursor)
+    return insert_data_to_feed_items_table(user_id, hash_key, feed_items, db_connection, cursor)
+
+
+def invalidate_followed_feed(user_id: int, hash_key: str, item_rows: int) -> None:
+    """
+    Invalidates the cached responses affected by follow_feed, once committed.
+    """
+    response_cache.cache.invalidate_user(user_id, [hash_key])
+    if item_rows:
+        response_cache.cache.invalidate_feed(hash_key)
+        notifier.notifier.publish(hash_key)
+
+
+def create_import_job(job_id: str, user_id: int, total: int) -> tuple:
+    """
+    Registers an OPML import before it is queued, so that its progress can be polled with get_import_job.
+    Args:
+     - job_id: The id of the import.
+     - user_id: ID of the importing user.
+     - total: The number of feeds to import.
+    Returns:
+     - A tuple containing the result of the operation and the HTTP status code.
+    """
+    now = int(time.time())
+    try:
+        with db_pool.writer() as (db_connection, cursor):
+            cursor.execute("""INSERT INTO rss_import_jobs (job_id, user_id, status, total, created_date, updated_date)
+                              VALUES (?,?,'queued',?,?,?)""", (job_id, user_id, total, now, now))
+            db_connection.commit()
+        return {"success": True, "job_id": job_id, "total": total}, 200
     except sqlite3.OperationalError as e:
         traceback.print_exc()
         return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
+
+
+def get_import_job(user_id: int, job_id: str) -> tuple:
+    """
+    Returns the progress of an OPML import of the user: its status ('queued', 'running', 'done' or 'failed'), the number
+    of feeds to import, the number of feeds done so far, and the URL and error of the feeds that could not be fetched.
+    Args:
+     - user_id: ID of the importing user.
+     - job_id: The id of the import.
+    Returns:
+     - A tuple containing the progress and the HTTP status code, 404 if the user has no such import.
+    """
+    with db_pool.cursor() as (db_connection, cursor):
+        job = cursor.execute("""SELECT status, total, done, failed, errors FROM rss_import_jobs
+                                WHERE job_id=? AND user_id=?""", (job_id, user_id)).fetchone()
+    if job is None:
+        return {"success": False, "message": "No such import!"}, 404
+    return {"success": True, "job_id": job_id, "status": job[0], "total": job[1], "done": job[2], "failed": job[3],
+            "errors": json.loads(job[4])}, 200
+
+
+def update_import_job(job_id: str, cursor: sqlite3.Cursor, status=None, done=0, errors=()) -> None:
+    """
+    Records the progress of an OPML import. The caller is expected to commit.
+    Args:
+     - job_id: The id of the import.
+     - cursor: Cursor object for executing SQL queries.
+     - status (optional): The new status of the import.
+     - done (optional): The number of feeds imported since the last update.
+     - errors (optional): {"url": ..., "error": ...} dicts of the feeds that failed since the last update.
+    """
+    stored_errors = None
+    if errors:
+        stored = cursor.execute("SELECT errors FROM rss_import_jobs WHERE job_id=?", (job_id,)).fetchone()
+        stored_errors = json.dumps(json.loads(stored[0]) + list(errors)) if stored else None
+    cursor.execute("""UPDATE rss_import_jobs SET status=COALESCE(?, status), done=done+?, failed=failed+?,
+                      errors=COALESCE(?, errors), updated_date=? WHERE job_id=?""",
+                   (status, done, len(errors), stored_errors, int(time.time()), job_id))
+
+
+def import_opml(job_id: str, user_id: int, urls: list, **fetch_options) -> tuple:
+    """
+    Follows many feeds at once, for an OPML import registered with create_import_job. Feeds already stored for other
+    followers are followed in a single transaction. The other feeds are fetched concurrently with
+    fetcher.AsyncFeedFetcher, within its global and per-host limits, and each is written in its own transaction as soon
+    as it is downloaded, followed by the progress of the import. Feeds that cannot be fetched are followed all the
+    same, their items are fetched by the next refresh, and they are reported in the errors of the import.
+    Args:
+     - job_id: The id of the import.
+     - user_id: ID of the importing user.
+     - urls: URLs of the feeds to follow, deduplicated.
+     - fetch_options: Options of fetcher.AsyncFeedFetcher.
+    Returns:
+     - A tuple containing the progress of the import and the HTTP status code.
+    """
+    try:
+        feeds = {builder.generate_hash(url): url for url in urls}
+        with storage.backend.cursor() as (db_connection, cursor):
+            stored = [hash_key for hash_key in feeds if is_feed_followed(hash_key, cursor)]
+            validators = {feeds[hash_key]: get_feed_validators(hash_key, cursor)
+                          for hash_key in feeds if hash_key not in stored}
+        with storage.backend.writer() as (db_connection, cursor):
+            for hash_key in stored:
+                follow_feed(user_id, feeds[hash_key], hash_key, None, None, db_connection, cursor)
+            db_connection.commit()
+        # Import jobs are kept in the SQLite database of db_pool whatever the storage backend, see storage.py.
+        with db_pool.writer() as (db_connection, cursor):
+            update_import_job(job_id, cursor, status='running', done=len(stored))
+            db_connection.commit()
+        response_cache.cache.invalidate_user(user_id, stored)
+
+        asyncio.run(fetch_imported_feeds(job_id, user_id, feeds, validators, fetch_options))
+        with db_pool.writer() as (db_connection, cursor):
+            update_import_job(job_id, cursor, status='done')
+            db_connection.commit()
     except Exception as e:
-        return {"success": False, "message": "Insertion error!", "error": str(e)}, 500
-    finally:
-        cursor.close()
+        traceback.print_exc()
+        with db_pool.writer() as (db_connection, cursor):
+            update_import_job(job_id, cursor, status='failed')
+            db_connection.commit()
+        return {"success": False, "message": "Import error!", "error": str(e)}, 500
+    return get_import_job(user_id, job_id)
+
+
+async def fetch_imported_feeds(job_id: str, user_id: int, feeds: dict, validators: dict, fetch_options: dict) -> None:
+    """
+    Fetches the feeds of an import that are not stored yet, and follows each one as it is downloaded, see import_opml.
+    Feeds are written on another thread, so that downloads go on meanwhile.
+    """
+    async with fetcher.AsyncFeedFetcher(**fetch_options) as feed_fetcher:
+        async for hash_key, feed_data in feed_fetcher.fetch_many(list(validators), validators):
+            await asyncio.to_thread(follow_imported_feed, job_id, user_id, feeds[hash_key], hash_key, feed_data,
+                                    feed_fetcher.validators[hash_key])
+        for hash_key, error in feed_fetcher.errors.items():
+            await asyncio.to_thread(follow_imported_feed, job_id, user_id, feeds[hash_key], hash_key, [], None,
+                                    str(error) or type(error).__name__)
+
+
+def follow_imported_feed(job_id: str, user_id: int, url: str, hash_key: str, feed_data, validators, error=None) -> None:
+    """
+    Follows a fetched feed of an import, then records it in the progress of the import.
+    Args:
+     - job_id: The id of the import.
+     - user_id: ID of the importing user.
+     - url: URL of the feed.
+     - hash_key: Hashed key of the feed URL.
+     - feed_data: The parsed entries of the feed, or None if it has not changed since its last fetch.
+     - validators: The validators of the fetch.
+     - error (optional): Why the feed could not be fetched.
+    """
+    feed_items = None
+    if feed_data is not None:
+        db_connection, cursor = get_db_cursor()
+        try:
+            feed_items = diff_feed_items(hash_key, itertools.islice(feed_data, config.config['feed_max_entries']), cursor)
+        finally:
+            cursor.close()
+            db_connection.close()
+    with storage.backend.writer() as (db_connection, cursor):
+        try:
+            item_rows = follow_feed(user_id, url, hash_key, feed_items, validators, db_connection, cursor)
+            db_connection.commit()
+        except Exception:
+            db_connection.rollback()
+            raise
+    invalidate_followed_feed(user_id, hash_key, item_rows)
+    with db_pool.writer() as (db_connection, cursor):
+        update_import_job(job_id, cursor, done=1, errors=[{"url": url, "error": error}] if error else ())
+        db_connection.commit()
+
+
+def iter_followed_feeds(user_id: int):
+    """
+    Generator over the feeds followed by a user, in the order they were followed.
+    Yields:
+     - tuple: The URL of the feed and its title, which is not stored and always None.
+    """
+    with storage.backend.cursor() as (db_connection, cursor):
+        for url, _ in storage.backend.iter_followed_feeds(user_id, cursor):
+            yield url, None
 
 
-def get_feeds(user_id: int, url: str, marked=None) -> tuple:
+def get_feeds(user_id: int, url: str, marked=None, limit=None, after=None, order='seq') -> tuple:
     """
-    Fetches feed items for a given user and URL.
+    Fetches a page of feed items for a given user and URL, newest first.
 
     Args:
      - user_id: ID of the user whose feed items need to be fetched.
      - url: URL of the RSS feed.
      - marked (optional): Marked status of the feed items - 'read' or 'unread'. Defaults to None.
+     - limit (optional): Maximum number of items to return, all of them if None.
+     - after (optional): The "seq" of the last item of the previous page, to fetch the page following it.
+     - order (optional): 'seq' for the order the items were stored in, 'published' for their published date.
 
     Returns:
      - Tuple : By default, all items are returned as response(the case when marked is None). If marked is read/ unread, corresponding rows
-        are filtered out from the database.
+        are filtered out from the database. Each item carries its "seq", the last one being the cursor for the next page.
     """
-    db_connection, cursor = get_db_cursor()
+    if marked and marked not in MARKED_STATUS:
+        return jsonify({"success": False, 'message': f'No items in the feed that are {marked}.'}), 200
     try:
-        marked_item_ids = []
-        if not marked:
-            feeds = cursor.execute("""SELECT rss_feeds.url, rss_feedData.feed_item, rss_feedData.feed_item_id
-                                  FROM rss_feeds INNER JOIN rss_feedData
-                                  ON rss_feeds.feed_id=rss_feedData.feed_id
-                                  WHERE rss_feeds.user_id=? ORDER BY datetime(rss_feeds.updated_date) DESC""", (user_id,))
-
-        else:
-            if marked == 'read':
-                marked_item_ids = get_marked_items(user_id, url, marked=1, cursor=cursor)
-            elif marked == 'unread':
-                marked_item_ids = get_marked_items(user_id, url, marked=0, cursor=cursor)
-            if not marked_item_ids:
-                return jsonify({"success": False, 'message': f'No items in the feed that are {marked}.'}), 200
-
-            placeholders = ','.join('?' * len(marked_item_ids))
-            feeds = cursor.execute(f"""SELECT rss_feeds.url, rss_feedData.feed_item, rss_feedData.feed_item_id
-                                    FROM rss_feeds INNER JOIN rss_feedData
-                                    ON rss_feeds.feed_id=rss_feedData.feed_id
-                                    WHERE rss_feeds.user_id=? AND rss_feedData.feed_item_id IN ({placeholders})""",([user_id] + marked_item_ids))
-            if feeds is []:
-                return {"success": False, 'message': 'No items identified.'}, 404
-        return [{
-            'id': feed[2],
-            'url': feed[0],
-            'data': json.loads(feed[1]),
-        } for feed in feeds], 200
-
-    except sqlite3.OperationalError as e:
+        feeds = list(iter_feed_items(user_id, url, marked, after, limit, order))
+        if marked and not feeds and after is None:
+            return jsonify({"success": False, 'message': f'No items in the feed that are {marked}.'}), 200
+        return feeds, 200
+    except storage.backend.OperationalError as e:
         traceback.print_exc()
         return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
     except Exception as e:
         traceback.print_exc()
         return {"success": False, "message": 'Error in fetching records', "error": str(e)}, 500
-    finally:
-        cursor.close()
+
+
+def iter_feed_items(user_id: int, url: str, marked=None, after=None, limit=None, order='seq'):
+    """
+    Generator over the feed items of a given user and URL, newest first, reading rows from the cursor in batches so that
+    memory stays flat however many items there are. Pagination is keyset based: after is the "seq" of the last item
+    already seen, and only older items follow. Items are read from their columns, see serialize_item.
+
+    Args:
+     - user_id: ID of the user whose feed items need to be fetched.
+     - url: URL of the RSS feed.
+     - marked (optional): 'read' or 'unread' to filter on the marked status of the items.
+     - after (optional): The "seq" of the last item already seen.
+     - limit (optional): Maximum number of items to yield, all of them if None.
+     - order (optional): 'seq' for the order the items were stored in, 'published' for their published date. Items
+       published at the same time, or without a date, keep the order they were stored in.
+
+    Yields:
+     - dict: An item with the keys "id", "seq", "url" and "data".
+    """
+    with storage.backend.cursor() as (db_connection, cursor):
+        for row in storage.backend.iter_items(user_id, url, cursor, marked, after, limit, order):
+            yield item_from_row(row)
+
+
+def stream_feed_items(user_id: int, url: str, marked=None, after=None, limit=None, order='seq'):
+    """
+    Like iter_feed_items, for responses streamed to clients that may read slowly: items are read in keyset pages of
+    storage.FETCH_BATCH_SIZE, and a pooled connection is only checked out while a page is read, not for the whole
+    response.
+    """
+    while limit is None or limit > 0:
+        page_size = storage.FETCH_BATCH_SIZE if limit is None else min(limit, storage.FETCH_BATCH_SIZE)
+        page = list(iter_feed_items(user_id, url, marked, after, page_size, order))
+        yield from page
+        if len(page) < page_size:
+            return
+        after = page[-1]['seq']
+        if limit is not None:
+            limit -= len(page)
+
+
+def item_from_row(row: tuple) -> dict:
+    """
+    Returns an item with the keys "id", "seq", "url" and "data" from an item row of storage.backend.
+    """
+    return {
+        'id': row[1],
+        'seq': row[2],
+        'url': row[0],
+        'data': serialize_item(row[3:]),
+    }
+
+
+def serialize_item(row: tuple) -> dict:
+    """
+    Returns the "data" of an item from the ITEM_COLUMNS of its row, in the format of builder.parse_feed. The published
+    date is stored as an epoch and given back as an RFC 822 date in GMT, or None if the feed did not provide one.
+    """
+    title, link, summary, published, guid = row
+    return {
+        'title': title,
+        'summary': summary,
+        'link': link,
+        'published': email.utils.formatdate(published, usegmt=True) if published else None,
+        'guid': guid,
+    }
+
+
+def get_items_after(user_id: int, after: int, limit: int) -> list:
+    """
+    Returns the items stored after a given one in any feed followed by a user, oldest first, for the change-notification
+    stream. Items are numbered by "seq" in the order they were stored, so a client that saw the items up to a seq
+    resumes from it.
+    Args:
+     - user_id: ID of the user.
+     - after: The "seq" of the last item already seen.
+     - limit: Maximum number of items to return.
+    Returns:
+     - list: Items with the keys "id", "seq", "url" and "data", like iter_feed_items.
+    """
+    with storage.backend.cursor() as (db_connection, cursor):
+        rows = storage.backend.get_items_after(user_id, after, limit, cursor)
+    return [item_from_row(row) for row in rows]
+
+
+def get_last_item_seq() -> int:
+    """
+    Returns the "seq" of the last item stored, 0 if there is none.
+    """
+    with storage.backend.cursor() as (db_connection, cursor):
+        return storage.backend.get_last_item_seq(cursor)
+
+
+def poll_new_items(last_seq) -> tuple:
+    """
+    Returns the feeds that have items stored after last_seq, and the "seq" of the last item stored, for the watcher of
+    notifier.py. On the first call, last_seq is None and no feed is returned.
+    """
+    if last_seq is None:
+        return [], get_last_item_seq()
+    with storage.backend.cursor() as (db_connection, cursor):
+        rows = storage.backend.get_new_item_feeds(last_seq, cursor)
+    return [row[0] for row in rows], max([last_seq] + [row[1] for row in rows])
+
+
+def get_user_feed_ids(user_id: int) -> list:
+    """
+    Returns the hash keys of the feeds followed by a user.
+    """
+    with storage.backend.cursor() as (db_connection, cursor):
+        return storage.backend.get_user_feed_ids(user_id, cursor)
+
+
+def item_columns(item: dict) -> tuple:
+    """
+    Returns the values of ITEM_COLUMNS for a parsed item.
+    """
+    return (item.get('title'), item.get('link'), item.get('summary'), builder.published_epoch(item.get('published')) or 0,
+            item.get('guid'))
+
+
+def search_items(user_id: int, text: str, limit: int, after=None) -> tuple:
+    """
+    Full-text search over the titles and summaries of the items of every feed followed by a user, through the FTS5
+    index rss_feedData_fts. Results are ranked with bm25, a match in the title weighing SEARCH_TITLE_WEIGHT times a match
+    in the summary, and carry a snippet of the matching text. Pagination is keyset based on (rank, seq).
+
+    Args:
+     - user_id: ID of the user searching.
+     - text: The search terms. Every word has to match, the last one as a prefix if it ends with "*".
+     - limit: Maximum number of items to return.
+     - after (optional): The "cursor" of the last item of the previous page.
+
+    Returns:
+     - Tuple : The list of matching items, each an item of iter_feed_items with its "snippet", "rank" and "cursor".
+    """
+    if storage.backend.name != 'sqlite':
+        return {"success": False, "message": "Search is not supported by the storage backend."}, 501
+    terms = re.findall(r'\w+', text or '')
+    if not terms:
+        return {"success": False, "message": "Please provide search terms!"}, 400
+    match = ' '.join(f'"{term}"' for term in terms) + ('*' if text.rstrip().endswith('*') else '')
+    query = f"""SELECT * FROM (
+                    SELECT rss_feeds.url, rss_feedData.feed_item_id, rss_feedData.item_seq, rss_feedData.title,
+                    rss_feedData.link, rss_feedData.summary, rss_feedData.published, rss_feedData.guid,
+                    bm25(rss_feedData_fts, {SEARCH_TITLE_WEIGHT}, 1.0) AS rank
+                    FROM rss_feedData_fts
+                    INNER JOIN rss_feedData ON rss_feedData.item_seq=rss_feedData_fts.rowid
+                    INNER JOIN rss_feeds ON rss_feeds.feed_id=rss_feedData.feed_id AND rss_feeds.user_id=?
+                    WHERE rss_feedData_fts MATCH ? LIMIT -1)"""
+    # LIMIT -1 keeps the subquery from being flattened, which would compute bm25 again for the cursor condition.
+    parameters = [user_id, match]
+    if after:
+        try:
+            after_rank, after_seq = after.rsplit(',', 1)
+            parameters += [float(after_rank), float(after_rank), int(after_seq)]
+        except ValueError:
+            return {"success": False, "message": "Invalid cursor."}, 400
+        query += " WHERE rank>? OR (rank=? AND item_seq<?)"
+    query += " ORDER BY rank, item_seq DESC LIMIT ?"
+    parameters.append(limit)
+    try:
+        with db_pool.cursor() as (db_connection, cursor):
+            rows = cursor.execute(query, parameters).fetchall()
+            # Snippets are only built for the page, not for every match that was ranked.
+            placeholders = ','.join('?' * len(rows))
+            snippets = dict(cursor.execute(f"""SELECT rowid, snippet(rss_feedData_fts, -1, '<b>', '</b>', '…', 16)
+                                                FROM rss_feedData_fts WHERE rss_feedData_fts MATCH ? AND rowid IN ({placeholders})""",
+                                            [match] + [row[2] for row in rows]))
+        return [{
+                    'id': row[1],
+                    'seq': row[2],
+                    'url': row[0],
+                    'data': serialize_item(row[3:8]),
+                    'snippet': snippets.get(row[2]),
+                    'rank': row[8],
+                    'cursor': f'{row[8]!r},{row[2]}',
+                } for row in rows], 200
+    except sqlite3.OperationalError as e:
+        traceback.print_exc()
+        return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
 
 
 def get_user_feed(user_id: int):
-    db_connection, cursor = get_db_cursor()
-    feeds = cursor.execute(f"""SELECT url
-                                FROM rss_feeds 
-                                WHERE user_id=?""",(user_id,))
-    if feeds is []:
-        return {"success": False, 'message': 'No items identified.'}, 404
-    return [{
-            'url': feed[0],
-        } for feed in feeds], 200
+    with storage.backend.cursor() as (db_connection, cursor):
+        feeds = storage.backend.iter_followed_feeds(user_id, cursor)
+        if feeds is []:
+            return {"success": False, 'message': 'No items identified.'}, 404
+        return [{
+                'url': feed[0],
+            } for feed in feeds], 200
 
 
 def insert_data_to_user(user_id: int, password: str) -> tuple:
@@ -168,11 +555,9 @@ def insert_data_to_user(user_id: int, password: str) -> tuple:
     Returns:
      - A tuple containing a dictionary with a success message and an HTTP status code.
 
-    The 'insert_data_to_user' method creates an SQL query to insert a new user into the 'user' table of the database.
-    It then executes the query using the 'get_db_cursor' helper method to establish a connection to the database and
-    create a cursor object. If the insertion is successful, the changes are committed and the connection and cursor
-    are closed. If there is a database connection error or any other exception is raised, the changes are rolled back,
-    and an error message is returned.
+    The 'insert_data_to_user' method inserts the new user through the storage backend (see storage.py), on a pooled
+    connection. If the insertion is successful, the changes are committed. If there is a database connection error or
+    any other exception is raised, the changes are rolled back, and an error message is returned.
 
     Example usage:
 
@@ -180,129 +565,110 @@ def insert_data_to_user(user_id: int, password: str) -> tuple:
     user_id = "ABC"
     password = "password"
 
-    The 'insert_data_to_user' method would generate and execute the following SQL query:
-    "INSERT INTO user(user_id, password) VALUES (?,?);" with the parameters ('ABC', 'password').
+    The 'insert_data_to_user' method would insert the row ('ABC', 'password') in the 'user' table, unless the user
+    exists already.
 
     If the insertion is successful, the method would return the following tuple:
     ({'success': True, 'message': 'User has been created!'}, 200)
     """
 
-    db_connection, cursor = get_db_cursor()
-    try:
-        check_data = cursor.execute("SELECT * FROM user WHERE user_id=?;", (user_id,))
-        if check_data.fetchone():
-            cursor.close()
-            return {"success": True, "message": "User exists!"}, 200
-        cursor.execute("INSERT INTO user(user_id, password) VALUES (?,?);", (user_id, password))
-        db_connection.commit()
-        cursor.close()
-        return {"success": True, "message": "User has been created!"}, 200
-    except sqlite3.OperationalError as e:
-        traceback.print_exc()
-        return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
-    except Exception as e:
-        traceback.print_exc()
-        db_connection.rollback()
-        return {"success": False, "message": "User not created!", "error": str(e)}, 500
-    finally:
-        cursor.close()
+    with storage.backend.writer() as (db_connection, cursor):
+        try:
+            if not storage.backend.insert_user(user_id, password, cursor):
+                return {"success": True, "message": "User exists!"}, 200
+            db_connection.commit()
+            return {"success": True, "message": "User has been created!"}, 200
+        except storage.backend.OperationalError as e:
+            traceback.print_exc()
+            return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
+        except Exception as e:
+            traceback.print_exc()
+            db_connection.rollback()
+            return {"success": False, "message": "User not created!", "error": str(e)}, 500
 
 
-def insert_data_to_feed_items_table(user_id: int, hash_key: str, feed_data: list, db_connection: sqlite3.Connection, cursor: sqlite3.Cursor) -> bool:
-    print(cursor)
+def insert_data_to_feed_items_table(user_id: int, hash_key: str, feed_items: tuple, db_connection: sqlite3.Connection, cursor: sqlite3.Cursor) -> int:
     """
-    This function inserts RSS feed items into the database for a given user and feed URL.
+    This function inserts RSS feed items into the database for a given user and feed URL, with one executemany per
+    statement. Items already stored for the feed are only rewritten if they changed. The caller is expected to commit.
     Args:
      - user_id: ID of the user for whom to insert data.
      - hash_key: Hashed key of the feed url
-     - feed_data: List of dictionaries containing feed item data after parsing.
-     - db_connection: SQLite3 database connection object.
+     - feed_items: The new and the changed items of the feed, as returned by diff_feed_items.
+     - db_connection: Database connection object of storage.backend.
      - cursor: Cursor object for executing SQL queries.
 
     Returns:
-     - bool: Returns True if the data is inserted successfully, False otherwise.
+     - int: The number of rows written.
     """
-    try:
-        check_data = cursor.execute("SELECT * FROM rss_feedData WHERE feed_id=?;", (hash_key,))
-        if check_data.fetchone():
-            return True
-        count = 0
-        for item in feed_data:
-            count += 1
-            cursor.execute("INSERT INTO rss_feedData (feed_id, feed_item_id, feed_item, marked) VALUES (?,?,?,?);", (hash_key, count, json.dumps(item), 0))
-            cursor.execute("INSERT INTO rss_marked_status (user_id, feed_item_id, is_read, feed_id, updated_date) VALUES (?,?,?,?,?);",(user_id, count, 0, hash_key, datetime.now().strftime(DATE_FORMAT)))
-        db_connection.commit()
-        if cursor.rowcount == 0:
-            return False
-        return True
-    except sqlite3.OperationalError:
-        traceback.print_exc()
-        return False
-    except Exception:
-        traceback.print_exc()
-        db_connection.rollback()
-        return False
-    finally:
-        cursor.close()
+    new_item_ids, updated_item_ids = write_feed_items(hash_key, *feed_items, cursor)
+    return len(new_item_ids) + len(updated_item_ids)
 
 
-def insert_data_to_feeds(user_id: int, url: str, hash_key: str, db_connection: sqlite3.Connection, cursor: sqlite3.Cursor) -> tuple:
-    """This function inserts feed data into the rss_feeds table for a given user.
+def insert_data_to_feeds(user_id: int, url: str, hash_key: str, db_connection: sqlite3.Connection, cursor: sqlite3.Cursor) -> bool:
+    """This function inserts feed data into the rss_feeds table for a given user. The caller is expected to commit.
 
     Args:
      - user_id: ID of the user for whom to insert data.
      - url: URL of the feed to which the data belongs.
      - hash_key: Hashed key of the feed URL.
-     - db_connection: SQLite3 database connection object.
+     - db_connection: Database connection object of storage.backend.
      - cursor: Cursor object for executing SQL queries.
 
     Returns:
-     - tuple: A tuple containing two boolean values indicating the success status of the operation and whether the data is a duplicate.
+     - bool: True if the row was inserted, False if the user already follows the feed.
     """
-    try:
-        check_data = cursor.execute("SELECT * FROM rss_feeds WHERE user_id=? AND feed_id=?", (user_id, hash_key))
-        if check_data.fetchone():
-            return False, True
-        cursor.execute("INSERT INTO rss_feeds(user_id, url, feed_id, updated_date) VALUES (?,?,?,?); ", (user_id, url, hash_key, datetime.now().strftime(DATE_FORMAT)))
-        db_connection.commit()
-        if cursor.rowcount == 0:
-            return False, False
-        return True, False
-    except sqlite3.OperationalError:
-        traceback.print_exc()
-        return False, False
-    except Exception:
-        print('here')
-        traceback.print_exc()
-        return False, False
+    return storage.backend.insert_follow(user_id, url, hash_key, cursor)
 
 
-def get_marked_items(user_id: int, url: str, marked: int, cursor: sqlite3.Cursor) -> list:
+def get_feed_validators(hash_key: str, cursor: sqlite3.Cursor) -> dict:
     """
-    Retrieves the IDs of the feed items that match the given criteria of being marked or unmarked for a specific user and URL.
+    Retrieves the HTTP validators stored for a feed on its previous fetch.
 
     Args:
-        user_id: The ID of the user whose feed items are being fetched.
-        url: The URL of the feed whose items are being fetched.
-        marked: An integer value indicating whether to fetch marked (1) or unmarked (0) feed items.
+        hash_key: Hashed key of the feed URL.
         cursor: The cursor object to execute SQL queries.
 
     Returns:
-        List: A list of IDs of the feed items matching the criteria, or None if no items were found.
-        """
-    feed_id_data = cursor.execute("SELECT feed_id FROM rss_feeds WHERE user_id=? AND url=?",(user_id, url))
-    if feed_id_data is []:
-        return []
-    feed_id = feed_id_data.fetchone()[0]
-    feed_item_data = cursor.execute("SELECT feed_item_id FROM rss_marked_status WHERE feed_id=? AND is_read=?",(feed_id, marked,))
-    if feed_item_data is []:
-        return []
-    return [feed[0] for feed in feed_item_data]
+        dict: The "etag", "last_modified" and "digest" of the previous fetch, or None if the feed was never fetched.
+    """
+    row = storage.backend.get_feed_validators(hash_key, cursor)
+    if not row:
+        return None
+    return {'etag': row[0], 'last_modified': row[1], 'digest': row[2]}
+
+
+def save_feed_validators(hash_key: str, validators: dict, cursor: sqlite3.Cursor) -> None:
+    """
+    Stores the HTTP validators of a fetch, to be sent as conditional headers on the next fetch of the feed. The caller
+    is expected to commit, so that the validators are saved in the same transaction as the feed items.
+
+    Args:
+        hash_key: Hashed key of the feed URL.
+        validators: dict with the "etag", "last_modified" and "digest" of the fetch.
+        cursor: The cursor object to execute SQL queries.
+    """
+    storage.backend.save_feed_validators(hash_key, validators, cursor)
+
+
+def get_read_state(user_id: int, hash_key: str, cursor: sqlite3.Cursor) -> tuple:
+    """
+    Retrieves the compact read state of a feed for a user.
+
+    Args:
+    - user_id: The ID of the user.
+    - hash_key: Hashed key of the feed URL.
+    - cursor: The cursor object to execute SQL queries.
+
+    Returns:
+    - tuple: The (read_hwm, bitmap_base, read_bitmap) of the feed, nothing read if the user never marked an item.
+    """
+    return storage.backend.get_read_state(user_id, hash_key, cursor)
 
 
 def mark_read(user_id: int, url: str, item_ids: list) -> tuple:
     """
-    Marks a list of item ids as read for the given user and URL.
+    Marks a list of item ids as read for the given user and URL, see mark_items.
 
     Args:
     - user_id: The ID of the user who marked the items as read.
@@ -312,55 +678,572 @@ def mark_read(user_id: int, url: str, item_ids: list) -> tuple:
     Returns:
     - A response based on the status of marked IDs
     """
-    db_connection, cursor = get_db_cursor()
+    return mark_items(user_id, [url], True, item_ids=item_ids)
+
+
+def mark_items(user_id: int, urls: list, is_read: bool = True, item_ids=None, up_to=None) -> tuple:
+    """
+    Marks feed items read or unread for a user in a single transaction, updating the compact read state of each feed
+    (see read_state.py) with one statement per form. Depending on the arguments, this marks:
+     - the listed item_ids of one feed,
+     - every item of one feed up to and including the item up_to, in the order they were stored,
+     - every item of all the feeds in urls, when neither item_ids nor up_to is given.
+
+    Args:
+    - user_id: The ID of the user marking the items.
+    - urls: The URLs of the RSS feeds, a single one when item_ids or up_to is given.
+    - is_read: True to mark the items read, False to mark them unread.
+    - item_ids (optional): A list of item IDs to be marked.
+    - up_to (optional): The item ID up to which items are marked.
+
+    Returns:
+    - A response based on the status of marked IDs, "marked" holding the number of items whose status changed.
+    """
+    if (item_ids or up_to) and len(urls) != 1:
+        return {"success": False, "message": "itemId and upTo apply to a single feedUrl!"}, 400
+    message = f"Items marked {'read' if is_read else 'unread'}."
+    with storage.backend.writer() as (db_connection, cursor):
+        try:
+            feed_ids = storage.backend.get_user_feed_ids(user_id, cursor, urls, lock=True)
+            if not feed_ids or len(feed_ids) != len(set(urls)):
+                return {"success": False, "message": "No data found for the combination!"}, 404
+            if item_ids or up_to:
+                feed_id = feed_ids[0]
+                read = read_state.decode(*get_read_state(user_id, feed_id, cursor))
+                if item_ids:
+                    new_read = read_state.mark(read, storage.backend.get_item_nos(feed_id, item_ids, cursor), is_read)
+                else:
+                    item_no = storage.backend.get_item_nos(feed_id, [up_to], cursor)
+                    new_read = read_state.mark_up_to(read, item_no[0], is_read) if item_no else read
+                marked = bin(read ^ new_read).count('1')
+                storage.backend.save_read_state(user_id, feed_id, read_state.encode(new_read), cursor)
+            else:
+                marked = storage.backend.count_items(user_id, feed_ids, not is_read, cursor)
+                storage.backend.mark_feeds(user_id, feed_ids, is_read, cursor)
+            db_connection.commit()
+            response_cache.cache.invalidate_user(user_id, feed_ids)
+            return {'success': True, 'message': message, 'marked': marked}, 200
+
+        except storage.backend.OperationalError as e:
+            traceback.print_exc()
+            return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
+        except Exception as e:
+            traceback.print_exc()
+            db_connection.rollback()
+            return {"success": False, 'message': 'Error in updating record', "error": str(e)}, 500
+
+
+@actor
+def force_feed_update(hash_key: str) -> tuple:
+    """
+    Forces an RSS feed update for all users following the feed, see refresh_feed.
+    Args:
+     - hash_key: Hashed key of the feed URL.
+    Returns:
+     - A response based on the status of forced update
+    """
     try:
-        feed_id_data = cursor.execute("SELECT feed_id FROM rss_feeds WHERE user_id=? AND url=?",(user_id, url))
-        if feed_id_data is []:
-            return {"success": False, "message": "No data found for the combination!"}, 404
-        feed_id = feed_id_data.fetchone()[0]
-        for item_id in item_ids:
-            cursor.execute("""UPDATE rss_marked_status 
-                              SET is_read=1, updated_date=? 
-                              WHERE feed_id=? AND feed_item_id=? AND user_id=?""", (datetime.now().strftime(DATE_FORMAT), feed_id, item_id, user_id))
+        return refresh_feed(hash_key)
+    finally:
+        finish_refresh_job(hash_key)
+
+
+def reserve_refresh_job(user_id: int, url: str, task_id: str) -> tuple:
+    """
+    Registers a refresh job for a feed followed by the user before it is queued, unless one is already queued or running
+    for the feed, in which case the request is absorbed by it. A job that has not finished after "refresh_job_timeout"
+    seconds is taken as lost and replaced. Feeds fetched less than "refresh_min_interval" seconds ago are not refreshed
+    again.
+    Args:
+     - user_id: ID of the user requesting the refresh.
+     - url: URL of the feed.
+     - task_id: The id of the message to queue for the job.
+    Returns:
+     - A tuple of the response and its status. On success, "task_id" is the id of the job to wait for and "deduplicated"
+       tells whether it is an existing one, in which case nothing should be queued. 429 with "retry_after" if the feed
+       was fetched too recently, 404 if the user does not follow it.
+    """
+    now = int(time.time())
+    hash_key = builder.generate_hash(url)
+    try:
+        with storage.backend.cursor() as (db_connection, cursor):
+            if hash_key not in storage.backend.get_user_feed_ids(user_id, cursor, [url]):
+                return {"success": False, "message": "Feed is not followed by the user!"}, 404
+            validators = storage.backend.get_feed_validators(hash_key, cursor)
+    except storage.backend.OperationalError as e:
+        traceback.print_exc()
+        return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
+    # Refresh jobs are kept in the SQLite database of db_pool whatever the storage backend, see storage.py.
+    with db_pool.writer() as (db_connection, cursor):
+        try:
+            job = cursor.execute("SELECT task_id, enqueued_date FROM rss_refresh_jobs WHERE feed_id=?", (hash_key,)).fetchone()
+            if job and job[1] > now - config.config['refresh_job_timeout']:
+                return {"success": True, "task_id": job[0], "deduplicated": True}, 200
+            retry_after = validators[3] + config.config['refresh_min_interval'] - now if validators else 0
+            if retry_after > 0:
+                return {"success": False, "message": "Feed was updated recently.", "retry_after": retry_after}, 429
+            cursor.execute("""INSERT INTO rss_refresh_jobs (feed_id, task_id, enqueued_date) VALUES (?,?,?)
+                              ON CONFLICT(feed_id) DO UPDATE SET task_id=excluded.task_id, enqueued_date=excluded.enqueued_date""",
+                           (hash_key, task_id, now))
+            db_connection.commit()
+            return {"success": True, "task_id": task_id, "deduplicated": False}, 200
+        except sqlite3.OperationalError as e:
+            traceback.print_exc()
+            return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
+
+
+def get_job_stats() -> dict:
+    """
+    Returns the number of refresh jobs and OPML imports queued or running, and how long ago the oldest of each was
+    queued, in seconds.
+    """
+    now = int(time.time())
+    with db_pool.cursor() as (db_connection, cursor):
+        refresh = cursor.execute("SELECT COUNT(*), MIN(enqueued_date) FROM rss_refresh_jobs").fetchone()
+        imports = cursor.execute("""SELECT COUNT(*), MIN(created_date) FROM rss_import_jobs
+                                    WHERE status IN ('queued', 'running')""").fetchone()
+    return {
+        'refresh': (refresh[0], now - refresh[1] if refresh[1] else 0),
+        'import': (imports[0], now - imports[1] if imports[1] else 0),
+    }
+
+
+def finish_refresh_job(hash_key: str) -> None:
+    """
+    Removes the refresh job of a feed once it is done, or failed for good, so that the next request queues a new one.
+    Args:
+     - hash_key: Hashed key of the feed URL.
+    """
+    with db_pool.writer() as (db_connection, cursor):
+        cursor.execute("DELETE FROM rss_refresh_jobs WHERE feed_id=?", (hash_key,))
         db_connection.commit()
-        return {'success': True, 'message': 'Item ids marked read.'}, 200
 
-    except sqlite3.OperationalError as e:
+
+def refresh_feed(hash_key: str) -> tuple:
+    """
+    Fetches and parses a feed once, and stores the new items for every user following it at the same time. The feed is
+    fetched conditionally, so nothing is parsed or written when it has not changed since the previous fetch, and is
+    streamed, see fetch_feed_items.
+    Args:
+     - hash_key: Hashed key of the feed URL.
+    Returns:
+     - A response based on the status of the refresh. On success, "new_items" and "updated_items" hold the number of
+       items added and changed.
+    """
+    try:
+        with storage.backend.cursor() as (db_connection, cursor):
+            url = storage.backend.get_feed_url(hash_key, cursor)
+            if not url:
+                return {"success": False, "message": "Feed is not followed by any user!"}, 404
+            validators = get_feed_validators(hash_key, cursor)
+        feed_items, validators = fetch_feed_items(url, validators)
+        if feed_items is None:
+            return {"success": True, "message": "Feed not modified.", "new_items": 0, "updated_items": 0}, 200
+    except storage.backend.OperationalError as e:
         traceback.print_exc()
         return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
-    except Exception as e:
+    except OSError as e:
+        logging.warning("Could not fetch feed %s: %s", hash_key, e)
+        return {"success": False, "message": "Feed could not be fetched!", "error": str(e)}, 502
+    return store_feed_items(hash_key, feed_items, validators)
+
+
+def refresh_feeds(hash_keys: list, **fetch_options) -> dict:
+    """
+    Refreshes a batch of feeds, like refresh_feed. The feeds are downloaded concurrently with fetcher.AsyncFeedFetcher,
+    within its global and per-host limits, so that a slow feed does not hold up the others, and each is written in its
+    own transaction as soon as it is downloaded. Each call runs an event loop and a fetcher of its own, see
+    refresh_feed_batch to reuse them across batches.
+    Args:
+     - hash_keys: Hashed keys of the feed URLs.
+     - fetch_options: Options of fetcher.AsyncFeedFetcher.
+    Returns:
+     - dict: The response of refresh_feed of each feed, keyed by hash key.
+    """
+    async def run():
+        async with fetcher.AsyncFeedFetcher(**fetch_options) as feed_fetcher:
+            return await refresh_feed_batch(hash_keys, feed_fetcher)
+    return asyncio.run(run())
+
+
+async def refresh_feed_batch(hash_keys: list, feed_fetcher) -> dict:
+    """
+    Refreshes a batch of feeds with a fetcher that may outlive it, see refresh_feeds. Feeds are read and written on
+    other threads, so that downloads go on meanwhile.
+    Args:
+     - hash_keys: Hashed keys of the feed URLs.
+     - feed_fetcher: The fetcher.AsyncFeedFetcher to download the feeds with.
+    Returns:
+     - dict: The response of refresh_feed of each feed, keyed by hash key.
+    """
+    try:
+        urls, validators = await asyncio.to_thread(get_refresh_validators, hash_keys)
+    except storage.backend.OperationalError as e:
         traceback.print_exc()
-        db_connection.rollback()
-        return {"success": False, 'message': 'Error in updating record', "error": str(e)}, 500
-    finally:
-        cursor.close()
+        return {hash_key: ({"success": False, "message": "Database connection error!", "error": str(e)}, 500)
+                for hash_key in hash_keys}
+    responses = {hash_key: ({"success": False, "message": "Feed is not followed by any user!"}, 404)
+                 for hash_key, url in urls.items() if not url}
+    async for hash_key, feed_data in feed_fetcher.fetch_many(list(validators), validators):
+        # Popped, so that a long-lived fetcher does not accumulate the validators and errors of every batch.
+        responses[hash_key] = await asyncio.to_thread(store_refreshed_feed, hash_key, feed_data,
+                                                      feed_fetcher.validators.pop(hash_key))
+    for hash_key in urls:
+        error = feed_fetcher.errors.pop(hash_key, None)
+        if error is not None:
+            responses[hash_key] = {"success": False, "message": "Feed could not be fetched!", "error": str(error)}, 502
+    return responses
 
 
-@actor
-def force_feed_update(user_id: int, url: str) -> tuple:
+def get_refresh_validators(hash_keys: list) -> tuple:
     """
-    Forces an RSS feed update for a given user and URL by updating the 'updated_date' column in the rss_feeds table
-    to the current date and time.
+    Returns the URL of each feed of refresh_feed_batch, None for feeds nobody follows, and the validators of the
+    followed ones keyed by URL.
+    """
+    with storage.backend.cursor() as (db_connection, cursor):
+        urls = {hash_key: storage.backend.get_feed_url(hash_key, cursor) for hash_key in dict.fromkeys(hash_keys)}
+        validators = {url: get_feed_validators(hash_key, cursor) for hash_key, url in urls.items() if url}
+    return urls, validators
+
+
+def store_refreshed_feed(hash_key: str, feed_data, validators: dict) -> tuple:
+    """
+    Diffs the parsed entries of a feed fetched by refresh_feed_batch against its stored items, and stores the result.
     Args:
-     - user_id: The ID of the user who owns the RSS feed.
-     - url: The URL of the RSS feed to be updated.
+     - hash_key: Hashed key of the feed URL.
+     - feed_data: The parsed entries of the feed, or None if it has not changed since its last fetch.
+     - validators: The validators of the fetch.
     Returns:
-     - A response based on the status of forced update
+     - A response like refresh_feed.
     """
-    db_connection, cursor = get_db_cursor()
+    if feed_data is None:
+        return {"success": True, "message": "Feed not modified.", "new_items": 0, "updated_items": 0}, 200
     try:
-        cursor.execute("UPDATE rss_feeds SET updated_date = ? where user_id=? AND url=?", (datetime.now().strftime(DATE_FORMAT), user_id, url))
-        db_connection.commit()
-        return {"success": True, "message": "Update successful!"}, 200
-    except sqlite3.OperationalError as e:
+        db_connection, cursor = get_db_cursor()
+        try:
+            feed_items = diff_feed_items(hash_key, itertools.islice(feed_data, config.config['feed_max_entries']), cursor)
+        finally:
+            cursor.close()
+            db_connection.close()
+    except storage.backend.OperationalError as e:
         traceback.print_exc()
         return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
-    except Exception as e:
-        traceback.print_exc()
-        db_connection.rollback()
-        return {"success": False, "message": "Error in force update", "error": str(e)}, 500
+    return store_feed_items(hash_key, feed_items, validators)
+
+
+def store_feed_items(hash_key: str, feed_items: tuple, validators: dict) -> tuple:
+    """
+    Writes the result of diff_feed_items for a refreshed feed along with its validators, in one transaction, and
+    notifies the followers of new items.
+    Args:
+     - hash_key: Hashed key of the feed URL.
+     - feed_items: The new and changed items, as returned by diff_feed_items.
+     - validators: The validators of the fetch.
+    Returns:
+     - A response like refresh_feed.
+    """
+    with storage.backend.writer() as (db_connection, cursor):
+        try:
+            new_item_ids, updated_item_ids = write_feed_items(hash_key, *feed_items, cursor)
+            if new_item_ids or updated_item_ids:
+                storage.backend.touch_feed(hash_key, cursor)
+            save_feed_validators(hash_key, validators, cursor)
+            db_connection.commit()
+            if new_item_ids or updated_item_ids:
+                response_cache.cache.invalidate_feed(hash_key)
+            if new_item_ids:
+                notifier.notifier.publish(hash_key)
+            return {"success": True, "message": "Update successful!", "new_items": len(new_item_ids),
+                    "updated_items": len(updated_item_ids)}, 200
+        except storage.backend.OperationalError as e:
+            traceback.print_exc()
+            return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
+        except Exception as e:
+            traceback.print_exc()
+            db_connection.rollback()
+            return {"success": False, "message": "Error in force update", "error": str(e)}, 500
+
+
+def fetch_feed_items(url: str, validators=None) -> tuple:
+    """
+    Conditionally fetches a feed with builder.stream_rss_feeder, within the "feed_max_bytes" and "feed_max_entries"
+    limits, and diffs its entries against the stored items while they are downloaded and parsed (see diff_feed_items),
+    so that only the new and changed items are held in memory. Nothing is written, and no write lock is needed.
+    Args:
+     - url: URL of the RSS feed.
+     - validators: The validators stored for the feed, see get_feed_validators.
+    Returns:
+     - tuple: The result of diff_feed_items, or None if the feed has not changed, and the validators to store.
+    Raises:
+     - OSError if the feed could not be downloaded.
+    """
+    hash_key, entries, validators = builder.stream_rss_feeder(url, validators, config.config['feed_max_bytes'],
+                                                              config.config['feed_max_entries'])
+    if entries is None:
+        return None, validators
+    # A dedicated connection, so that a slow download does not hold one of the pool.
+    db_connection, cursor = get_db_cursor()
+    try:
+        return diff_feed_items(hash_key, entries, cursor), validators
     finally:
         cursor.close()
+        db_connection.close()
+
+
+def refresh_all_feeds() -> dict:
+    """
+    Refreshes every followed feed once, regardless of how many users follow it.
+    Returns:
+     - A dict mapping the hash key of each feed to the response of refresh_feed.
+    """
+    return {hash_key: refresh_feed(hash_key) for hash_key in get_followed_feed_ids()}
+
+
+def get_followed_feed_ids() -> list:
+    """
+    Returns the hash keys of all feeds followed by at least one user.
+    """
+    with storage.backend.cursor() as (db_connection, cursor):
+        return storage.backend.get_followed_feed_ids(cursor)
+
+
+def get_stored_feed_ids() -> list:
+    """
+    Returns the hash keys of all feeds with stored items, followed or not.
+    """
+    with db_pool.cursor() as (db_connection, cursor):
+        return [row[0] for row in cursor.execute("SELECT DISTINCT feed_id FROM rss_feedData")]
+
+
+def expired_items_predicate(keep_unread: bool) -> str:
+    """
+    Returns the condition matching the items of rss_feedData that the retention policy removes, with the parameters
+    feed_id, the highest item_no of the feed, the last item_no to remove for "retention_max_items" and the published
+    epoch before which items are removed for "retention_max_age_days". Items still unread by any follower of the feed
+    are kept if keep_unread. The item with the highest item_no is always kept: new items are numbered after it, and
+    numbers at or below the read high-water mark of a follower would show as read.
+    """
+    predicate = """rss_feedData.feed_id=? AND rss_feedData.item_no<?
+                   AND (rss_feedData.item_no<=? OR (rss_feedData.published>0 AND rss_feedData.published<?))"""
+    if keep_unread:
+        predicate += f""" AND NOT EXISTS (SELECT 1 FROM rss_feeds LEFT JOIN rss_read_state
+                          ON rss_read_state.user_id=rss_feeds.user_id AND rss_read_state.feed_id=rss_feeds.feed_id
+                          WHERE rss_feeds.feed_id=rss_feedData.feed_id AND {READ_PREDICATE[0]})"""
+    return predicate
+
+
+def retention_parameters(hash_key: str, cursor: sqlite3.Cursor) -> tuple:
+    """
+    Returns the parameters of expired_items_predicate for a feed, from the retention policy of config.yaml. A limit of
+    0 disables it.
+    """
+    max_items = config.config['retention_max_items']
+    max_age_days = config.config['retention_max_age_days']
+    max_item_no = cursor.execute("SELECT COALESCE(MAX(item_no), 0) FROM rss_feedData WHERE feed_id=?",
+                                 (hash_key,)).fetchone()[0]
+    last_item_no = max_item_no - max_items if max_items else 0
+    cutoff = int(time.time()) - max_age_days * 86400 if max_age_days else 0
+    return hash_key, max_item_no, last_item_no, cutoff
+
+
+def get_expired_items(hash_key: str, limit: int) -> list:
+    """
+    Returns the oldest items of a feed that the retention policy removes, see expired_items_predicate.
+    Args:
+     - hash_key: Hashed key of the feed URL.
+     - limit: Maximum number of items to return.
+    Returns:
+     - list: The items as dicts of their "feed_id", "id", "seq", "item_no" and ITEM_COLUMNS, to be archived.
+    """
+    with db_pool.cursor() as (db_connection, cursor):
+        parameters = retention_parameters(hash_key, cursor)
+        rows = cursor.execute(f"""SELECT feed_item_id, item_seq, item_no, {', '.join(ITEM_COLUMNS)} FROM rss_feedData
+                                  WHERE {expired_items_predicate(config.config['retention_keep_unread'])}
+                                  ORDER BY item_seq LIMIT ?""", parameters + (limit,)).fetchall()
+    return [dict(zip(('id', 'seq', 'item_no') + ITEM_COLUMNS, row), feed_id=hash_key) for row in rows]
+
+
+def delete_expired_items(hash_key: str, items: list, segment=None) -> int:
+    """
+    Deletes archived items of a feed, and records the segment they were archived to. The retention policy is checked
+    again under the write lock, so that an item marked unread since it was archived is kept; it then stays in the
+    archive as well.
+    Args:
+     - hash_key: Hashed key of the feed URL.
+     - items: Items returned by get_expired_items.
+     - segment (optional): The archive segment the items were written to.
+    Returns:
+     - int: The number of items deleted.
+    """
+    with db_pool.writer() as (db_connection, cursor):
+        try:
+            parameters = retention_parameters(hash_key, cursor)
+            seqs = [item['seq'] for item in items]
+            cursor.execute(f"""DELETE FROM rss_feedData WHERE item_seq IN ({', '.join('?' * len(seqs))})
+                               AND {expired_items_predicate(config.config['retention_keep_unread'])}""",
+                           seqs + list(parameters))
+            deleted = cursor.rowcount
+            if segment:
+                cursor.execute("""INSERT INTO rss_archive_segments (segment, feed_id, items, min_seq, max_seq)
+                                  VALUES (?,?,?,?,?)
+                                  ON CONFLICT(feed_id, segment) DO UPDATE SET items=items+excluded.items,
+                                  min_seq=MIN(min_seq, excluded.min_seq), max_seq=MAX(max_seq, excluded.max_seq)""",
+                               (segment, hash_key, len(items), min(seqs), max(seqs)))
+            db_connection.commit()
+        except Exception:
+            db_connection.rollback()
+            raise
+    if deleted:
+        response_cache.cache.invalidate_feed(hash_key)
+    return deleted
+
+
+def incremental_vacuum(pages: int) -> int:
+    """
+    Returns up to pages free pages of the database file to the file system, holding the write lock for that time only.
+    Does nothing unless the database is in auto_vacuum=INCREMENTAL mode, see compaction.py.
+    Returns:
+     - int: The number of free pages left.
+    """
+    with db_pool.writer() as (db_connection, cursor):
+        cursor.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def get_archived_items(user_id: int, url: str, limit: int, after=None) -> tuple:
+    """
+    Reads the archived items of a feed followed by a user, newest first, from the archive segments holding items of the
+    feed. Items archived more than once (see delete_expired_items) are listed once, and items that are still stored
+    are left out.
+    Args:
+     - user_id: ID of the user.
+     - url: URL of the feed.
+     - limit: Maximum number of items to return.
+     - after (optional): The "seq" of the last item of the previous page.
+    Returns:
+     - A tuple of the items, with the keys "id", "seq", "url" and "data" like get_feeds, and the HTTP status code.
+    """
+    hash_key = builder.generate_hash(url)
+    with storage.backend.cursor() as (db_connection, cursor):
+        if hash_key not in storage.backend.get_user_feed_ids(user_id, cursor, [url]):
+            return {"success": False, "message": "Feed is not followed by the user!"}, 404
+    with db_pool.cursor() as (db_connection, cursor):
+        query = "SELECT segment, max_seq FROM rss_archive_segments WHERE feed_id=?"
+        parameters = [hash_key]
+        if after is not None:
+            query += " AND min_seq<?"
+            parameters.append(after)
+        segments = cursor.execute(query + " ORDER BY max_seq DESC", parameters).fetchall()
+    store = archive.Archive(config.config['archive_path'])
+    items = {}
+    for segment, max_seq in segments:
+        # Once a page of items newer than anything in the remaining segments is read, they cannot add to the page.
+        if len(items) >= limit and max_seq < sorted(items, reverse=True)[limit - 1]:
+            break
+        for item in store.read(segment, hash_key):
+            if after is None or item['seq'] < after:
+                items[item['seq']] = item
+    if items:
+        with db_pool.cursor() as (db_connection, cursor):
+            seqs = list(items)
+            for offset in range(0, len(seqs), DIFF_BATCH_SIZE):
+                batch = seqs[offset:offset + DIFF_BATCH_SIZE]
+                for row in cursor.execute(f"SELECT item_seq FROM rss_feedData WHERE item_seq IN ({', '.join('?' * len(batch))})", batch):
+                    del items[row[0]]
+    page = sorted(items.values(), key=lambda item: item['seq'], reverse=True)[:limit]
+    return [{'id': item['id'], 'seq': item['seq'], 'url': url,
+             'data': serialize_item(tuple(item[column] for column in ITEM_COLUMNS))} for item in page], 200
+
+
+def is_feed_followed(hash_key: str, cursor: sqlite3.Cursor) -> bool:
+    """
+    Checks whether any user already follows a feed, in which case its items are already stored.
+    Args:
+     - hash_key: Hashed key of the feed URL.
+     - cursor: Cursor object for executing SQL queries.
+    Returns:
+     - bool: True if the feed has at least one follower.
+    """
+    return storage.backend.is_feed_followed(hash_key, cursor)
+
+
+def upsert_feed_items(hash_key: str, feed_data, cursor: sqlite3.Cursor) -> tuple:
+    """
+    Diffs a freshly parsed feed against the stored items and writes only the new and the changed items, see
+    diff_feed_items and write_feed_items. The caller is expected to commit.
+    Args:
+     - hash_key: Hashed key of the feed url
+     - feed_data: Iterable of dictionaries containing feed item data after parsing.
+     - cursor: Cursor object for executing SQL queries.
+    Returns:
+     - tuple: The feed_item_ids of the inserted items and the feed_item_ids of the updated items.
+    """
+    new_items, updated_items = diff_feed_items(hash_key, feed_data, cursor)
+    return write_feed_items(hash_key, new_items, updated_items, cursor)
+
+
+def diff_feed_items(hash_key: str, feed_data, cursor: sqlite3.Cursor) -> tuple:
+    """
+    Compares parsed items, identified by builder.generate_item_id, against the stored items of the feed. The items are
+    consumed in batches of DIFF_BATCH_SIZE and looked up by id, so neither the feed nor the stored items are held in
+    memory as a whole, and feed_data may be a generator such as the entries of builder.stream_rss_feeder. Feeds list
+    their newest items first: once "feed_known_streak" items in a row are stored unchanged, the rest of the feed is
+    taken as known and feed_data is closed, which also stops its download.
+    Args:
+     - hash_key: Hashed key of the feed url
+     - feed_data: Iterable of dictionaries containing feed item data after parsing.
+     - cursor: Cursor object for executing SQL queries, only read from.
+    Returns:
+     - tuple: The new items and the changed items, in feed order, as lists of (feed_item_id, columns, raw_entry) tuples
+       to be written with write_feed_items.
+    """
+    known_streak = config.config['feed_known_streak']
+    store_raw = config.config['store_raw_entries']
+    new_items, updated_items = [], []
+    seen_item_ids = set()
+    streak = 0
+    entries = iter(feed_data)
+    try:
+        while streak < known_streak:
+            batch = [(builder.generate_item_id(item), item) for item in itertools.islice(entries, DIFF_BATCH_SIZE)]
+            if not batch:
+                break
+            stored_items = storage.backend.get_stored_items(hash_key, [item_id for item_id, _ in batch], cursor)
+            for item_id, item in batch:
+                if item_id in seen_item_ids:
+                    continue
+                seen_item_ids.add(item_id)
+                columns = item_columns(item)
+                if item_id in stored_items and stored_items[item_id] == columns:
+                    streak += 1
+                    if streak >= known_streak:
+                        break
+                    continue
+                streak = 0
+                raw_entry = zlib.compress(json.dumps(item).encode('UTF-8')) if store_raw else None
+                (updated_items if item_id in stored_items else new_items).append((item_id, columns, raw_entry))
+    finally:
+        close = getattr(entries, 'close', None)
+        if close:
+            close()
+    return new_items, updated_items
+
+
+def write_feed_items(hash_key: str, new_items: list, updated_items: list, cursor: sqlite3.Cursor) -> tuple:
+    """
+    Writes the result of diff_feed_items. New items are numbered after the last stored item_no of the feed, which the
+    storage backend reads under its write lock. The caller is expected to commit.
+    Args:
+     - hash_key: Hashed key of the feed url
+     - new_items: New items, as returned by diff_feed_items.
+     - updated_items: Changed items, as returned by diff_feed_items.
+     - cursor: Cursor object for executing SQL queries.
+    Returns:
+     - tuple: The feed_item_ids of the inserted items and the feed_item_ids of the updated items.
+    """
+    # Feeds list their newest items first, insert them last so that they get the highest item_seq and item_no.
+    storage.backend.write_items(hash_key, list(reversed(new_items)), updated_items, cursor)
+    return [item[0] for item in new_items], [item[0] for item in updated_items]
 
 
 def token_validator(user_id: int, password: str) -> tuple:
@@ -379,30 +1262,50 @@ def token_validator(user_id: int, password: str) -> tuple:
     - If successful, HTTP status code 200.
     - If unsuccessful due to incorrect password, HTTP status code 401.
     - If unsuccessful due to user not existing, HTTP status code 404.
+    - If too many passwords are being hashed already, HTTP status code 503.
     - If there is an error in the function, HTTP status code 500.
 
     """
-    select_query = "SELECT * FROM user WHERE user_id = ?;"
-    db_connection, cursor = get_db_cursor()
+    hasher = password_hasher.get_hasher()
     try:
-        check_data = cursor.execute(select_query, (user_id,))
-        if check_data is []:
+        # The connection goes back to the pool before the hash is checked, logins queued for a hashing worker hold none.
+        with storage.backend.cursor() as (db_connection, cursor):
+            password_hash = storage.backend.get_user_password(user_id, cursor)
+        if password_hash is None:
             return {"success": False, "message": "User does not exist!"}, 404
-        user_data = check_data.fetchone()
-        if check_password_hash(user_data[1], password):
+        if hasher.check(password_hash, password):
+                if hasher.needs_rehash(password_hash):
+                    rehash_password(user_id, password)
                 token = jwt.encode(
                                     {
-                                        'user_id': user_data[0],
+                                        'user_id': user_id,
                                         'exp' : datetime.utcnow() + timedelta(minutes = 60)
                                     }, config.config['secret_key'])
                 return {"success": True, "message": "Login successful!", "token":token}, 200
         else:
             return {"success":False, "message": "Invalid password for the user ID."}, 401
-    except sqlite3.OperationalError as e:
+    except password_hasher.HasherBusy:
+        return {"success": False, "message": "Server busy, try again later."}, 503
+    except storage.backend.OperationalError as e:
         traceback.print_exc()
         return {"success": False, "message": "Database connection error!", "error": str(e)}, 500
     except Exception as e:
         traceback.print_exc()
         return {"success":False, "message": "Error in token validation", "error": str(e)}, 500
-    finally:
-        cursor.close()
+
+
+def rehash_password(user_id: int, password: str) -> None:
+    """
+    Stores the password of a user hashed with the configured method, after a successful login with a hash made with a
+    different method or cost. Failures are logged only, the login itself already succeeded.
+    Args:
+     - user_id: ID of the user
+     - password: Password provided by the user, already verified
+    """
+    try:
+        password_hash = password_hasher.get_hasher().hash(password)
+        with storage.backend.writer() as (db_connection, cursor):
+            storage.backend.update_user_password(user_id, password_hash, cursor)
+            db_connection.commit()
+    except (password_hasher.HasherBusy, storage.backend.OperationalError) as e:
+        logging.warning("Could not rehash the password of user %s: %s", user_id, e)
@@ -0,0 +1,320 @@
+"""
+Asynchronous feed fetcher, used to refresh many feeds concurrently.
+
+Feeds are downloaded on an asyncio event loop with a global concurrency cap and a per-host concurrency cap. Connections
+are kept alive and reused per host, and every request is bounded by a timeout. Parsing is CPU bound, so it runs in a
+process pool to keep the event loop responsive.
+
+Example usage:
+
+async with AsyncFeedFetcher() as fetcher:
+    async for hash_key, feed_data in fetcher.fetch_many(urls):
+        ...
+"""
+import asyncio
+import contextlib
+import logging
+import ssl
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urljoin, urlsplit
+import builder
+import config
+
+
+MAX_REDIRECTS = 5
+# Errors of a single feed, left out of a batch: network and HTTP errors, a server closing the connection mid-response
+# (IncompleteReadError), overlong header or chunk-size lines (LimitOverrunError), invalid URLs and compressed bodies.
+FETCH_ERRORS = (OSError, ValueError, EOFError, asyncio.LimitOverrunError, zlib.error)
+
+
+class FetchError(OSError):
+    """Raised when a feed cannot be downloaded or parsed."""
+
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive connections per (scheme, host, port) and limits the number of concurrent connections per host.
+    """
+
+    def __init__(self, per_host_limit: int):
+        self.per_host_limit = per_host_limit
+        self._idle = {}
+        self._host_slots = {}
+        self._ssl_context = ssl.create_default_context()
+
+    def host_slot(self, key: tuple) -> asyncio.Semaphore:
+        if key not in self._host_slots:
+            self._host_slots[key] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_slots[key]
+
+    async def acquire(self, key: tuple) -> tuple:
+        """
+        Returns a (reader, writer, reused) tuple for the host, reusing an idle connection when one is available.
+        """
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(host, port, ssl=self._ssl_context if scheme == 'https' else None)
+        return reader, writer, False
+
+    def release(self, key: tuple, reader, writer, reusable: bool) -> None:
+        if reusable and not reader.at_eof():
+            self._idle.setdefault(key, []).append((reader, writer))
+        else:
+            writer.close()
+
+    async def close(self) -> None:
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncFeedFetcher:
+    """
+    Fetches and parses feeds concurrently.
+    Args:
+     - max_concurrency: Maximum number of requests in flight in total.
+     - per_host_limit: Maximum number of requests in flight per host, which is also the number of connections kept per host.
+     - timeout: Seconds allowed for a single request, including redirects, from the moment it got its slots.
+     - parse_workers: Number of processes used to parse feeds. 0 parses on the event loop thread.
+     - max_bytes: Maximum number of bytes read from a feed, both as sent and once decompressed, "feed_max_bytes" by
+       default. The rest is ignored.
+    """
+
+    def __init__(self, max_concurrency=None, per_host_limit=None, timeout=None, parse_workers=None, max_bytes=None):
+        self.max_concurrency = max_concurrency or config.config['fetch_max_concurrency']
+        self.timeout = timeout or config.config['fetch_timeout']
+        self.max_bytes = max_bytes or config.config['feed_max_bytes']
+        self.pool = ConnectionPool(per_host_limit or config.config['fetch_per_host_limit'])
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._parse_pool = ProcessPoolExecutor(parse_workers) if parse_workers != 0 else None
+        self.validators = {}
+        self.errors = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self) -> None:
+        await self.pool.close()
+        if self._parse_pool:
+            self._parse_pool.shutdown()
+
+    async def fetch(self, feed_url: str, validators=None) -> tuple:
+        """
+        Conditionally fetches and parses a single feed, like builder.conditional_rss_feeder.
+        Returns:
+         - A tuple of the hash-key of the URL, the parsed feed data (None if unchanged) and the validators to store.
+        """
+        validators = validators or {}
+        headers = builder.conditional_headers(validators.get('etag'), validators.get('last_modified'))
+        key = connection_key(feed_url)
+        # The host slot is taken first, so that requests queued behind others to the same host neither hold a global
+        # slot nor spend their timeout waiting.
+        async with self.pool.host_slot(key), self._slots:
+            try:
+                with builder.FETCH_SECONDS.time('async'):
+                    status, response_headers, body = await asyncio.wait_for(self._get(feed_url, headers, key),
+                                                                            self.timeout)
+            except asyncio.TimeoutError:
+                raise FetchError(f"Timed out fetching {feed_url}")
+        hash_key = builder.generate_hash(feed_url)
+        if status == 304:
+            return hash_key, None, {
+                'etag': response_headers.get('etag') or validators.get('etag'),
+                'last_modified': response_headers.get('last-modified') or validators.get('last_modified'),
+                'digest': validators.get('digest'),
+            }
+        if status >= 400:
+            raise FetchError(f"HTTP {status} fetching {feed_url}")
+        new_validators = {
+            'etag': response_headers.get('etag'),
+            'last_modified': response_headers.get('last-modified'),
+            'digest': builder.content_digest(body),
+        }
+        if new_validators['digest'] == validators.get('digest'):
+            return hash_key, None, new_validators
+        try:
+            if self._parse_pool:
+                # Timed here, the parsing processes have metrics of their own that are not collected.
+                started = time.perf_counter()
+                feed_data = await asyncio.get_running_loop().run_in_executor(self._parse_pool, builder.parse_feed, body)
+                builder.PARSE_SECONDS.observe(time.perf_counter() - started, 'process_pool')
+            else:
+                feed_data = builder.parse_feed(body)
+        except Exception as e:
+            raise FetchError(f"Could not parse {feed_url}: {e!r}") from e
+        return hash_key, feed_data, new_validators
+
+    async def fetch_many(self, feed_urls, validators=None):
+        """
+        Fetches a batch of feeds concurrently and yields (hash_key, feed_data) tuples as they complete. feed_data is None
+        for feeds that have not changed. The validators of each fetch are kept in self.validators and feeds that could
+        not be fetched are left out and recorded in self.errors, both keyed by hash-key.
+        Args:
+         - feed_urls: The URLs to fetch.
+         - validators: Optional dict mapping a URL to the validators of its previous fetch.
+        """
+        validators = validators or {}
+
+        async def fetch_one(feed_url):
+            try:
+                return await self.fetch(feed_url, validators.get(feed_url))
+            except FETCH_ERRORS as e:
+                logging.warning("Could not fetch %s: %s", feed_url, e)
+                self.errors[builder.generate_hash(feed_url)] = e
+                return None
+
+        tasks = [asyncio.ensure_future(fetch_one(feed_url)) for feed_url in dict.fromkeys(feed_urls)]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                if result is None:
+                    continue
+                hash_key, feed_data, new_validators = result
+                self.validators[hash_key] = new_validators
+                yield hash_key, feed_data
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _get(self, feed_url: str, headers: dict, held_key: tuple) -> tuple:
+        for _ in range(MAX_REDIRECTS + 1):
+            status, response_headers, body = await self._request(feed_url, headers, held_key)
+            if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+                feed_url = urljoin(feed_url, response_headers['location'])
+                continue
+            return status, response_headers, body
+        raise FetchError(f"Too many redirects fetching {feed_url}")
+
+    async def _request(self, feed_url: str, headers: dict, held_key: tuple) -> tuple:
+        """
+        Sends a single request, on a connection to the host of feed_url. The slot of held_key is already held by fetch,
+        the slot of another host, after a redirect, is taken here.
+        """
+        key = connection_key(feed_url)
+        parts = urlsplit(feed_url)
+        target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        request = [f"GET {target} HTTP/1.1", f"Host: {parts.netloc}", "Accept-Encoding: gzip, deflate",
+                   "Connection: keep-alive"] + [f"{name}: {value}" for name, value in headers.items()]
+        request = ("\r\n".join(request) + "\r\n\r\n").encode('latin-1')
+
+        async with self.pool.host_slot(key) if key != held_key else contextlib.nullcontext():
+            for attempt in range(2):
+                reader, writer, reused = await self.pool.acquire(key)
+                reusable = False
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    status, response_headers, body, reusable = await read_response(reader, self.max_bytes)
+                    if len(body) >= self.max_bytes:
+                        logging.warning("Feed %s may be larger than %s bytes, the rest is ignored", feed_url, self.max_bytes)
+                    return status, response_headers, body
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # An idle connection may have been closed by the server meanwhile, retry once on a new one.
+                    if not reused or attempt:
+                        raise
+                finally:
+                    self.pool.release(key, reader, writer, reusable)
+
+
+def connection_key(feed_url: str) -> tuple:
+    """
+    Returns the (scheme, host, port) tuple that connections and host slots are kept by for a URL.
+    Raises:
+     - ValueError if the URL is not an http(s) URL.
+    """
+    parts = urlsplit(feed_url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f"Unsupported feed URL {feed_url}")
+    return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+
+async def read_response(reader: asyncio.StreamReader, max_bytes=None) -> tuple:
+    """
+    Reads an HTTP/1.1 response from the stream.
+    Args:
+     - reader: The stream of the connection.
+     - max_bytes (optional): Maximum number of bytes of the body read, and of the body once decompressed. The rest is
+       ignored, and the connection is not reused when the body was cut short.
+    Returns:
+     - A tuple of the status code, a dict of lower-cased headers, the decoded body and whether the connection can be reused.
+    """
+    status_line = await reader.readuntil(b"\r\n")
+    version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+    status = int(status)
+    headers = {}
+    while True:
+        line = await reader.readuntil(b"\r\n")
+        if line == b"\r\n":
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    reusable = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    if status in (204, 304) or 100 <= status < 200:
+        body = b""
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        left = max_bytes
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                break
+            if left is not None and size > left:
+                chunks.append(await reader.readexactly(left))
+                reusable = False
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+            if left is not None:
+                left -= size
+        body = b"".join(chunks)
+    elif 'content-length' in headers:
+        length = int(headers['content-length'])
+        if max_bytes is not None and length > max_bytes:
+            length = max_bytes
+            reusable = False
+        body = await reader.readexactly(length)
+    else:
+        chunks = []
+        left = max_bytes
+        while left is None or left > 0:
+            chunk = await reader.read(-1 if left is None else left)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if left is not None:
+                left -= len(chunk)
+        body = b"".join(chunks)
+        reusable = False
+
+    encoding = headers.get('content-encoding', '').lower()
+    if encoding in ('gzip', 'deflate'):
+        # decompressobj bounds the output, and accepts a body cut short above.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+        body = decompressor.decompress(body, max_bytes or 0)
+    return status, headers, body, reusable
+
+
+def fetch_feeds(feed_urls, **options) -> list:
+    """
+    Synchronous helper around AsyncFeedFetcher.fetch_many.
+    Returns:
+     - A list of (hash_key, feed_data) tuples for the feeds that could be fetched.
+    """
+    async def run():
+        async with AsyncFeedFetcher(**options) as fetcher:
+            return [result async for result in fetcher.fetch_many(feed_urls)]
+    return asyncio.run(run())
@@ -0,0 +1,207 @@
+"""
+Low-overhead instrumentation of the hot paths, exposed in the Prometheus text format.
+
+Histograms keep a count per bucket and per label values, so recording a timing costs two clock reads, a bisect and an
+uncontended lock, cheap enough to leave on in production. Gauges are either set by the code or computed by a function
+when the metrics are rendered, which keeps things like pool saturation and queue lag off the hot path entirely. The
+application serves the metrics on GET /metrics; a process without an HTTP server (queue_listener.py) starts one with
+serve().
+
+Example usage:
+
+FETCH_SECONDS = metrics.Histogram('rss_feed_fetch_seconds', "Time spent downloading feeds.", ['source'])
+
+with FETCH_SECONDS.time('stream'):
+    ...
+
+@FETCH_SECONDS.time('sync')
+def fetch(...):
+    ...
+"""
+import bisect
+import logging
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metrics by name, in the order they were created.
+registry = {}
+
+
+class Histogram:
+    """
+    A histogram of observed values, typically durations in seconds.
+    Args:
+     - name: Name of the metric.
+     - documentation: Help text of the metric.
+     - labels: Names of the labels. Label values are given positionally to observe and time, and should come from a
+       small fixed set (e.g. statement classes, not URLs).
+     - buckets: Upper bounds of the buckets, in increasing order.
+    """
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        registry[name] = self
+
+    def observe(self, value: float, *label_values) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # One count per bucket, then the +Inf bucket and the sum of the observed values.
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *label_values) -> 'Timer':
+        """
+        Returns a context manager, also usable as a decorator, observing the seconds its block takes.
+        """
+        return Timer(self, label_values)
+
+    def snapshot(self) -> dict:
+        """
+        Returns a copy of the series, mapping label values to the cumulative counts of the buckets, the +Inf bucket
+        (the total count) and the sum.
+        """
+        with self._lock:
+            series = {label_values: list(values) for label_values, values in self._series.items()}
+        for values in series.values():
+            for index in range(1, len(values) - 1):
+                values[index] += values[index - 1]
+        return series
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+        for label_values, values in sorted(self.snapshot().items()):
+            labels = list(zip(self.labels, label_values))
+            for bound, count in zip(bounds, values):
+                lines.append(f"{self.name}_bucket{format_labels(labels + [('le', bound)])} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(values[-1])}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {values[-2]}")
+        return lines
+
+
+class Timer:
+    """
+    Observes the duration of a with block, or of each call of a decorated function, in a histogram.
+    """
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+    def __call__(self, function):
+        histogram, label_values = self.histogram, self.label_values
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *label_values)
+        return timed
+
+
+class Gauge:
+    """
+    A value that goes up and down.
+    Args:
+     - name: Name of the metric.
+     - documentation: Help text of the metric.
+     - labels: Names of the labels.
+     - function: Optional function computing the value when the metrics are rendered, instead of set(). It returns a
+       number, or a dict mapping label values to numbers for a gauge with labels.
+    """
+
+    def __init__(self, name: str, documentation: str, labels=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self._values = {}
+        registry[name] = self
+
+    def set(self, value: float, *label_values) -> None:
+        self._values[label_values] = value
+
+    def values(self) -> dict:
+        if self.function is None:
+            return dict(self._values)
+        values = self.function()
+        return values if isinstance(values, dict) else {(): values}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for label_values, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{format_labels(list(zip(self.labels, label_values)))} {format_value(value)}")
+        return lines
+
+
+def format_labels(labels: list) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format. A gauge whose function fails is left out.
+    """
+    lines = []
+    for metric in list(registry.values()):
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            logging.warning("Could not collect metric %s: %s", metric.name, e)
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = '') -> ThreadingHTTPServer:
+    """
+    Serves the metrics over HTTP on a daemon thread, for processes without their own HTTP server.
+    Returns:
+     - The server, stopped with shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,99 @@
+"""
+Versioned schema migrations for the SQLite database.
+
+Migrations are the files migrations/NNNN_description.sql, applied in order of their number. Migrations that need
+more than SQL are written as migrations/NNNN_description.py modules with an upgrade(db_connection) function, which
+must not commit. The versions applied to a database are recorded in the schema_migrations table, and each migration
+runs in its own transaction together with its record, so a failed migration leaves the database at the previous version.
+
+Run with: python migrations.py [db_path]
+"""
+import importlib.util
+import os
+import re
+import sqlite3
+import sys
+import time
+import config
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.(sql|py)$')
+
+
+def available_migrations() -> list:
+    """
+    Returns the (version, name, path) of every migration file, ordered by version.
+    """
+    migrations = []
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, file_name)))
+    return sorted(migrations)
+
+
+def current_version(db_connection: sqlite3.Connection) -> int:
+    """
+    Returns the latest migration version applied to the database, 0 for a new database.
+    """
+    db_connection.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                                 version         INTEGER NOT NULL PRIMARY KEY,
+                                 name            TEXT NOT NULL,
+                                 applied_date    INTEGER NOT NULL)""")
+    return db_connection.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+
+
+def migrate(db_connection: sqlite3.Connection, target=None) -> list:
+    """
+    Applies the pending migrations up to target (all of them by default).
+    Args:
+     - db_connection: SQLite3 database connection object.
+     - target: Optional version to stop at.
+    Returns:
+     - A list of the versions applied.
+    """
+    applied = []
+    version = current_version(db_connection)
+    for migration_version, name, path in available_migrations():
+        if migration_version <= version or (target is not None and migration_version > target):
+            continue
+        try:
+            if path.endswith('.py'):
+                run_python_migration(db_connection, migration_version, name, path)
+            else:
+                with open(path) as migration_file:
+                    script = migration_file.read()
+                db_connection.executescript(f"""BEGIN;
+                                                {script}
+                                                INSERT INTO schema_migrations (version, name, applied_date)
+                                                VALUES ({migration_version}, '{name}', {int(time.time())});
+                                                COMMIT;""")
+        except Exception:
+            if db_connection.in_transaction:
+                db_connection.rollback()
+            raise
+        applied.append(migration_version)
+    return applied
+
+
+def run_python_migration(db_connection: sqlite3.Connection, version: int, name: str, path: str) -> None:
+    """
+    Runs the upgrade function of a Python migration module in a transaction, together with its schema_migrations record.
+    """
+    spec = importlib.util.spec_from_file_location(f"migration_{version:04d}_{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    db_connection.execute("BEGIN")
+    module.upgrade(db_connection)
+    db_connection.execute("INSERT INTO schema_migrations (version, name, applied_date) VALUES (?,?,?)",
+                          (version, name, int(time.time())))
+    db_connection.commit()
+
+
+if __name__ == '__main__':
+    db_connection = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else config.config['db_path'])
+    applied = migrate(db_connection)
+    print(f"Applied migrations: {applied}" if applied else "Database is up to date.")
+    print(f"Schema version: {current_version(db_connection)}")
+    db_connection.close()
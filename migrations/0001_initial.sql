@@ -0,0 +1,39 @@
+CREATE TABLE IF NOT EXISTS user (
+    user_id     INTEGER NOT NULL,
+    password    TEXT NOT NULL,
+    PRIMARY KEY (user_id)
+);
+
+CREATE TABLE IF NOT EXISTS rss_feeds (
+    user_id         INTEGER NOT NULL,
+    url             TEXT NOT NULL,
+    feed_id         TEXT NOT NULL,
+    updated_date    TEXT,
+    PRIMARY KEY (user_id, feed_id)
+);
+
+CREATE TABLE IF NOT EXISTS rss_feedData (
+    feed_id         TEXT NOT NULL,
+    feed_item_id    TEXT NOT NULL,
+    feed_item       TEXT NOT NULL,
+    marked          INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (feed_id, feed_item_id)
+);
+
+CREATE TABLE IF NOT EXISTS rss_marked_status (
+    user_id         INTEGER NOT NULL,
+    feed_item_id    TEXT NOT NULL,
+    is_read         INTEGER NOT NULL DEFAULT 0,
+    feed_id         TEXT NOT NULL,
+    updated_date    TEXT,
+    PRIMARY KEY (user_id, feed_id, feed_item_id)
+);
+
+CREATE TABLE IF NOT EXISTS rss_feed_validators (
+    feed_id         TEXT NOT NULL,
+    etag            TEXT,
+    last_modified   TEXT,
+    digest          TEXT,
+    fetched_date    TEXT,
+    PRIMARY KEY (feed_id)
+);
@@ -0,0 +1,59 @@
+-- Dates become integer epochs so that they can be ordered through an index, rss_feedData gets a stable integer key
+-- (item_seq) and every hot query gets an index covering its filter.
+
+CREATE TABLE rss_feeds_new (
+    user_id         INTEGER NOT NULL,
+    url             TEXT NOT NULL,
+    feed_id         TEXT NOT NULL,
+    updated_date    INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, feed_id)
+);
+INSERT INTO rss_feeds_new (user_id, url, feed_id, updated_date)
+    SELECT user_id, url, feed_id, COALESCE(CAST(strftime('%s', updated_date) AS INTEGER), 0) FROM rss_feeds;
+DROP TABLE rss_feeds;
+ALTER TABLE rss_feeds_new RENAME TO rss_feeds;
+CREATE INDEX idx_rss_feeds_user_updated ON rss_feeds (user_id, updated_date);
+CREATE INDEX idx_rss_feeds_user_url ON rss_feeds (user_id, url);
+CREATE INDEX idx_rss_feeds_feed_user ON rss_feeds (feed_id, user_id);
+
+CREATE TABLE rss_feedData_new (
+    item_seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+    feed_id         TEXT NOT NULL,
+    feed_item_id    TEXT NOT NULL,
+    feed_item       TEXT NOT NULL,
+    marked          INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (feed_id, feed_item_id)
+);
+INSERT INTO rss_feedData_new (feed_id, feed_item_id, feed_item, marked)
+    SELECT feed_id, feed_item_id, feed_item, marked FROM rss_feedData ORDER BY rowid;
+DROP TABLE rss_feedData;
+ALTER TABLE rss_feedData_new RENAME TO rss_feedData;
+
+CREATE TABLE rss_marked_status_new (
+    user_id         INTEGER NOT NULL,
+    feed_item_id    TEXT NOT NULL,
+    is_read         INTEGER NOT NULL DEFAULT 0,
+    feed_id         TEXT NOT NULL,
+    updated_date    INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, feed_id, feed_item_id)
+);
+INSERT INTO rss_marked_status_new (user_id, feed_item_id, is_read, feed_id, updated_date)
+    SELECT user_id, feed_item_id, is_read, feed_id, COALESCE(CAST(strftime('%s', updated_date) AS INTEGER), 0)
+    FROM rss_marked_status;
+DROP TABLE rss_marked_status;
+ALTER TABLE rss_marked_status_new RENAME TO rss_marked_status;
+CREATE INDEX idx_rss_marked_status_read ON rss_marked_status (user_id, feed_id, is_read, feed_item_id);
+
+CREATE TABLE rss_feed_validators_new (
+    feed_id         TEXT NOT NULL,
+    etag            TEXT,
+    last_modified   TEXT,
+    digest          TEXT,
+    fetched_date    INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (feed_id)
+);
+INSERT INTO rss_feed_validators_new (feed_id, etag, last_modified, digest, fetched_date)
+    SELECT feed_id, etag, last_modified, digest, COALESCE(CAST(strftime('%s', fetched_date) AS INTEGER), 0)
+    FROM rss_feed_validators;
+DROP TABLE rss_feed_validators;
+ALTER TABLE rss_feed_validators_new RENAME TO rss_feed_validators;
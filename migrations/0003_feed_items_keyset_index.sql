@@ -0,0 +1,6 @@
+-- Keyset pagination of a feed's items walks rss_feedData by (feed_id, item_seq). A user follows a URL at most once,
+-- declaring it lets the planner treat the rss_feeds lookup as a single row and read the items already in order.
+
+CREATE INDEX idx_rss_feedData_feed_seq ON rss_feedData (feed_id, item_seq);
+DROP INDEX idx_rss_feeds_user_url;
+CREATE UNIQUE INDEX idx_rss_feeds_user_url ON rss_feeds (user_id, url);
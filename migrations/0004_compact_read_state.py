@@ -0,0 +1,36 @@
+"""
+Replaces the per-item rss_marked_status rows with one rss_read_state row per (user, feed), see read_state.py.
+Items get item_no, their position in the feed in the order they were stored.
+"""
+import read_state
+
+
+def upgrade(db_connection):
+    db_connection.execute("ALTER TABLE rss_feedData ADD COLUMN item_no INTEGER NOT NULL DEFAULT 0")
+    db_connection.execute("""UPDATE rss_feedData SET item_no=numbered.item_no
+                             FROM (SELECT item_seq, ROW_NUMBER() OVER (PARTITION BY feed_id ORDER BY item_seq) AS item_no
+                                   FROM rss_feedData) AS numbered
+                             WHERE rss_feedData.item_seq=numbered.item_seq""")
+    db_connection.execute("CREATE UNIQUE INDEX idx_rss_feedData_feed_no ON rss_feedData (feed_id, item_no)")
+    db_connection.execute("""CREATE TABLE rss_read_state (
+                                 user_id         INTEGER NOT NULL,
+                                 feed_id         TEXT NOT NULL,
+                                 read_hwm        INTEGER NOT NULL DEFAULT 0,
+                                 bitmap_base     INTEGER NOT NULL DEFAULT 0,
+                                 read_bitmap     BLOB,
+                                 updated_date    INTEGER NOT NULL DEFAULT 0,
+                                 PRIMARY KEY (user_id, feed_id))""")
+
+    read_items = {}
+    for user_id, feed_id, item_no, updated_date in db_connection.execute(
+            """SELECT rss_marked_status.user_id, rss_marked_status.feed_id, rss_feedData.item_no, rss_marked_status.updated_date
+               FROM rss_marked_status INNER JOIN rss_feedData
+               ON rss_feedData.feed_id=rss_marked_status.feed_id AND rss_feedData.feed_item_id=rss_marked_status.feed_item_id
+               WHERE rss_marked_status.is_read=1"""):
+        read, last_updated = read_items.get((user_id, feed_id), (0, 0))
+        read_items[(user_id, feed_id)] = (read_state.mark(read, [item_no], True), max(last_updated, updated_date))
+    db_connection.executemany("""INSERT INTO rss_read_state (user_id, feed_id, read_hwm, bitmap_base, read_bitmap, updated_date)
+                                 VALUES (?,?,?,?,?,?)""",
+                              [(user_id, feed_id) + read_state.encode(read) + (updated_date,)
+                               for (user_id, feed_id), (read, updated_date) in read_items.items()])
+    db_connection.execute("DROP TABLE rss_marked_status")
@@ -0,0 +1,26 @@
+"""
+Stores the fields of feed items in typed columns instead of a JSON document, so that reads no longer decode every row
+and items can be ordered by their published date through an index. raw_entry optionally keeps the whole parsed entry,
+zlib compressed (see "store_raw_entries" in config.yaml).
+"""
+import json
+import builder
+
+
+def upgrade(db_connection):
+    for column in ("title TEXT", "link TEXT", "summary TEXT", "published INTEGER NOT NULL DEFAULT 0", "guid TEXT",
+                   "raw_entry BLOB"):
+        db_connection.execute(f"ALTER TABLE rss_feedData ADD COLUMN {column}")
+    rows = db_connection.execute("SELECT item_seq, feed_item FROM rss_feedData").fetchall()
+    items = []
+    for item_seq, feed_item in rows:
+        try:
+            item = json.loads(feed_item)
+        except ValueError:
+            item = {}
+        items.append((item.get('title'), item.get('link'), item.get('summary'),
+                      builder.published_epoch(item.get('published')) or 0, item.get('guid'), item_seq))
+    db_connection.executemany("UPDATE rss_feedData SET title=?, link=?, summary=?, published=?, guid=? WHERE item_seq=?",
+                              items)
+    db_connection.execute("ALTER TABLE rss_feedData DROP COLUMN feed_item")
+    db_connection.execute("CREATE INDEX idx_rss_feedData_feed_published ON rss_feedData (feed_id, published)")
@@ -0,0 +1,26 @@
+-- Full-text index over the titles and summaries of feed items, used by GET /search. It is an external content FTS5
+-- table: the text stays in rss_feedData only, and the triggers keep the index in sync with its inserts, updates and
+-- deletes.
+
+CREATE VIRTUAL TABLE rss_feedData_fts USING fts5(
+    title,
+    summary,
+    content='rss_feedData',
+    content_rowid='item_seq',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER rss_feedData_fts_insert AFTER INSERT ON rss_feedData BEGIN
+    INSERT INTO rss_feedData_fts (rowid, title, summary) VALUES (new.item_seq, new.title, new.summary);
+END;
+
+CREATE TRIGGER rss_feedData_fts_delete AFTER DELETE ON rss_feedData BEGIN
+    INSERT INTO rss_feedData_fts (rss_feedData_fts, rowid, title, summary) VALUES ('delete', old.item_seq, old.title, old.summary);
+END;
+
+CREATE TRIGGER rss_feedData_fts_update AFTER UPDATE OF title, summary ON rss_feedData BEGIN
+    INSERT INTO rss_feedData_fts (rss_feedData_fts, rowid, title, summary) VALUES ('delete', old.item_seq, old.title, old.summary);
+    INSERT INTO rss_feedData_fts (rowid, title, summary) VALUES (new.item_seq, new.title, new.summary);
+END;
+
+INSERT INTO rss_feedData_fts (rss_feedData_fts) VALUES ('rebuild');
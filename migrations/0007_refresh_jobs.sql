@@ -0,0 +1,8 @@
+-- One row per feed with a refresh job queued or running, so that further refresh requests for the feed are absorbed
+-- by it instead of queueing duplicates.
+
+CREATE TABLE rss_refresh_jobs (
+    feed_id         TEXT NOT NULL PRIMARY KEY,
+    task_id         TEXT NOT NULL,
+    enqueued_date   INTEGER NOT NULL
+);
@@ -0,0 +1,14 @@
+-- One row per OPML import, holding its progress so that the client can poll it while the feeds are fetched in the
+-- background.
+
+CREATE TABLE rss_import_jobs (
+    job_id          TEXT NOT NULL PRIMARY KEY,
+    user_id         INTEGER NOT NULL,
+    status          TEXT NOT NULL,
+    total           INTEGER NOT NULL,
+    done            INTEGER NOT NULL DEFAULT 0,
+    failed          INTEGER NOT NULL DEFAULT 0,
+    errors          TEXT NOT NULL DEFAULT '[]',
+    created_date    INTEGER NOT NULL,
+    updated_date    INTEGER NOT NULL
+);
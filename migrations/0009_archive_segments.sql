@@ -0,0 +1,11 @@
+-- Segments of the item archive holding items of each feed, see archive.py, so that the archived items of a feed are
+-- read from its segments only.
+
+CREATE TABLE rss_archive_segments (
+    segment         TEXT NOT NULL,
+    feed_id         TEXT NOT NULL,
+    items           INTEGER NOT NULL,
+    min_seq         INTEGER NOT NULL,
+    max_seq         INTEGER NOT NULL,
+    PRIMARY KEY (feed_id, segment)
+);
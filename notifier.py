@@ -0,0 +1,136 @@
+"""
+In-process publish/subscribe of new feed items, keyed by feed_id, behind GET /feeds/stream.
+
+The write paths of db_service publish the feeds they stored new items for, once committed. A subscription covers the
+feeds a user follows and is woken up by the publications of any of them; the subscriber then reads the new items from
+the database, so a publication carries no data and a missed or spurious one costs nothing but a query. Feeds refreshed
+by other processes (queue_listener.py, scheduler.py) are not published in this process: a single watcher thread polls
+the database for new items every "stream_watch_interval" seconds and publishes them, for all the subscriptions of the
+process at once.
+
+Example usage:
+
+with notifier.notifier.subscribe(feed_ids) as subscription:
+    while subscription.wait(timeout):
+        ...  # read the new items
+"""
+import logging
+import threading
+import metrics
+
+
+class Subscription:
+    """
+    A subscription to a set of feeds. wait() returns as soon as any of them was published since the previous wait, or
+    since the subscription was created.
+    """
+
+    def __init__(self, notifier: 'FeedNotifier', feed_ids):
+        self.notifier = notifier
+        self.feed_ids = frozenset(feed_ids)
+        self.closed = False
+        self._event = threading.Event()
+
+    def notify(self) -> None:
+        self._event.set()
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Waits up to timeout seconds for a publication. Returns True if there was one.
+        """
+        published = self._event.wait(timeout)
+        self._event.clear()
+        return published
+
+    def close(self) -> None:
+        self.notifier.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FeedNotifier:
+    """
+    Fans out publications of feed ids to the subscriptions covering them.
+    """
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._stop = threading.Event()
+        self.count = 0
+
+    def subscribe(self, feed_ids) -> Subscription:
+        subscription = Subscription(self, feed_ids)
+        with self._lock:
+            for feed_id in subscription.feed_ids:
+                self._subscriptions.setdefault(feed_id, set()).add(subscription)
+            self.count += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            for feed_id in subscription.feed_ids:
+                subscriptions = self._subscriptions.get(feed_id)
+                if subscriptions is not None and subscription in subscriptions:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._subscriptions[feed_id]
+            self.count -= 1
+
+    def publish(self, feed_id: str) -> None:
+        """
+        Wakes up the subscriptions covering a feed that has new items.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(feed_id, ()))
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def watch(self, poll, interval: float) -> None:
+        """
+        Starts the watcher thread, unless it runs already.
+        Args:
+         - poll: Function taking the last item_seq seen, or None on the first call, and returning the ids of the feeds
+           with newer items and the new last item_seq.
+         - interval: Seconds between two polls.
+        """
+        with self._lock:
+            if self._watcher is not None and self._watcher.is_alive():
+                return
+            self._stop = threading.Event()
+            self._watcher = threading.Thread(target=self._watch, args=(poll, interval, self._stop), daemon=True)
+            self._watcher.start()
+
+    def stop(self) -> None:
+        """
+        Stops the watcher thread, if it runs, and waits for it, e.g. before the database it polls goes away.
+        """
+        with self._lock:
+            watcher, self._watcher = self._watcher, None
+            self._stop.set()
+        if watcher is not None:
+            watcher.join()
+
+    def _watch(self, poll, interval: float, stop: threading.Event) -> None:
+        last_seq = None
+        while not stop.is_set():
+            try:
+                feed_ids, last_seq = poll(last_seq)
+                for feed_id in feed_ids:
+                    self.publish(feed_id)
+            except Exception as e:
+                logging.warning("Could not poll for new items: %s", e)
+            stop.wait(interval)
+
+
+notifier = FeedNotifier()
+SUBSCRIPTIONS = metrics.Gauge('rss_stream_subscriptions', "Open change-notification streams and long polls.",
+                              function=lambda: notifier.count)
@@ -0,0 +1,55 @@
+"""
+Reading and writing of OPML subscription lists, the format feed readers import and export subscriptions in.
+
+Example usage:
+
+feeds = opml.parse_opml(document)
+body = ''.join(opml.iter_opml(feeds, 'Subscriptions'))
+"""
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+import builder
+
+
+class OPMLError(ValueError):
+    """Raised when a document is not a valid OPML subscription list."""
+
+
+def parse_opml(document: bytes) -> list:
+    """
+    Extracts the feeds of an OPML document. Outlines may be nested in categories, each outline with an xmlUrl attribute
+    is a feed. Feeds listed more than once, by URLs with the same builder.generate_hash, are kept once.
+    Args:
+     - document: The OPML document.
+    Returns:
+     - list: (url, title) tuples in document order. The title is None when the outline has neither text nor title.
+    """
+    try:
+        root = ElementTree.fromstring(document)
+    except ElementTree.ParseError as e:
+        raise OPMLError(f"Invalid OPML document: {e}")
+    if root.tag != 'opml' or root.find('body') is None:
+        raise OPMLError("Invalid OPML document: no opml body")
+    feeds = {}
+    for outline in root.find('body').iter('outline'):
+        url = (outline.get('xmlUrl') or outline.get('xmlurl') or '').strip()
+        if url:
+            feeds.setdefault(builder.generate_hash(url), (url, outline.get('text') or outline.get('title')))
+    return list(feeds.values())
+
+
+def iter_opml(feeds, title: str):
+    """
+    Generator over the parts of an OPML document listing feeds, so that a large subscription list can be streamed.
+    Args:
+     - feeds: Iterable of (url, title) tuples. A feed without title is listed by its URL.
+     - title: Title of the document.
+    Yields:
+     - str: Parts of the document.
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<opml version="2.0">\n'
+    yield f'<head><title>{escape(title)}</title></head>\n<body>\n'
+    for url, feed_title in feeds:
+        text = quoteattr(feed_title or url)
+        yield f'<outline type="rss" text={text} title={text} xmlUrl={quoteattr(url)}/>\n'
+    yield '</body>\n</opml>\n'
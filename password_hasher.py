@@ -0,0 +1,88 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+import config
+
+
+class HasherBusy(Exception):
+    """
+    Raised when more password hashes are queued than the pool is configured to accept.
+    """
+
+
+class PasswordHasher:
+    """
+    Runs password hashing on a bounded pool of worker threads, so that a burst of logins queues up behind a fixed
+    number of workers instead of occupying every request thread. hashlib releases the GIL while hashing, so the workers
+    run in parallel with the rest of the application. When more than max_queue hashes are pending, new ones are refused
+    with HasherBusy instead of waiting.
+    Args:
+     - workers: Number of hashing threads.
+     - max_queue: Maximum number of pending hashes, including the running ones.
+     - method: werkzeug hash method including its cost, e.g. "pbkdf2:sha256:600000".
+     - timeout: Seconds to wait for a queued hash.
+    """
+
+    def __init__(self, workers: int, max_queue: int, method: str, timeout: float = 30):
+        self.method = method
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hasher')
+
+    def _run(self, function, *args):
+        with self._lock:
+            if self.pending >= self.max_queue:
+                raise HasherBusy(f"{self.pending} password hashes pending")
+            self.pending += 1
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future.result(timeout=self.timeout)
+
+    def _release(self) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    def hash(self, password: str) -> str:
+        """
+        Returns the hash of password with the configured method.
+        """
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash: str, password: str) -> bool:
+        """
+        Returns whether password matches pwhash.
+        """
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        """
+        Returns whether pwhash was made with a different method or cost than the configured one.
+        """
+        return pwhash.split('$', 1)[0] != self.method
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+_hasher = None
+_hasher_lock = threading.Lock()
+
+
+def get_hasher() -> PasswordHasher:
+    """
+    Returns the process wide hasher, creating it on first use or when the configured hash method changed.
+    """
+    global _hasher
+    with _hasher_lock:
+        if _hasher is None or _hasher.method != config.config['password_hash_method']:
+            if _hasher is not None:
+                _hasher.shutdown(wait=False)
+            _hasher = PasswordHasher(config.config['password_hash_workers'], config.config['password_hash_max_queue'],
+                                     config.config['password_hash_method'])
+        return _hasher
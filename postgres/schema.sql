@@ -0,0 +1,63 @@
+-- Schema of the PostgreSQL storage backend (postgres_storage.py), the counterpart of the users, follows, feed items
+-- and read state tables of the SQLite migrations. Every statement is idempotent, the schema is applied on first use.
+
+CREATE TABLE IF NOT EXISTS "user" (
+    user_id         BIGINT NOT NULL PRIMARY KEY,
+    password        TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rss_feeds (
+    follow_seq      BIGINT GENERATED ALWAYS AS IDENTITY,
+    user_id         BIGINT NOT NULL,
+    url             TEXT NOT NULL,
+    feed_id         TEXT NOT NULL,
+    updated_date    BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, feed_id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_rss_feeds_user_url ON rss_feeds (user_id, url);
+CREATE INDEX IF NOT EXISTS idx_rss_feeds_feed_user ON rss_feeds (feed_id, user_id);
+
+CREATE TABLE IF NOT EXISTS rss_feedData (
+    item_seq        BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    feed_id         TEXT NOT NULL,
+    feed_item_id    TEXT NOT NULL,
+    item_no         INTEGER NOT NULL,
+    title           TEXT,
+    link            TEXT,
+    summary         TEXT,
+    published       BIGINT NOT NULL DEFAULT 0,
+    guid            TEXT,
+    raw_entry       BYTEA,
+    UNIQUE (feed_id, feed_item_id),
+    UNIQUE (feed_id, item_no)
+);
+CREATE INDEX IF NOT EXISTS idx_rss_feedData_feed_seq ON rss_feedData (feed_id, item_seq);
+CREATE INDEX IF NOT EXISTS idx_rss_feedData_feed_published ON rss_feedData (feed_id, published);
+
+CREATE TABLE IF NOT EXISTS rss_feed_validators (
+    feed_id         TEXT NOT NULL PRIMARY KEY,
+    etag            TEXT,
+    last_modified   TEXT,
+    digest          TEXT,
+    fetched_date    BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS rss_read_state (
+    user_id         BIGINT NOT NULL,
+    feed_id         TEXT NOT NULL,
+    read_hwm        INTEGER NOT NULL DEFAULT 0,
+    bitmap_base     INTEGER NOT NULL DEFAULT 0,
+    read_bitmap     BYTEA,
+    updated_date    BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, feed_id)
+);
+
+-- read_state.read_bit: whether item_no is set in the bitmap of read items above the high-water mark. get_bit numbers
+-- the bits of a bytea from the least significant bit of its first byte, like the little-endian bitmap of read_state.py.
+CREATE OR REPLACE FUNCTION read_bit(read_bitmap BYTEA, bitmap_base INTEGER, item_no INTEGER) RETURNS BOOLEAN AS $$
+    SELECT CASE
+        WHEN read_bitmap IS NULL THEN FALSE
+        WHEN item_no - 1 - COALESCE(bitmap_base, 0) NOT BETWEEN 0 AND length(read_bitmap) * 8 - 1 THEN FALSE
+        ELSE get_bit(read_bitmap, item_no - 1 - COALESCE(bitmap_base, 0)) = 1
+    END
+$$ LANGUAGE SQL IMMUTABLE;
@@ -0,0 +1,307 @@
+"""
+PostgreSQL storage backend, see storage.py. Selected with "storage_backend: postgres" and "postgres_dsn" in
+config.yaml, and requires psycopg2 (pip install psycopg2-binary).
+
+Unlike SQLite, PostgreSQL lets several API and worker processes write at the same time, so there is no process-wide
+write lock: writers of new items are serialized by a transaction-scoped advisory lock instead, which keeps the item_no
+of a feed dense and makes item_seq follow commit order (see write_items). Connections are pooled per process. New items are loaded with a single multi-row INSERT, or
+with COPY into a temporary table above "postgres_copy_threshold" items, and upserted with ON CONFLICT.
+
+The schema, postgres/schema.sql, is applied on first use. To run the tests against a local server or a container:
+
+docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=rss postgres:16
+RSS_TEST_POSTGRES_DSN="host=127.0.0.1 user=postgres password=rss" python -m pytest tests/test_storage.py
+"""
+import io
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+import config
+import db_pool
+import storage
+
+try:
+    import psycopg2
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), 'postgres', 'schema.sql')
+# Key of the advisory lock taken while the schema is applied, so that processes starting together do not race.
+SCHEMA_LOCK = 0x727373
+# Key of the advisory lock taken by transactions inserting items, see write_items.
+ITEMS_LOCK = 0x727374
+ITEM_INSERT_COLUMNS = ('feed_id', 'feed_item_id', 'item_no') + storage.ITEM_COLUMNS + ('raw_entry',)
+ITEM_UPSERT = f"""ON CONFLICT(feed_id, feed_item_id) DO UPDATE SET
+                  {', '.join(f'{column}=excluded.{column}' for column in storage.ITEM_COLUMNS)}, raw_entry=excluded.raw_entry"""
+# Casts of the VALUES rows of items, whose columns may be all NULL in a batch.
+ITEM_TEMPLATE = "(%s, %s, %s::integer, %s::text, %s::text, %s::text, %s::bigint, %s::text, %s::bytea)"
+
+
+class PostgresStorage(storage.Storage):
+    """
+    A PostgreSQL database.
+    Args:
+     - dsn: libpq connection string of the database.
+     - size: Maximum number of pooled connections of the process.
+     - timeout: Seconds to wait for a pooled connection when all of them are in use.
+    """
+    name = 'postgres'
+
+    def __init__(self, dsn: str, size: int, timeout: float = 10):
+        if psycopg2 is None:
+            raise RuntimeError("storage_backend postgres requires psycopg2, pip install psycopg2-binary")
+        self.OperationalError = psycopg2.OperationalError
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.copy_threshold = config.config['postgres_copy_threshold']
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._cursor_names = itertools.count(1)
+
+    def get_pool(self):
+        """
+        Returns the connection pool, creating it and applying the schema on first use.
+        """
+        with self._lock:
+            if self._pool is None:
+                db_connection = psycopg2.connect(self.dsn)
+                try:
+                    self.create_schema(db_connection)
+                finally:
+                    db_connection.close()
+                self._pool = psycopg2.pool.ThreadedConnectionPool(0, self.size, self.dsn)
+            return self._pool
+
+    @staticmethod
+    def create_schema(db_connection) -> None:
+        with open(SCHEMA_FILE) as schema_file:
+            schema = schema_file.read()
+        with db_connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK,))
+            cursor.execute(schema)
+        db_connection.commit()
+
+    @contextmanager
+    def cursor(self):
+        pool = self.get_pool()
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.OperationalError("Timed out waiting for a database connection from the pool")
+        try:
+            db_connection = pool.getconn()
+            db_pool.WAIT_SECONDS.observe(time.perf_counter() - started, 'connection')
+            try:
+                with db_connection.cursor() as cursor:
+                    yield db_connection, cursor
+            finally:
+                broken = bool(db_connection.closed)
+                if not broken:
+                    # The caller neither committed nor rolled back, do not leak its transaction to the next user.
+                    db_connection.rollback()
+                pool.putconn(db_connection, close=broken)
+        finally:
+            self._slots.release()
+
+    def writer(self):
+        return self.cursor()
+
+    def connect(self) -> tuple:
+        self.get_pool()
+        db_connection = psycopg2.connect(self.dsn)
+        return db_connection, db_connection.cursor()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def get_user_password(self, user_id: int, cursor):
+        cursor.execute('SELECT password FROM "user" WHERE user_id=%s', (user_id,))
+        user = cursor.fetchone()
+        return user[0] if user else None
+
+    def insert_user(self, user_id: int, password: str, cursor) -> bool:
+        cursor.execute('INSERT INTO "user" (user_id, password) VALUES (%s,%s) ON CONFLICT DO NOTHING', (user_id, password))
+        return cursor.rowcount == 1
+
+    def update_user_password(self, user_id: int, password: str, cursor) -> None:
+        cursor.execute('UPDATE "user" SET password=%s WHERE user_id=%s', (password, user_id))
+
+    def insert_follow(self, user_id: int, url: str, feed_id: str, cursor) -> bool:
+        cursor.execute("""INSERT INTO rss_feeds (user_id, url, feed_id, updated_date) VALUES (%s,%s,%s,%s)
+                          ON CONFLICT DO NOTHING""", (user_id, url, feed_id, int(time.time())))
+        return cursor.rowcount == 1
+
+    def is_feed_followed(self, feed_id: str, cursor) -> bool:
+        cursor.execute("SELECT 1 FROM rss_feeds WHERE feed_id=%s LIMIT 1", (feed_id,))
+        return cursor.fetchone() is not None
+
+    def get_feed_url(self, feed_id: str, cursor):
+        cursor.execute("SELECT url FROM rss_feeds WHERE feed_id=%s LIMIT 1", (feed_id,))
+        feed = cursor.fetchone()
+        return feed[0] if feed else None
+
+    def iter_followed_feeds(self, user_id: int, cursor):
+        yield from self._iter_rows(cursor, "SELECT url, feed_id FROM rss_feeds WHERE user_id=%s ORDER BY follow_seq",
+                                   (user_id,))
+
+    def get_user_feed_ids(self, user_id: int, cursor, urls=None, lock=False) -> list:
+        # Rows are locked in feed_id order, so that concurrent requests on several feeds cannot deadlock.
+        suffix = " ORDER BY feed_id FOR UPDATE" if lock else ""
+        if urls is None:
+            cursor.execute("SELECT feed_id FROM rss_feeds WHERE user_id=%s" + suffix, (user_id,))
+        else:
+            cursor.execute("SELECT feed_id FROM rss_feeds WHERE user_id=%s AND url=ANY(%s)" + suffix, (user_id, list(urls)))
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_followed_feed_ids(self, cursor) -> list:
+        cursor.execute("SELECT DISTINCT feed_id FROM rss_feeds")
+        return [row[0] for row in cursor.fetchall()]
+
+    def touch_feed(self, feed_id: str, cursor) -> None:
+        cursor.execute("UPDATE rss_feeds SET updated_date=%s WHERE feed_id=%s", (int(time.time()), feed_id))
+
+    def get_feed_validators(self, feed_id: str, cursor):
+        cursor.execute("SELECT etag, last_modified, digest, fetched_date FROM rss_feed_validators WHERE feed_id=%s",
+                       (feed_id,))
+        return cursor.fetchone()
+
+    def save_feed_validators(self, feed_id: str, validators: dict, cursor) -> None:
+        cursor.execute("""INSERT INTO rss_feed_validators (feed_id, etag, last_modified, digest, fetched_date)
+                          VALUES (%s,%s,%s,%s,%s)
+                          ON CONFLICT(feed_id) DO UPDATE SET etag=excluded.etag, last_modified=excluded.last_modified,
+                          digest=excluded.digest, fetched_date=excluded.fetched_date""",
+                       (feed_id, validators['etag'], validators['last_modified'], validators['digest'], int(time.time())))
+
+    def get_stored_items(self, feed_id: str, item_ids: list, cursor) -> dict:
+        cursor.execute(f"""SELECT feed_item_id, {', '.join(storage.ITEM_COLUMNS)} FROM rss_feedData
+                           WHERE feed_id=%s AND feed_item_id=ANY(%s)""", (feed_id, list(item_ids)))
+        return {row[0]: row[1:] for row in cursor.fetchall()}
+
+    def write_items(self, feed_id: str, new_items: list, updated_items: list, cursor) -> None:
+        # Writers of new items in other processes wait here until this transaction ends, so that item_no is read and
+        # assigned by one of them at a time. item_seq is assigned at insert time, so this also makes it follow commit
+        # order: a reader that sees an item sees every item with a lower item_seq, and the keyset scans of
+        # get_items_after and get_new_item_feeds cannot skip an item that commits late.
+        if new_items:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ITEMS_LOCK,))
+        cursor.execute("SELECT COALESCE(MAX(item_no), 0) FROM rss_feedData WHERE feed_id=%s", (feed_id,))
+        last_item_no = cursor.fetchone()[0]
+        rows = [(feed_id, item_id, last_item_no + number) + tuple(columns) + (raw_entry,)
+                for number, (item_id, columns, raw_entry) in enumerate(new_items, start=1)]
+        if len(rows) >= self.copy_threshold:
+            self._copy_items(rows, cursor)
+        elif rows:
+            psycopg2.extras.execute_values(
+                cursor, f"INSERT INTO rss_feedData ({', '.join(ITEM_INSERT_COLUMNS)}) VALUES %s {ITEM_UPSERT}",
+                rows, template=ITEM_TEMPLATE, page_size=len(rows))
+        if updated_items:
+            psycopg2.extras.execute_values(
+                cursor, f"""UPDATE rss_feedData SET {', '.join(f'{column}=data.{column}' for column in storage.ITEM_COLUMNS)},
+                            raw_entry=data.raw_entry
+                            FROM (VALUES %s) AS data ({', '.join(ITEM_INSERT_COLUMNS)})
+                            WHERE rss_feedData.feed_id=data.feed_id AND rss_feedData.feed_item_id=data.feed_item_id""",
+                [(feed_id, item_id, 0) + tuple(columns) + (raw_entry,) for item_id, columns, raw_entry in updated_items],
+                template=ITEM_TEMPLATE, page_size=len(updated_items))
+
+    def _copy_items(self, rows: list, cursor) -> None:
+        """
+        Loads item rows with COPY into a temporary table, then upserts them in item_no order.
+        """
+        cursor.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS rss_feedData_load (
+                              feed_id TEXT, feed_item_id TEXT, item_no INTEGER, title TEXT, link TEXT, summary TEXT,
+                              published BIGINT, guid TEXT, raw_entry BYTEA) ON COMMIT DELETE ROWS""")
+        data = io.StringIO(''.join('\t'.join(copy_value(value) for value in row) + '\n' for row in rows))
+        cursor.copy_expert(f"COPY rss_feedData_load ({', '.join(ITEM_INSERT_COLUMNS)}) FROM STDIN", data)
+        cursor.execute(f"""INSERT INTO rss_feedData ({', '.join(ITEM_INSERT_COLUMNS)})
+                           SELECT {', '.join(ITEM_INSERT_COLUMNS)} FROM rss_feedData_load ORDER BY item_no
+                           {ITEM_UPSERT}""")
+        cursor.execute("TRUNCATE rss_feedData_load")
+
+    def iter_items(self, user_id: int, url: str, cursor, marked=None, after=None, limit=None, order='seq'):
+        query = storage.items_query(marked, after, order, placeholder='%s')
+        parameters = [user_id, url] + ([after] if after is not None else [])
+        if limit is not None:
+            query += " LIMIT %s"
+            parameters.append(limit)
+        yield from self._iter_rows(cursor, query, parameters)
+
+    def _iter_rows(self, cursor, query: str, parameters):
+        """
+        Generator over the rows of a query, read through a server-side cursor in batches of storage.FETCH_BATCH_SIZE.
+        """
+        with cursor.connection.cursor(name=f'rows_{next(self._cursor_names)}') as rows:
+            rows.itersize = storage.FETCH_BATCH_SIZE
+            rows.execute(query, parameters)
+            yield from rows
+
+    def get_items_after(self, user_id: int, after: int, limit: int, cursor) -> list:
+        cursor.execute(f"""SELECT {storage.ITEM_ROW}
+                           FROM rss_feeds INNER JOIN rss_feedData ON rss_feeds.feed_id=rss_feedData.feed_id
+                           WHERE rss_feeds.user_id=%s AND rss_feedData.item_seq>%s
+                           ORDER BY rss_feedData.item_seq LIMIT %s""", (user_id, after, limit))
+        return cursor.fetchall()
+
+    def get_last_item_seq(self, cursor) -> int:
+        cursor.execute("SELECT COALESCE(MAX(item_seq), 0) FROM rss_feedData")
+        return cursor.fetchone()[0]
+
+    def get_new_item_feeds(self, last_seq: int, cursor) -> list:
+        cursor.execute("""WITH new_items AS MATERIALIZED (SELECT feed_id, item_seq FROM rss_feedData WHERE item_seq>%s)
+                          SELECT feed_id, MAX(item_seq) FROM new_items GROUP BY feed_id""", (last_seq,))
+        return cursor.fetchall()
+
+    def get_read_state(self, user_id: int, feed_id: str, cursor) -> tuple:
+        cursor.execute("SELECT read_hwm, bitmap_base, read_bitmap FROM rss_read_state WHERE user_id=%s AND feed_id=%s",
+                       (user_id, feed_id))
+        state = cursor.fetchone()
+        return (state[0], state[1], bytes(state[2]) if state[2] is not None else None) if state else (0, 0, None)
+
+    def save_read_state(self, user_id: int, feed_id: str, state: tuple, cursor) -> None:
+        cursor.execute("""INSERT INTO rss_read_state (user_id, feed_id, read_hwm, bitmap_base, read_bitmap, updated_date)
+                          VALUES (%s,%s,%s,%s,%s,%s)
+                          ON CONFLICT(user_id, feed_id) DO UPDATE SET read_hwm=excluded.read_hwm,
+                          bitmap_base=excluded.bitmap_base, read_bitmap=excluded.read_bitmap, updated_date=excluded.updated_date""",
+                       (user_id, feed_id) + tuple(state) + (int(time.time()),))
+
+    def get_item_nos(self, feed_id: str, item_ids: list, cursor) -> list:
+        cursor.execute("SELECT item_no FROM rss_feedData WHERE feed_id=%s AND feed_item_id=ANY(%s)", (feed_id, list(item_ids)))
+        return [row[0] for row in cursor.fetchall()]
+
+    def count_items(self, user_id: int, feed_ids: list, is_read: bool, cursor) -> int:
+        cursor.execute(f"""SELECT COUNT(*) FROM rss_feedData LEFT JOIN rss_read_state
+                           ON rss_read_state.user_id=%s AND rss_read_state.feed_id=rss_feedData.feed_id
+                           WHERE rss_feedData.feed_id=ANY(%s) AND {storage.READ_PREDICATE[int(is_read)]}""",
+                       (user_id, list(feed_ids)))
+        return cursor.fetchone()[0]
+
+    def mark_feeds(self, user_id: int, feed_ids: list, is_read: bool, cursor) -> None:
+        if is_read:
+            cursor.execute("""INSERT INTO rss_read_state (user_id, feed_id, read_hwm, bitmap_base, read_bitmap, updated_date)
+                              SELECT %s, feed_id, MAX(item_no), 0, NULL, %s FROM rss_feedData
+                              WHERE feed_id=ANY(%s) GROUP BY feed_id
+                              ON CONFLICT(user_id, feed_id) DO UPDATE SET read_hwm=excluded.read_hwm,
+                              bitmap_base=0, read_bitmap=NULL, updated_date=excluded.updated_date""",
+                           (user_id, int(time.time()), list(feed_ids)))
+        else:
+            cursor.execute("""UPDATE rss_read_state SET read_hwm=0, bitmap_base=0, read_bitmap=NULL, updated_date=%s
+                              WHERE user_id=%s AND feed_id=ANY(%s)""", (int(time.time()), user_id, list(feed_ids)))
+
+
+def copy_value(value) -> str:
+    """
+    Returns a value in the text format of COPY.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        return '\\\\x' + value.hex()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
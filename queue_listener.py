@@ -1,14 +1,50 @@
 import pika
 import json
 import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 import db_service
 import config
+import metrics
+
+
+MESSAGE_SECONDS = metrics.Histogram('rss_queue_message_seconds', "Time from the receipt of a message to its "
+                                   "acknowledgement, by actor and outcome.", ['actor', 'outcome'])
+LAG_SECONDS = metrics.Histogram('rss_queue_lag_seconds', "Time messages spent in the queue before they were received.",
+                                buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 14400))
+IN_FLIGHT = metrics.Gauge('rss_queue_in_flight', "Messages received and not acknowledged yet.")
+
+
+def process_message(body):
+    """
+    Processes one message of the queue. Messages of the import_opml actor import the feeds of an OPML document, see
+    db_service.import_opml. Other messages carry the hash key of a feed, and the method force_feed_update is called,
+    which refreshes the feed once for all its followers. Raises an exception if the message is invalid or the update
+    fails.
+    Args
+    - body: message body.
+    Returns:
+    - The message id.
+    """
+    body_json = json.loads(body)
+    if body_json.get('actor_name') == 'import_opml':
+        response, status = db_service.import_opml(*body_json['args'])
+        if status >= 500:
+            raise RuntimeError(f"Import {body_json['args'][0]} failed: {response.get('message')}")
+        return body_json.get('message_id')
+    hash_key = body_json['args'][0]
+    response, status = db_service.force_feed_update(hash_key)
+    if status >= 500:
+        raise RuntimeError(f"Update of feed {hash_key} failed: {response.get('message')}")
+    return body_json.get('message_id')
 
 
 def on_message(channel, method, properties, body):
     """
-    This method prcesses the incoming messages from a queue. For each message, the user id and feedurl are extracted from the message body and the method 
-    force_feed_update is called. Upon completion of processing each message, as an acknowledgement, the delivery tag of the message is. In case
+    This method prcesses the incoming messages from a queue one at a time, see process_message. Upon completion of processing each message, as an acknowledgement, the delivery tag of the message is. In case
     processing fails, a reject is returned.
     Args
     - channel: a channel object from the pika module that's used to consume messages from the queue.
@@ -16,17 +52,132 @@ def on_message(channel, method, properties, body):
     - body: message body.
     """
     try:
-        body_json = json.loads(body)
-        user_id = body_json['args'][0]
-        feedUrl = body_json['args'][1]
-        db_service.force_feed_update(user_id, feedUrl)
-        logging.info(f"Updated completed for message id:{body_json['message_id']}")
+        message_id = process_message(body)
+        logging.info(f"Updated completed for message id:{message_id}")
         channel.basic_ack(delivery_tag=method.delivery_tag)
     except Exception as e:
         logging.exception("Error processing message: %s", e)
         channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
 
 
+class QueueWorker:
+    """
+    Consumes a queue with up to prefetch unacknowledged messages in flight, processing them concurrently in an executor
+    (a thread or a process pool). pika connections are not thread-safe: messages are received on the thread consuming
+    the connection, and the acks and rejects of finished messages are scheduled back onto it with
+    add_callback_threadsafe. On stop, the consumer is cancelled so that no new messages arrive (messages prefetched but
+    not yet dispatched go back to the queue) and the messages in flight are finished and acknowledged before returning.
+    If the executor cannot take a message anymore, the message is requeued and the worker stops consuming the same way.
+    Args:
+     - connection: A pika.BlockingConnection, or an object with the same interface.
+     - channel: A channel of the connection.
+     - executor: The concurrent.futures executor processing the messages.
+     - prefetch: Maximum number of unacknowledged messages delivered to the worker.
+     - queue: Name of the queue to consume.
+     - handler: Function processing a message body, raising an exception when it fails. It has to be picklable for a
+       process pool.
+    """
+
+    def __init__(self, connection, channel, executor, prefetch: int, queue: str = 'default', handler=process_message):
+        self.connection = connection
+        self.channel = channel
+        self.executor = executor
+        self.prefetch = prefetch
+        self.queue = queue
+        self.handler = handler
+        self.in_flight = 0
+        self.consumer_tag = None
+        self._lock = threading.Lock()
+
+    def on_message(self, channel, method, properties, body):
+        # Timed here rather than in the handler, whose metrics are not collected when it runs in a process pool.
+        started = time.perf_counter()
+        actor = message_actor(body)
+        with self._lock:
+            self.in_flight += 1
+            IN_FLIGHT.set(self.in_flight)
+        try:
+            future = self.executor.submit(self.handler, body)
+        except Exception:
+            # The executor is shut down or broken: stop consuming, and requeue the message for another worker.
+            logging.exception("Could not process message %s", method.delivery_tag)
+            with self._lock:
+                self.in_flight -= 1
+                IN_FLIGHT.set(self.in_flight)
+            if self.consumer_tag is not None:
+                channel.basic_cancel(self.consumer_tag)
+                self.consumer_tag = None
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            MESSAGE_SECONDS.observe(time.perf_counter() - started, actor, 'nack')
+            return
+        future.add_done_callback(lambda future: self.connection.add_callback_threadsafe(
+            partial(self.on_done, method.delivery_tag, future, actor, started)))
+
+    def on_done(self, delivery_tag, future, actor='update_feeds', started=None):
+        """
+        Acknowledges or rejects a processed message, on the connection thread.
+        """
+        try:
+            if future.exception() is None:
+                logging.info(f"Updated completed for message id:{future.result()}")
+                self.channel.basic_ack(delivery_tag=delivery_tag)
+                outcome = 'ack'
+            else:
+                logging.error("Error processing message: %s", future.exception())
+                self.channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+                outcome = 'reject'
+            if started is not None:
+                MESSAGE_SECONDS.observe(time.perf_counter() - started, actor, outcome)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                IN_FLIGHT.set(self.in_flight)
+
+    def run(self) -> None:
+        """
+        Consumes the queue until stop() is called or the process is interrupted (SIGINT / SIGTERM), then drains.
+        """
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        self.consumer_tag = self.channel.basic_consume(queue=self.queue, on_message_callback=self.on_message)
+        try:
+            self.channel.start_consuming()
+        except KeyboardInterrupt:
+            logging.info("Interrupted, finishing %s messages in flight", self.in_flight)
+        finally:
+            self.drain()
+
+    def stop(self) -> None:
+        """
+        Stops consuming, from any thread. run() returns once the messages in flight are acknowledged.
+        """
+        self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+
+    def drain(self) -> None:
+        if self.consumer_tag is not None and self.channel.is_open:
+            self.channel.basic_cancel(self.consumer_tag)
+            self.consumer_tag = None
+        while self.in_flight:
+            self.connection.process_data_events(time_limit=0.1)
+        self.executor.shutdown(wait=True)
+
+
+def message_actor(body) -> str:
+    """
+    Returns the actor of a message, recording how long it waited in the queue in LAG_SECONDS.
+    """
+    try:
+        body_json = json.loads(body)
+    except ValueError:
+        return 'invalid'
+    if body_json.get('message_timestamp'):
+        LAG_SECONDS.observe(max(0.0, time.time() - body_json['message_timestamp'] / 1000))
+    return body_json.get('actor_name', 'update_feeds')
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
 if __name__ == '__main__':
     credentials = pika.PlainCredentials(config.config['mq_user_id'], config.config['mq_password'])
     parameters = pika.ConnectionParameters(host=config.config['mq_host'], port=config.config['mq_port'],
@@ -35,6 +186,14 @@ if __name__ == '__main__':
     connection = pika.BlockingConnection(parameters)
     channel = connection.channel()
 
-    channel.basic_consume(queue='default', on_message_callback=on_message)
+    if config.config['queue_worker_type'] == 'process':
+        executor = ProcessPoolExecutor(max_workers=config.config['queue_workers'])
+    else:
+        executor = ThreadPoolExecutor(max_workers=config.config['queue_workers'])
+    worker = QueueWorker(connection, channel, executor, config.config['queue_prefetch'])
+    if config.config['queue_metrics_port']:
+        metrics.serve(config.config['queue_metrics_port'])
+    signal.signal(signal.SIGTERM, interrupt)
     logging.info("Listening for messages. To exit press CTRL+C")
-    channel.start_consuming()
+    worker.run()
+    connection.close()
@@ -0,0 +1,71 @@
+"""
+Compact storage of the read state of a user's feed.
+
+Instead of a row per (user, feed, item), the read state of a feed is one row per (user, feed) holding:
+ - read_hwm: the read high-water mark, every item with item_no <= read_hwm is read,
+ - read_bitmap / bitmap_base: a bitmap of the items above the high-water mark that are read, bit i of the bitmap
+   standing for item_no bitmap_base + i + 1.
+item_no numbers the items of a feed 1, 2, 3... in the order they were stored. The high-water mark is kept as high as
+possible, so a user who reads a feed in order stores no bitmap at all, and an item is unread exactly when
+item_no > read_hwm and its bit is not set.
+
+Example usage:
+
+read = decode(read_hwm, bitmap_base, read_bitmap)
+read = mark(read, [3, 4], is_read=True)
+read_hwm, bitmap_base, read_bitmap = encode(read)
+"""
+
+
+def decode(read_hwm, bitmap_base, read_bitmap) -> int:
+    """
+    Returns the set of read item numbers as an int, bit item_no - 1 being set for every read item.
+    """
+    read = (1 << (read_hwm or 0)) - 1
+    if read_bitmap:
+        read |= int.from_bytes(read_bitmap, 'little') << (bitmap_base or 0)
+    return read
+
+
+def encode(read: int) -> tuple:
+    """
+    Returns the (read_hwm, bitmap_base, read_bitmap) to store for a set of read item numbers built by decode.
+    """
+    read_hwm = (~read & (read + 1)).bit_length() - 1
+    above = read >> read_hwm
+    if not above:
+        return read_hwm, 0, None
+    bitmap_base = read_hwm - read_hwm % 8
+    above = read >> bitmap_base
+    return read_hwm, bitmap_base, above.to_bytes((above.bit_length() + 7) // 8, 'little')
+
+
+def mark(read: int, item_nos, is_read: bool) -> int:
+    """
+    Marks the given item numbers read or unread in a set of read item numbers built by decode.
+    """
+    mask = 0
+    for item_no in item_nos:
+        mask |= 1 << (item_no - 1)
+    return read | mask if is_read else read & ~mask
+
+
+def mark_up_to(read: int, item_no: int, is_read: bool) -> int:
+    """
+    Marks every item number up to and including item_no read or unread.
+    """
+    mask = (1 << item_no) - 1
+    return read | mask if is_read else read & ~mask
+
+
+def read_bit(read_bitmap, bitmap_base, item_no) -> int:
+    """
+    Returns 1 if item_no is set in the bitmap of read items above the high-water mark. Registered as the SQL function
+    read_bit on every connection, so that read / unread filters are computed in the query.
+    """
+    if not read_bitmap:
+        return 0
+    position = item_no - 1 - (bitmap_base or 0)
+    if position < 0 or position >= len(read_bitmap) * 8:
+        return 0
+    return (read_bitmap[position // 8] >> (position % 8)) & 1
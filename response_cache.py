@@ -0,0 +1,182 @@
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+import config
+
+
+class CacheBackend:
+    """
+    Interface of the storage behind ResponseCache. A shared backend (e.g. memcached or Redis) implements these methods
+    so that every application process sees the same entries and invalidations; MemoryBackend keeps them in the process.
+    """
+
+    def get(self, key: str):
+        """
+        Returns the value stored for key, or None.
+        """
+        raise NotImplementedError
+
+    def set(self, key: str, value, size: int, ttl: float) -> None:
+        """
+        Stores value for key for ttl seconds. size is the approximate number of bytes it takes.
+        """
+        raise NotImplementedError
+
+    def versions(self, tags: list) -> list:
+        """
+        Returns the current version of each tag. A tag that has no version yet gets one that was never used before.
+        """
+        raise NotImplementedError
+
+    def bump(self, tags: list) -> None:
+        """
+        Gives each tag a new version, which makes every entry stored under its previous version unreachable.
+        """
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """
+    In-process backend: an LRU of entries bounded by their total size, and the tag versions.
+    Args:
+     - max_bytes: Maximum total size of the stored entries.
+     - max_tags: Maximum number of tag versions kept. Forgetting a tag is safe, it gets a new version when next used.
+    """
+
+    def __init__(self, max_bytes: int, max_tags: int = 100000):
+        self.max_bytes = max_bytes
+        self.max_tags = max_tags
+        self.size = 0
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, size, value = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, size: int, ttl: float) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + ttl, size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        self.size -= self._entries.pop(key)[1]
+
+    def versions(self, tags: list) -> list:
+        with self._lock:
+            versions = []
+            for tag in tags:
+                if tag not in self._versions:
+                    self._versions[tag] = next(self._counter)
+                self._versions.move_to_end(tag)
+                versions.append(self._versions[tag])
+            while len(self._versions) > self.max_tags:
+                self._versions.popitem(last=False)
+            return versions
+
+    def bump(self, tags: list) -> None:
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = next(self._counter)
+                self._versions.move_to_end(tag)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self.size = 0
+
+
+class ResponseCache:
+    """
+    Caches serialized responses of GET /feeds. An entry is keyed by the request (user, feed URL, marked filter and page)
+    and by the versions of the tags it depends on: the items of the feed, and the follow and read state of the user for
+    the feed. The write paths of db_service bump these tags, so a change makes exactly the affected entries unreachable
+    and they age out of the LRU. Tag versions are read before the response is built, so a response built concurrently
+    with a write is stored under the old versions and never served. Entries also expire after ttl seconds, which bounds
+    how stale they can get when another process (e.g. queue_listener) writes and the backend is not shared.
+    Args:
+     - backend: A CacheBackend.
+     - ttl: Seconds an entry is kept at most.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def tags(user_id: int, feed_id: str) -> list:
+        return [f'feed:{feed_id}', f'user:{user_id}:{feed_id}']
+
+    def key(self, user_id: int, feed_id: str, page: tuple) -> str:
+        versions = self.backend.versions(self.tags(user_id, feed_id))
+        return json.dumps(['feeds', user_id, feed_id, page, versions])
+
+    def get(self, key: str):
+        """
+        Returns the (etag, body, headers) stored for key, or None.
+        """
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key: str, body: bytes, headers: dict) -> tuple:
+        """
+        Stores a serialized response for key and returns it as (etag, body, headers).
+        """
+        entry = (etag(body), body, headers)
+        self.backend.set(key, entry, len(key) + len(body), self.ttl)
+        return entry
+
+    def invalidate_feed(self, feed_id: str) -> None:
+        """
+        Invalidates the responses of every user for a feed whose items changed.
+        """
+        self.backend.bump([f'feed:{feed_id}'])
+
+    def invalidate_user(self, user_id: int, feed_ids: list) -> None:
+        """
+        Invalidates the responses of a user for feeds they followed, or whose items they marked.
+        """
+        self.backend.bump([f'user:{user_id}:{feed_id}' for feed_id in feed_ids])
+
+
+def etag(body: bytes) -> str:
+    return hashlib.sha1(body).hexdigest()
+
+
+cache = ResponseCache(MemoryBackend(config.config['response_cache_max_bytes']), config.config['response_cache_ttl'])
+
+
+def set_backend(backend: CacheBackend) -> None:
+    """
+    Replaces the backend of the response cache, e.g. with a shared one when several processes write to the database.
+    """
+    cache.backend = backend
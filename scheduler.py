@@ -0,0 +1,193 @@
+"""
+Background scheduler that keeps followed feeds fresh.
+
+Feeds are kept in a heap keyed by the time their next refresh is due. The feeds due within "scheduler_batch_window"
+seconds of each other are refreshed together through db_service.refresh_feed_batch, which downloads them concurrently
+on an event loop and fetcher kept for the life of the scheduler, and the interval of each feed adapts to
+how often it publishes: the interval moves towards the observed time between new items, backs off when nothing
+changed, and backs off exponentially while the feed keeps failing. Newly scheduled feeds are spread over
+"scheduler_start_jitter" seconds, so that a restart does not refresh them all at once.
+
+Run with: python scheduler.py
+"""
+import asyncio
+import heapq
+import logging
+import random
+import threading
+import time
+import config
+import db_service
+import fetcher
+
+
+class BatchRefresher:
+    """
+    Refreshes batches of feeds like db_service.refresh_feeds, but on one event loop and fetcher.AsyncFeedFetcher kept
+    across batches, so that connections and parser processes are reused instead of set up again for every batch.
+    Args:
+     - fetch_options: Options of fetcher.AsyncFeedFetcher.
+    """
+
+    def __init__(self, **fetch_options):
+        self.fetch_options = fetch_options
+        self.loop = None
+        self.fetcher = None
+
+    def __call__(self, hash_keys: list) -> dict:
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        if self.fetcher is None:
+            self.fetcher = fetcher.AsyncFeedFetcher(**self.fetch_options)
+        return self.loop.run_until_complete(db_service.refresh_feed_batch(hash_keys, self.fetcher))
+
+    def close(self) -> None:
+        if self.fetcher is not None:
+            self.loop.run_until_complete(self.fetcher.close())
+            self.fetcher = None
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+
+
+class FeedScheduler:
+    """
+    Schedules feed refreshes by next due time.
+    Args:
+     - refresh: Function refreshing a batch of feeds by hash key, returning a dict mapping each hash key to
+       a (response, status) tuple like db_service.refresh_feeds. Defaults to a BatchRefresher, closed by run_forever.
+     - list_feeds: Function returning the hash keys of all followed feeds.
+     - clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, refresh=None, list_feeds=db_service.get_followed_feed_ids, clock=time.time):
+        self.owns_refresh = refresh is None
+        self.refresh = BatchRefresher() if refresh is None else refresh
+        self.list_feeds = list_feeds
+        self.clock = clock
+        self.min_interval = config.config['scheduler_min_interval']
+        self.max_interval = config.config['scheduler_max_interval']
+        self.backoff = config.config['scheduler_backoff']
+        self.start_jitter = config.config['scheduler_start_jitter']
+        self.batch_window = config.config['scheduler_batch_window']
+        self.heap = []
+        self.feeds = {}
+
+    def add_feed(self, hash_key: str, due=None) -> None:
+        """
+        Schedules a feed, due within start_jitter seconds unless a due time is given. Feeds already scheduled are left
+        untouched.
+        """
+        if hash_key in self.feeds:
+            return
+        now = self.clock()
+        if due is None:
+            due = now + random.uniform(0, self.start_jitter)
+        self.feeds[hash_key] = {'interval': self.min_interval, 'failures': 0, 'last_refresh': now, 'due': due}
+        heapq.heappush(self.heap, (self.feeds[hash_key]['due'], hash_key))
+
+    def sync_feeds(self) -> None:
+        """
+        Schedules newly followed feeds and drops feeds nobody follows anymore.
+        """
+        followed = set(self.list_feeds())
+        for hash_key in followed - set(self.feeds):
+            self.add_feed(hash_key)
+        for hash_key in set(self.feeds) - followed:
+            del self.feeds[hash_key]
+
+    def next_due(self):
+        """
+        Returns the time the next feed is due, or None if no feed is scheduled.
+        """
+        while self.heap:
+            due, hash_key = self.heap[0]
+            if hash_key in self.feeds and self.feeds[hash_key]['due'] == due:
+                return due
+            heapq.heappop(self.heap)  # stale entry of a rescheduled or dropped feed
+        return None
+
+    def run_due(self) -> int:
+        """
+        Refreshes every feed that is due in one batch, and reschedules them. Feeds due within batch_window seconds are
+        refreshed early with them, rather than each in a batch of its own.
+        Returns:
+         - The number of feeds refreshed.
+        """
+        due = self.next_due()
+        if due is None or due > self.clock():
+            return 0
+        until = self.clock() + self.batch_window
+        hash_keys = []
+        while True:
+            due = self.next_due()
+            if due is None or due > until:
+                break
+            hash_keys.append(heapq.heappop(self.heap)[1])
+        if not hash_keys:
+            return 0
+        try:
+            responses = self.refresh(hash_keys)
+        except Exception as e:
+            logging.exception("Refresh of %s feeds failed", len(hash_keys))
+            responses = {hash_key: ({"success": False, "error": str(e)}, 500) for hash_key in hash_keys}
+        for hash_key in hash_keys:
+            response, status = responses.get(hash_key, ({"success": False}, 500))
+            if status == 404:
+                self.feeds.pop(hash_key, None)
+                continue
+            self.reschedule(hash_key, response if status == 200 else None)
+        return len(hash_keys)
+
+    def reschedule(self, hash_key: str, response) -> None:
+        """
+        Computes the next interval of a feed from the response of its refresh, None meaning the refresh failed.
+        """
+        feed = self.feeds[hash_key]
+        now = self.clock()
+        if response is None:
+            feed['failures'] += 1
+            delay = min(self.max_interval, feed['interval'] * 2 ** feed['failures'])
+        else:
+            feed['failures'] = 0
+            new_items = response.get('new_items', 0)
+            if new_items:
+                # Aim at roughly one new item per refresh, smoothing the observed time between items.
+                observed = (now - feed['last_refresh']) / new_items
+                feed['interval'] = (feed['interval'] + observed) / 2
+            else:
+                feed['interval'] *= self.backoff
+            feed['interval'] = min(self.max_interval, max(self.min_interval, feed['interval']))
+            feed['last_refresh'] = now
+            delay = feed['interval']
+        feed['due'] = now + delay
+        heapq.heappush(self.heap, (feed['due'], hash_key))
+
+    def run_forever(self, stop_event=None) -> None:
+        """
+        Refreshes feeds as they become due until stop_event is set, re-syncing the followed feeds periodically.
+        """
+        stop_event = stop_event or threading.Event()
+        sync_interval = config.config['scheduler_sync_interval']
+        next_sync = self.clock()
+        try:
+            while not stop_event.is_set():
+                if self.clock() >= next_sync:
+                    self.sync_feeds()
+                    next_sync = self.clock() + sync_interval
+                self.run_due()
+                due = self.next_due()
+                wait = next_sync - self.clock() if due is None else min(due, next_sync) - self.clock()
+                stop_event.wait(max(0.0, wait))
+        finally:
+            if self.owns_refresh:
+                self.refresh.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.info("Scheduler started. To exit press CTRL+C")
+    try:
+        FeedScheduler().run_forever()
+    except KeyboardInterrupt:
+        logging.info("Scheduler stopped")
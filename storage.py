@@ -0,0 +1,404 @@
+"""
+Storage backends of the users, follows, feed items and read state behind db_service.
+
+A Storage implements the queries of db_service for one database engine. Transactions are composed by db_service as
+before: it checks out a (connection, cursor) pair with cursor() or writer(), passes the cursor to any number of storage
+methods, and commits. SQLiteStorage is the default, over db_pool; postgres_storage.PostgresStorage lets several API
+and worker processes share a PostgreSQL database. The backend is chosen with "storage_backend" in config.yaml.
+
+The features built on SQLite specifics (full-text search over FTS5, refresh and import jobs, retention and the item
+archive, see compaction.py) stay on the SQLite database of db_pool whatever the backend.
+
+Example usage:
+
+with storage.backend.cursor() as (db_connection, cursor):
+    password = storage.backend.get_user_password(user_id, cursor)
+"""
+import sqlite3
+import time
+import config
+import db_pool
+
+
+MARKED_STATUS = {'read': 1, 'unread': 0}
+# Whether an item of rss_feedData is read by the user of the joined rss_read_state row, see read_state.py.
+READ_PREDICATE = {
+    1: """(rss_feedData.item_no<=COALESCE(rss_read_state.read_hwm, 0)
+           OR read_bit(rss_read_state.read_bitmap, rss_read_state.bitmap_base, rss_feedData.item_no))""",
+    0: """(rss_feedData.item_no>COALESCE(rss_read_state.read_hwm, 0)
+           AND NOT read_bit(rss_read_state.read_bitmap, rss_read_state.bitmap_base, rss_feedData.item_no))""",
+}
+# Columns of rss_feedData holding the fields of a parsed item, see db_service.serialize_item.
+ITEM_COLUMNS = ('title', 'link', 'summary', 'published', 'guid')
+# Columns of the rows of items_query: the URL of the feed, the id and seq of the item, then ITEM_COLUMNS.
+ITEM_ROW = ("rss_feeds.url, rss_feedData.feed_item_id, rss_feedData.item_seq, "
+            + ', '.join(f'rss_feedData.{column}' for column in ITEM_COLUMNS))
+FETCH_BATCH_SIZE = 500
+
+
+class Storage:
+    """
+    Interface of a storage backend. Methods taking a cursor run in the transaction of its connection and never commit.
+    Items are written as the (feed_item_id, columns, raw_entry) tuples of db_service.diff_feed_items, columns being the
+    values of ITEM_COLUMNS, and read back as rows of the feed URL, the feed_item_id, the item_seq and ITEM_COLUMNS.
+    """
+    name = None
+    # Exception raised when the database cannot be reached or is busy, reported as "Database connection error!".
+    OperationalError = Exception
+
+    def cursor(self):
+        """
+        Context manager checking out a pooled connection, yielding a (connection, cursor) tuple.
+        """
+        raise NotImplementedError
+
+    def writer(self):
+        """
+        Like cursor(), for a transaction that writes. Keep the block short.
+        """
+        raise NotImplementedError
+
+    def connect(self) -> tuple:
+        """
+        Returns a (connection, cursor) tuple of a dedicated connection, not taken from the pool, that the caller closes.
+        """
+        raise NotImplementedError
+
+    # Users
+
+    def get_user_password(self, user_id: int, cursor):
+        """
+        Returns the password hash of a user, None if the user does not exist.
+        """
+        raise NotImplementedError
+
+    def insert_user(self, user_id: int, password: str, cursor) -> bool:
+        """
+        Creates a user with a password hash. Returns False if the user exists already.
+        """
+        raise NotImplementedError
+
+    def update_user_password(self, user_id: int, password: str, cursor) -> None:
+        raise NotImplementedError
+
+    # Follows
+
+    def insert_follow(self, user_id: int, url: str, feed_id: str, cursor) -> bool:
+        """
+        Makes a user follow a feed. Returns False if the user follows it already.
+        """
+        raise NotImplementedError
+
+    def is_feed_followed(self, feed_id: str, cursor) -> bool:
+        raise NotImplementedError
+
+    def get_feed_url(self, feed_id: str, cursor):
+        """
+        Returns the URL of a followed feed, None if nobody follows it.
+        """
+        raise NotImplementedError
+
+    def iter_followed_feeds(self, user_id: int, cursor):
+        """
+        Generator over the (url, feed_id) of the feeds followed by a user, in the order they were followed.
+        """
+        raise NotImplementedError
+
+    def get_user_feed_ids(self, user_id: int, cursor, urls=None, lock=False) -> list:
+        """
+        Returns the feed_ids of the feeds followed by a user, only the ones of the given URLs if urls is given. With lock,
+        the follows are locked until the end of the write transaction, so that the read state of the user and feeds can
+        be read, modified and saved without losing concurrent updates.
+        """
+        raise NotImplementedError
+
+    def get_followed_feed_ids(self, cursor) -> list:
+        """
+        Returns the feed_ids of the feeds followed by at least one user.
+        """
+        raise NotImplementedError
+
+    def touch_feed(self, feed_id: str, cursor) -> None:
+        """
+        Records that the items of a feed changed, for all its followers.
+        """
+        raise NotImplementedError
+
+    def get_feed_validators(self, feed_id: str, cursor):
+        """
+        Returns the (etag, last_modified, digest, fetched_date) stored on the last fetch of a feed, None if never fetched.
+        """
+        raise NotImplementedError
+
+    def save_feed_validators(self, feed_id: str, validators: dict, cursor) -> None:
+        raise NotImplementedError
+
+    # Items
+
+    def get_stored_items(self, feed_id: str, item_ids: list, cursor) -> dict:
+        """
+        Returns the ITEM_COLUMNS values of the stored items of a feed among item_ids, by feed_item_id.
+        """
+        raise NotImplementedError
+
+    def write_items(self, feed_id: str, new_items: list, updated_items: list, cursor) -> None:
+        """
+        Inserts new items, numbered after the last item_no of the feed in the order given, and updates changed items.
+        """
+        raise NotImplementedError
+
+    def iter_items(self, user_id: int, url: str, cursor, marked=None, after=None, limit=None, order='seq'):
+        """
+        Generator over the item rows of a feed followed by a user, newest first, see db_service.iter_feed_items.
+        """
+        raise NotImplementedError
+
+    def get_items_after(self, user_id: int, after: int, limit: int, cursor) -> list:
+        """
+        Returns the item rows stored after the item_seq after in the feeds followed by a user, oldest first.
+        """
+        raise NotImplementedError
+
+    def get_last_item_seq(self, cursor) -> int:
+        raise NotImplementedError
+
+    def get_new_item_feeds(self, last_seq: int, cursor) -> list:
+        """
+        Returns the (feed_id, last item_seq) of the feeds with items stored after the item_seq last_seq.
+        """
+        raise NotImplementedError
+
+    # Read state
+
+    def get_read_state(self, user_id: int, feed_id: str, cursor) -> tuple:
+        """
+        Returns the (read_hwm, bitmap_base, read_bitmap) of a feed for a user, see read_state.py.
+        """
+        raise NotImplementedError
+
+    def save_read_state(self, user_id: int, feed_id: str, state: tuple, cursor) -> None:
+        raise NotImplementedError
+
+    def get_item_nos(self, feed_id: str, item_ids: list, cursor) -> list:
+        """
+        Returns the item_no of the stored items of a feed among item_ids.
+        """
+        raise NotImplementedError
+
+    def count_items(self, user_id: int, feed_ids: list, is_read: bool, cursor) -> int:
+        """
+        Returns the number of items of the feeds that are read, or unread, by a user.
+        """
+        raise NotImplementedError
+
+    def mark_feeds(self, user_id: int, feed_ids: list, is_read: bool, cursor) -> None:
+        """
+        Marks every stored item of the feeds read, or unread, for a user.
+        """
+        raise NotImplementedError
+
+
+def items_query(marked=None, after=None, order='seq', placeholder='?') -> str:
+    """
+    Returns the query of Storage.iter_items, with the parameters user_id, url, then after and limit when given. The SQL
+    is shared by the backends, which only differ by their parameter placeholder.
+    """
+    query = f"""SELECT {ITEM_ROW}
+                FROM rss_feeds INNER JOIN rss_feedData
+                ON rss_feeds.feed_id=rss_feedData.feed_id"""
+    if marked:
+        query += """ LEFT JOIN rss_read_state
+                     ON rss_read_state.user_id=rss_feeds.user_id AND rss_read_state.feed_id=rss_feeds.feed_id"""
+    query += f" WHERE rss_feeds.user_id={placeholder} AND rss_feeds.url={placeholder}"
+    if marked:
+        query += " AND " + READ_PREDICATE[MARKED_STATUS[marked]]
+    if after is not None and order == 'published':
+        query += f""" AND (rss_feedData.published, rss_feedData.item_seq)<
+                     (SELECT published, item_seq FROM rss_feedData WHERE item_seq={placeholder})"""
+    elif after is not None:
+        query += f" AND rss_feedData.item_seq<{placeholder}"
+    if order == 'published':
+        query += " ORDER BY rss_feedData.published DESC, rss_feedData.item_seq DESC"
+    else:
+        query += " ORDER BY rss_feedData.item_seq DESC"
+    return query
+
+
+class SQLiteStorage(Storage):
+    """
+    The SQLite database of db_pool, "db_path" in config.yaml. Writes are serialized by the pool's write lock.
+    """
+    name = 'sqlite'
+    OperationalError = sqlite3.OperationalError
+
+    def cursor(self):
+        return db_pool.cursor()
+
+    def writer(self):
+        return db_pool.writer()
+
+    def connect(self) -> tuple:
+        db_pool.get_pool()
+        db_connection = db_pool.connect(config.config['db_path'])
+        return db_connection, db_connection.cursor()
+
+    def get_user_password(self, user_id: int, cursor):
+        user = cursor.execute("SELECT password FROM user WHERE user_id=?;", (user_id,)).fetchone()
+        return user[0] if user else None
+
+    def insert_user(self, user_id: int, password: str, cursor) -> bool:
+        cursor.execute("INSERT INTO user(user_id, password) VALUES (?,?) ON CONFLICT DO NOTHING;", (user_id, password))
+        return cursor.rowcount == 1
+
+    def update_user_password(self, user_id: int, password: str, cursor) -> None:
+        cursor.execute("UPDATE user SET password=? WHERE user_id=?;", (password, user_id))
+
+    def insert_follow(self, user_id: int, url: str, feed_id: str, cursor) -> bool:
+        cursor.execute("""INSERT INTO rss_feeds(user_id, url, feed_id, updated_date) VALUES (?,?,?,?)
+                          ON CONFLICT DO NOTHING""", (user_id, url, feed_id, int(time.time())))
+        return cursor.rowcount == 1
+
+    def is_feed_followed(self, feed_id: str, cursor) -> bool:
+        return cursor.execute("SELECT 1 FROM rss_feeds WHERE feed_id=? LIMIT 1", (feed_id,)).fetchone() is not None
+
+    def get_feed_url(self, feed_id: str, cursor):
+        feed = cursor.execute("SELECT url FROM rss_feeds WHERE feed_id=? LIMIT 1", (feed_id,)).fetchone()
+        return feed[0] if feed else None
+
+    def iter_followed_feeds(self, user_id: int, cursor):
+        cursor.execute("SELECT url, feed_id FROM rss_feeds WHERE user_id=? ORDER BY rowid", (user_id,))
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def get_user_feed_ids(self, user_id: int, cursor, urls=None, lock=False) -> list:
+        # Writers hold the process-wide write lock, see db_pool.writer.
+        if urls is None:
+            return [row[0] for row in cursor.execute("SELECT feed_id FROM rss_feeds WHERE user_id=?", (user_id,))]
+        placeholders = ','.join('?' * len(urls))
+        return [row[0] for row in cursor.execute(f"SELECT feed_id FROM rss_feeds WHERE user_id=? AND url IN ({placeholders})",
+                                                 [user_id] + list(urls))]
+
+    def get_followed_feed_ids(self, cursor) -> list:
+        return [row[0] for row in cursor.execute("SELECT DISTINCT feed_id FROM rss_feeds")]
+
+    def touch_feed(self, feed_id: str, cursor) -> None:
+        cursor.execute("UPDATE rss_feeds SET updated_date=? WHERE feed_id=?", (int(time.time()), feed_id))
+
+    def get_feed_validators(self, feed_id: str, cursor):
+        return cursor.execute("SELECT etag, last_modified, digest, fetched_date FROM rss_feed_validators WHERE feed_id=?",
+                              (feed_id,)).fetchone()
+
+    def save_feed_validators(self, feed_id: str, validators: dict, cursor) -> None:
+        cursor.execute("""INSERT INTO rss_feed_validators (feed_id, etag, last_modified, digest, fetched_date) VALUES (?,?,?,?,?)
+                          ON CONFLICT(feed_id) DO UPDATE SET etag=excluded.etag, last_modified=excluded.last_modified,
+                          digest=excluded.digest, fetched_date=excluded.fetched_date""",
+                       (feed_id, validators['etag'], validators['last_modified'], validators['digest'], int(time.time())))
+
+    def get_stored_items(self, feed_id: str, item_ids: list, cursor) -> dict:
+        placeholders = ','.join('?' * len(item_ids))
+        return {row[0]: row[1:] for row in cursor.execute(
+            f"SELECT feed_item_id, {', '.join(ITEM_COLUMNS)} FROM rss_feedData WHERE feed_id=? AND feed_item_id IN ({placeholders})",
+            [feed_id] + list(item_ids))}
+
+    def write_items(self, feed_id: str, new_items: list, updated_items: list, cursor) -> None:
+        last_item_no = cursor.execute("SELECT COALESCE(MAX(item_no), 0) FROM rss_feedData WHERE feed_id=?", (feed_id,)).fetchone()[0]
+        # An item stored meanwhile by another writer is updated instead.
+        cursor.executemany(f"""INSERT INTO rss_feedData (feed_id, feed_item_id, marked, item_no, {', '.join(ITEM_COLUMNS)}, raw_entry)
+                               VALUES (?,?,0,?,?,?,?,?,?,?)
+                               ON CONFLICT(feed_id, feed_item_id) DO UPDATE SET
+                               {', '.join(f'{column}=excluded.{column}' for column in ITEM_COLUMNS)}, raw_entry=excluded.raw_entry""",
+                           [(feed_id, item_id, last_item_no + number) + columns + (raw_entry,)
+                            for number, (item_id, columns, raw_entry) in enumerate(new_items, start=1)])
+        cursor.executemany(f"""UPDATE rss_feedData SET {', '.join(f'{column}=?' for column in ITEM_COLUMNS)}, raw_entry=?
+                               WHERE feed_id=? AND feed_item_id=?""",
+                           [columns + (raw_entry, feed_id, item_id) for item_id, columns, raw_entry in updated_items])
+
+    def iter_items(self, user_id: int, url: str, cursor, marked=None, after=None, limit=None, order='seq'):
+        query = items_query(marked, after, order)
+        parameters = [user_id, url] + ([after] if after is not None else [])
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+        cursor.execute(query, parameters)
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def get_items_after(self, user_id: int, after: int, limit: int, cursor) -> list:
+        return cursor.execute(f"""SELECT {ITEM_ROW}
+                                  FROM rss_feeds INNER JOIN rss_feedData ON rss_feeds.feed_id=rss_feedData.feed_id
+                                  WHERE rss_feeds.user_id=? AND rss_feedData.item_seq>?
+                                  ORDER BY rss_feedData.item_seq LIMIT ?""", (user_id, after, limit)).fetchall()
+
+    def get_last_item_seq(self, cursor) -> int:
+        return cursor.execute("SELECT COALESCE(MAX(item_seq), 0) FROM rss_feedData").fetchone()[0]
+
+    def get_new_item_feeds(self, last_seq: int, cursor) -> list:
+        # Materialized, so that the item_seq range drives the query instead of a scan of the feed_id index.
+        return cursor.execute("""WITH new_items AS MATERIALIZED (SELECT feed_id, item_seq FROM rss_feedData WHERE item_seq>?)
+                                 SELECT feed_id, MAX(item_seq) FROM new_items GROUP BY feed_id""", (last_seq,)).fetchall()
+
+    def get_read_state(self, user_id: int, feed_id: str, cursor) -> tuple:
+        state = cursor.execute("SELECT read_hwm, bitmap_base, read_bitmap FROM rss_read_state WHERE user_id=? AND feed_id=?",
+                               (user_id, feed_id)).fetchone()
+        return state or (0, 0, None)
+
+    def save_read_state(self, user_id: int, feed_id: str, state: tuple, cursor) -> None:
+        cursor.execute("""INSERT INTO rss_read_state (user_id, feed_id, read_hwm, bitmap_base, read_bitmap, updated_date)
+                          VALUES (?,?,?,?,?,?)
+                          ON CONFLICT(user_id, feed_id) DO UPDATE SET read_hwm=excluded.read_hwm,
+                          bitmap_base=excluded.bitmap_base, read_bitmap=excluded.read_bitmap, updated_date=excluded.updated_date""",
+                       (user_id, feed_id) + tuple(state) + (int(time.time()),))
+
+    def get_item_nos(self, feed_id: str, item_ids: list, cursor) -> list:
+        placeholders = ','.join('?' * len(item_ids))
+        return [row[0] for row in cursor.execute(f"SELECT item_no FROM rss_feedData WHERE feed_id=? AND feed_item_id IN ({placeholders})",
+                                                 [feed_id] + list(item_ids))]
+
+    def count_items(self, user_id: int, feed_ids: list, is_read: bool, cursor) -> int:
+        placeholders = ','.join('?' * len(feed_ids))
+        return cursor.execute(f"""SELECT COUNT(*) FROM rss_feedData LEFT JOIN rss_read_state
+                                  ON rss_read_state.user_id=? AND rss_read_state.feed_id=rss_feedData.feed_id
+                                  WHERE rss_feedData.feed_id IN ({placeholders}) AND {READ_PREDICATE[int(is_read)]}""",
+                              [user_id] + list(feed_ids)).fetchone()[0]
+
+    def mark_feeds(self, user_id: int, feed_ids: list, is_read: bool, cursor) -> None:
+        placeholders = ','.join('?' * len(feed_ids))
+        if is_read:
+            cursor.execute(f"""INSERT INTO rss_read_state (user_id, feed_id, read_hwm, bitmap_base, read_bitmap, updated_date)
+                               SELECT ?, feed_id, MAX(item_no), 0, NULL, ? FROM rss_feedData
+                               WHERE feed_id IN ({placeholders}) GROUP BY feed_id
+                               ON CONFLICT(user_id, feed_id) DO UPDATE SET read_hwm=excluded.read_hwm,
+                               bitmap_base=0, read_bitmap=NULL, updated_date=excluded.updated_date""",
+                           [user_id, int(time.time())] + list(feed_ids))
+        else:
+            cursor.execute(f"""UPDATE rss_read_state SET read_hwm=0, bitmap_base=0, read_bitmap=NULL, updated_date=?
+                               WHERE user_id=? AND feed_id IN ({placeholders})""",
+                           [int(time.time()), user_id] + list(feed_ids))
+
+
+def create_backend() -> Storage:
+    """
+    Returns the backend configured as "storage_backend": 'sqlite', or 'postgres' for postgres_storage.PostgresStorage,
+    which requires psycopg2.
+    """
+    if config.config['storage_backend'] == 'postgres':
+        import postgres_storage
+        return postgres_storage.PostgresStorage(config.config['postgres_dsn'], config.config['postgres_pool_size'])
+    return SQLiteStorage()
+
+
+backend = create_backend()
+
+
+def set_backend(storage: Storage) -> None:
+    """
+    Replaces the storage backend, e.g. with another database in tests.
+    """
+    global backend
+    backend = storage
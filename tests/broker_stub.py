@@ -0,0 +1,91 @@
+import collections
+import itertools
+import queue
+import threading
+import time
+
+
+class BrokerStub:
+    """
+    In-memory stand-in for a RabbitMQ broker and a pika.BlockingConnection, covering what queue_listener uses. Like pika,
+    message callbacks, acks and add_callback_threadsafe callbacks all run on the thread consuming the connection; an ack,
+    nack or reject sent from any other thread is recorded in errors. At most prefetch_count messages are unacknowledged at once.
+    """
+
+    def __init__(self, messages=()):
+        self.messages = collections.deque(messages)
+        self.acked = []
+        self.rejected = []
+        self.nacked = []
+        self.errors = []
+        self.unacked = {}
+        self.max_unacked = 0
+        self.is_open = True
+        self.prefetch_count = None
+        self.consumer = None
+        self._consuming = False
+        self._thread = None
+        self._callbacks = queue.Queue()
+        self._tags = itertools.count(1)
+
+    # Connection
+    def channel(self):
+        return self
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.put(callback)
+
+    def process_data_events(self, time_limit=0):
+        self._thread = threading.current_thread()
+        self._deliver()
+        deadline = time.monotonic() + time_limit
+        while True:
+            try:
+                callback = self._callbacks.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            callback()
+            self._deliver()
+
+    # Channel
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback):
+        self.consumer = on_message_callback
+        return 'consumer-1'
+
+    def basic_cancel(self, consumer_tag):
+        self.consumer = None
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and self.consumer:
+            self.process_data_events(time_limit=0.01)
+
+    def stop_consuming(self):
+        self._consuming = False
+
+    def basic_ack(self, delivery_tag):
+        self._settle(delivery_tag, self.acked)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self._settle(delivery_tag, self.rejected)
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self._settle(delivery_tag, self.nacked)
+        if requeue:
+            self.messages.appendleft(self.nacked[-1])
+
+    def _settle(self, delivery_tag, settled):
+        if threading.current_thread() is not self._thread:
+            self.errors.append(f"delivery {delivery_tag} settled outside of the connection thread")
+        settled.append(self.unacked.pop(delivery_tag))
+
+    def _deliver(self):
+        while self.consumer and self.messages and len(self.unacked) < (self.prefetch_count or float('inf')):
+            delivery_tag = next(self._tags)
+            body = self.messages.popleft()
+            self.unacked[delivery_tag] = body
+            self.max_unacked = max(self.max_unacked, len(self.unacked))
+            self.consumer(self, collections.namedtuple('Method', 'delivery_tag')(delivery_tag), None, body)
@@ -0,0 +1,119 @@
+import hashlib
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_rss(title, items) -> str:
+    """
+    Returns an RSS 2.0 document with one <item> per (title, link, summary) tuple in items.
+    """
+    entries = ''.join(f"""
+        <item>
+            <title>{item_title}</title>
+            <link>{link}</link>
+            <guid>{link}</guid>
+            <description>{summary}</description>
+            <pubDate>Mon, 06 Mar 2023 10:00:00 GMT</pubDate>
+        </item>""" for item_title, link, summary in items)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+    <channel>
+        <title>{title}</title>
+        <link>http://example.com/</link>
+        <description>{title}</description>{entries}
+    </channel>
+</rss>"""
+
+
+class FeedStub:
+    """
+    A local HTTP server serving canned feeds, used in place of real feeds in tests.
+
+    Feeds are registered per path with set_feed(). Every response carries an ETag and a Last-Modified header, and
+    conditional requests are answered with 304 unless honor_conditional is False. The number of requests per path is
+    recorded in hits, and the number of accepted connections in connections. delay adds a fixed latency in seconds to
+    every response, to simulate remote servers.
+
+    Example usage:
+
+    with FeedStub() as stub:
+        stub.set_feed('/rss', make_rss('Example', [('Title', 'http://example.com/1', 'Summary')]))
+        builder.rss_feeder(stub.url('/rss'))
+    """
+
+    def __init__(self, honor_conditional=True, delay=0.0):
+        self.feeds = {}
+        self.hits = {}
+        self.connections = 0
+        self.honor_conditional = honor_conditional
+        self.delay = delay
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}{path}"
+
+    def set_feed(self, path, document) -> None:
+        body = document.encode('UTF-8')
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        with self._lock:
+            self.feeds[path] = (body, etag, formatdate(usegmt=True))
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                with stub._lock:
+                    stub.connections += 1
+                super().setup()
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.hits[self.path] = stub.hits.get(self.path, 0) + 1
+                    feed = stub.feeds.get(self.path)
+                if stub.delay:
+                    time.sleep(stub.delay)
+                if feed is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body, etag, last_modified = feed
+                if 'If-None-Match' in self.headers:
+                    not_modified = self.headers['If-None-Match'] == etag
+                else:
+                    not_modified = self.headers.get('If-Modified-Since') == last_modified
+                if stub.honor_conditional and not_modified:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/rss+xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -4,6 +4,8 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
 import auth_service
 import config
 import jwt
+import time
+import pytest
 from app_main import app
 
 
@@ -36,3 +38,43 @@ class Test_authservice:
         with app.test_request_context():
             response = self.get_userId()
         assert response == {'success': False, 'message': 'Invalid token'}
+
+    def test_verified_tokens_are_cached(self, monkeypatch):
+        auth_service.token_cache.clear()
+        decodes = []
+        decode = jwt.decode
+        monkeypatch.setattr(jwt, 'decode', lambda *args, **kwargs: decodes.append(1) or decode(*args, **kwargs))
+        token = jwt.encode({'user_id': 102, 'exp': time.time() + 60}, config.config['secret_key'], algorithm='HS256')
+        hits = auth_service.token_cache.hits
+        for _ in range(3):
+            with app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+                assert self.get_userId() == 102
+        assert len(decodes) == 1
+        assert auth_service.token_cache.hits == hits + 2
+
+    def test_cached_tokens_expire(self):
+        cache = auth_service.TokenCache(maxsize=2, ttl=60)
+        cache.put('expired', {'user_id': 1, 'exp': time.time() - 1})
+        assert cache.get('expired') is None
+        for token in ('a', 'b', 'c'):
+            cache.put(token, {'user_id': 1})
+        assert cache.get('a') is None and cache.get('c') == {'user_id': 1}
+
+    def test_malformed_tokens_are_rejected_before_decoding(self, monkeypatch):
+        monkeypatch.setattr(jwt, 'decode', lambda *args, **kwargs: pytest.fail("decoded a malformed token"))
+        rejects = auth_service.token_cache.rejects
+        for header in ('Bearer not-a-token', 'Bearer ' + 'a.' * 3000 + 'a', 'Bearer a.b.c!'):
+            with app.test_request_context(headers={'Authorization': header}):
+                assert self.get_userId() == {'success': False, 'message': 'Invalid token'}
+        assert auth_service.token_cache.rejects == rejects + 3
+
+    def test_login_throttle_sweeps_expired_failures(self, monkeypatch):
+        now = 1000.0
+        monkeypatch.setattr(time, 'time', lambda: now)
+        throttle = auth_service.LoginThrottle(per_user=2, per_ip=2, window=60)
+        for user_id in range(100):
+            throttle.failed(user_id, f'10.0.0.{user_id}')
+        assert len(throttle._failures) == 200
+        now += 61
+        throttle.failed(1000, '10.0.1.1')
+        assert set(throttle._failures) == {('user', 1000), ('ip', '10.0.1.1')}
@@ -2,6 +2,9 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
 import builder
+from feed_stub import FeedStub, make_rss
+
+ITEMS = [('First', 'http://example.com/1', 'One'), ('Second', 'http://example.com/2', 'Two')]
 
 class TestBuilder:
     
@@ -14,9 +17,11 @@ class TestBuilder:
         pass
         
     def test_rss_feeder(cls):
-        hash_key, feeds = builder.rss_feeder('http://www.nu.nl/rss/Algemeen')
-        assert isinstance(hash_key, str)
-        assert isinstance(feeds, list)
+        with FeedStub() as stub:
+            stub.set_feed('/rss', make_rss('Example', ITEMS))
+            hash_key, feeds = builder.rss_feeder(stub.url('/rss'))
+        assert hash_key == builder.generate_hash(stub.url('/rss'))
+        assert isinstance(feeds, list) and len(feeds) == 2
 
         assert all(isinstance(entry, dict) for entry in feeds)
         assert all("title" in entry for entry in feeds)
@@ -28,4 +33,91 @@ class TestBuilder:
         hash_key = builder.generate_hash('http://www.nu.nl/rss/Algemeen')
         assert hash_key == '489dd89f4b0474b26f5247c2fa5257f7'
 
+    def test_conditional_rss_feeder_not_modified(cls):
+        with FeedStub() as stub:
+            stub.set_feed('/rss', make_rss('Example', ITEMS))
+            hash_key, feeds, validators = builder.conditional_rss_feeder(stub.url('/rss'))
+            assert [entry['title'] for entry in feeds] == ['First', 'Second']
+            assert validators['etag'] and validators['last_modified'] and validators['digest']
+
+            hash_key, feeds, new_validators = builder.conditional_rss_feeder(stub.url('/rss'), validators)
+            assert feeds is None
+            assert new_validators == validators
+
+    def test_conditional_rss_feeder_same_digest(cls):
+        with FeedStub(honor_conditional=False) as stub:
+            stub.set_feed('/rss', make_rss('Example', ITEMS))
+            _, _, validators = builder.conditional_rss_feeder(stub.url('/rss'))
+            _, feeds, _ = builder.conditional_rss_feeder(stub.url('/rss'), validators)
+            assert feeds is None
+            assert stub.hits['/rss'] == 2
+
+    def test_conditional_rss_feeder_changed(cls):
+        with FeedStub() as stub:
+            stub.set_feed('/rss', make_rss('Example', ITEMS))
+            _, _, validators = builder.conditional_rss_feeder(stub.url('/rss'))
+            stub.set_feed('/rss', make_rss('Example', ITEMS + [('Third', 'http://example.com/3', 'Three')]))
+            _, feeds, new_validators = builder.conditional_rss_feeder(stub.url('/rss'), validators)
+            assert len(feeds) == 3
+            assert new_validators['digest'] != validators['digest']
+
+    def test_stream_rss_feeder_limits(cls):
+        items = [(f'Item {number}', f'http://example.com/{number}', 'Summary') for number in range(50)]
+        with FeedStub() as stub:
+            stub.set_feed('/rss', make_rss('Example', items))
+            _, entries, validators = builder.stream_rss_feeder(stub.url('/rss'), max_entries=3)
+            assert [entry['title'] for entry in entries] == ['Item 0', 'Item 1', 'Item 2']
+            assert '+:' in validators['digest']
+
+            _, entries, validators = builder.stream_rss_feeder(stub.url('/rss'), max_bytes=2000)
+            assert 0 < len(list(entries)) < 50
+
+            _, entries, validators = builder.stream_rss_feeder(stub.url('/rss'))
+            assert len(list(entries)) == 50
+            assert validators['digest'] == builder.content_digest(make_rss('Example', items).encode())
+            assert builder.stream_rss_feeder(stub.url('/rss'), validators)[1] is None
+
+    def test_stream_rss_feeder_same_digest(cls):
+        items = [(f'Item {number}', f'http://example.com/{number}', 'Summary') for number in range(50)]
+        with FeedStub(honor_conditional=False) as stub:
+            stub.set_feed('/rss', make_rss('Example', items))
+            _, entries, validators = builder.stream_rss_feeder(stub.url('/rss'))
+            assert len(list(entries)) == 50
+            _, entries, new_validators = builder.stream_rss_feeder(stub.url('/rss'), validators)
+            assert entries is None
+            assert new_validators['digest'] == validators['digest']
+
+            # Stopped early, only the part that was read is compared.
+            _, entries, validators = builder.stream_rss_feeder(stub.url('/rss'), max_entries=3)
+            assert len(list(entries)) == 3
+            assert builder.stream_rss_feeder(stub.url('/rss'), validators)[1] is None
+
+            stub.set_feed('/rss', make_rss('Example', [('New', 'http://example.com/new', 'New')] + items))
+            _, entries, _ = builder.stream_rss_feeder(stub.url('/rss'), validators)
+            assert [entry['title'] for entry in entries][:2] == ['New', 'Item 0']
+
+    def test_iter_feed_entries(cls):
+        atom = b"""<?xml version="1.0" encoding="utf-8"?>
+            <feed xmlns="http://www.w3.org/2005/Atom"><title>Example</title>
+            <entry><title>Atom entry</title><link rel="self" href="http://example.com/self"/>
+            <link href="http://example.com/atom"/><id>urn:entry:1</id><updated>2023-03-06T10:00:00Z</updated>
+            <summary type="html">&lt;p&gt;Summary&lt;/p&gt;</summary></entry></feed>"""
+        chunks = [atom[offset:offset + 16] for offset in range(0, len(atom), 16)]
+        assert list(builder.iter_feed_entries(chunks)) == [{'title': 'Atom entry', 'summary': '<p>Summary</p>',
+                                                            'link': 'http://example.com/atom', 'published': '2023-03-06T10:00:00Z',
+                                                            'guid': 'urn:entry:1'}]
+        # Not well-formed XML is left to feedparser.
+        document = make_rss('Example', [('Caf&eacute;', 'http://example.com/1', 'One')]).encode()
+        assert [entry['title'] for entry in builder.iter_feed_entries([document])] == ['Café']
 
+    def test_generate_item_id_description_only(cls):
+        document = b"""<?xml version="1.0"?><rss version="2.0"><channel><title>Example</title>
+            <item><description>Only a description</description></item>
+            <item><description>Another description</description></item></channel></rss>"""
+        entries = list(builder.iter_feed_entries([document]))
+        assert [entry['title'] for entry in entries] == [None, None]
+        # Both parsers agree on missing fields.
+        assert builder.parse_feed(document) == entries
+        item_ids = [builder.generate_item_id(entry) for entry in entries]
+        assert item_ids[0] != item_ids[1]
+        assert builder.generate_item_id({'title': 'Title', 'published': None}) == builder.generate_item_id({'title': 'Title'})
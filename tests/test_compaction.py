@@ -0,0 +1,108 @@
+import sys
+import os
+import pytest
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import archive
+import builder
+import compaction
+import config
+import db_pool
+import db_service
+import response_cache
+from feed_stub import FeedStub, make_rss
+
+ITEMS = [(f'Item {number}', f'http://example.com/{number}', f'Summary {number}') for number in range(10)]
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setitem(config.config, 'db_path', str(tmp_path / 'rss_feeds.db'))
+    monkeypatch.setitem(config.config, 'archive_path', str(tmp_path / 'archive'))
+    monkeypatch.setitem(config.config, 'retention_max_items', 4)
+    monkeypatch.setitem(config.config, 'retention_max_age_days', 0)
+    monkeypatch.setitem(config.config, 'retention_keep_unread', True)
+    response_cache.cache.backend.clear()
+
+
+@pytest.fixture
+def feed(database):
+    with FeedStub() as stub:
+        stub.set_feed('/rss', make_rss('Example', ITEMS))
+        db_service.insert_feeds_to_db(1, stub.url('/rss'))
+        db_service.insert_feeds_to_db(2, stub.url('/rss'))
+        yield stub.url('/rss')
+
+
+def titles(items):
+    return [item['data']['title'] for item in items]
+
+
+class TestArchive:
+
+    def test_append_and_read(self, tmp_path):
+        store = archive.Archive(str(tmp_path), segment_bytes=10)
+        first = store.append([{'feed_id': 'a', 'seq': 1}, {'feed_id': 'b', 'seq': 2}])
+        assert store.append([{'feed_id': 'a', 'seq': 3}]) != first
+        assert store.segments() == ['segment-000001.jsonl.gz', 'segment-000002.jsonl.gz']
+        assert list(store.read(first, 'a')) == [{'feed_id': 'a', 'seq': 1}]
+
+        store.segment_bytes = 10 ** 6
+        store.append([{'feed_id': 'a', 'seq': 4}])
+        assert [item['seq'] for item in store.read(store.segments()[-1])] == [3, 4]
+        with pytest.raises(ValueError):
+            list(store.read('../rss_feeds.db'))
+
+
+@pytest.mark.usefixtures('database')
+class TestCompaction:
+
+    def compact(self):
+        return compaction.compact(archive.Archive(config.config['archive_path']), batch_size=2, pause=0)
+
+    def test_unread_items_are_kept(self, feed):
+        assert self.compact()['deleted'] == 0
+        db_service.mark_items(1, [feed], True)
+        assert self.compact()['deleted'] == 0
+
+        db_service.mark_items(2, [feed], True)
+        stats = self.compact()
+        assert (stats['archived'], stats['deleted'], stats['feeds']) == (6, 6, 1)
+        assert titles(db_service.iter_feed_items(1, feed)) == ['Item 0', 'Item 1', 'Item 2', 'Item 3']
+        assert db_service.search_items(1, 'summary', 20)[0] and not db_service.search_items(1, 'summary 9', 20)[0]
+
+    def test_archived_items_are_readable(self, feed, monkeypatch):
+        monkeypatch.setitem(config.config, 'retention_keep_unread', False)
+        assert self.compact()['deleted'] == 6
+        page, status = db_service.get_archived_items(1, feed, 4)
+        assert status == 200 and titles(page) == ['Item 4', 'Item 5', 'Item 6', 'Item 7']
+        assert titles(db_service.get_archived_items(1, feed, 4, page[-1]['seq'])[0]) == ['Item 8', 'Item 9']
+        assert db_service.get_archived_items(3, feed, 4)[1] == 404
+
+    def test_max_age(self, feed, monkeypatch):
+        monkeypatch.setitem(config.config, 'retention_keep_unread', False)
+        monkeypatch.setitem(config.config, 'retention_max_items', 0)
+        monkeypatch.setitem(config.config, 'retention_max_age_days', 30)
+        # The newest item is kept, see expired_items_predicate.
+        assert self.compact()['deleted'] == 9
+        assert titles(db_service.iter_feed_items(1, feed)) == ['Item 0']
+
+    def test_new_items_after_compaction_are_unread(self, database, monkeypatch):
+        monkeypatch.setitem(config.config, 'retention_max_items', 0)
+        monkeypatch.setitem(config.config, 'retention_max_age_days', 30)
+        with FeedStub() as stub:
+            stub.set_feed('/rss', make_rss('Example', ITEMS[:3]))
+            db_service.insert_feeds_to_db(1, stub.url('/rss'))
+            db_service.mark_items(1, [stub.url('/rss')], True)
+            assert self.compact()['deleted'] == 2
+
+            stub.set_feed('/rss', make_rss('Example', [('New', 'http://example.com/new', 'New')] + ITEMS[:1]))
+            assert db_service.refresh_feed(builder.generate_hash(stub.url('/rss')))[1] == 200
+            assert titles(db_service.iter_feed_items(1, stub.url('/rss'), 'unread')) == ['New']
+
+    def test_incremental_vacuum(self, feed, monkeypatch):
+        monkeypatch.setitem(config.config, 'retention_keep_unread', False)
+        monkeypatch.setitem(config.config, 'retention_max_items', 1)
+        with db_pool.cursor() as (db_connection, cursor):
+            assert cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert compaction.compact(None, pause=0)['free_pages'] == 0
+        assert db_service.get_archived_items(1, feed, 10)[0] == []
@@ -0,0 +1,54 @@
+import sys
+import os
+import sqlite3
+import threading
+import pytest
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import config
+import db_pool
+
+
+class TestDbPool:
+
+    @pytest.fixture
+    def pool(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(config.config, 'db_path', str(tmp_path / 'rss_feeds.db'))
+        monkeypatch.setitem(config.config, 'db_pool_size', 2)
+        monkeypatch.setattr(db_pool, '_pool', None)
+        pool = db_pool.get_pool()
+        pool.timeout = 0.2
+        yield pool
+        pool.close()
+
+    def test_wal_mode_and_connection_reuse(self, pool):
+        with pool.connection() as db_connection:
+            assert db_connection.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+            assert db_connection.execute("PRAGMA synchronous").fetchone()[0] == 1
+            first = db_connection
+        with pool.connection() as db_connection:
+            assert db_connection is first
+
+    def test_readers_do_not_block_behind_writer(self, pool):
+        with pool.writer() as (db_connection, cursor):
+            cursor.execute("INSERT INTO user(user_id, password) VALUES (1, 'secret')")
+            result = []
+
+            def read():
+                with db_pool.cursor() as (_, reader_cursor):
+                    result.append(reader_cursor.execute("SELECT COUNT(*) FROM user").fetchone()[0])
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(timeout=2)
+            assert result == [0]
+            db_connection.commit()
+
+    def test_pool_is_bounded_and_rolls_back_leaked_transactions(self, pool):
+        with pool.cursor() as (db_connection, cursor):
+            cursor.execute("INSERT INTO user(user_id, password) VALUES (1, 'secret')")
+        with pool.connection(), pool.connection():
+            assert pool.in_use == 2
+            with pytest.raises(sqlite3.OperationalError):
+                with pool.connection():
+                    pass
+        with pool.cursor() as (db_connection, cursor):
+            assert cursor.execute("SELECT COUNT(*) FROM user").fetchone()[0] == 0
@@ -1,26 +1,56 @@
 from email import header
+import json
 import jwt
 
 import sys
 import os
+import sqlite3
+import threading
+import time
 import pytest
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
 import db_service
+import db_pool
+import builder
+import auth_service
+import app_main
+import response_cache
+import storage
+import opml
+import password_hasher
+import notifier
 from app_main import app
 import config
+from feed_stub import FeedStub, make_rss
+from dramatiq import Message
+from dramatiq.brokers.stub import StubBroker
 
+ITEMS = [('First', 'http://example.com/1', 'One'), ('Second', 'http://example.com/2', 'Two')]
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setitem(config.config, 'db_path', str(tmp_path / 'rss_feeds.db'))
+    response_cache.cache.backend.clear()
+
+
+@pytest.fixture
+def stub():
+    with FeedStub() as stub:
+        stub.set_feed('/rss', make_rss('Example', ITEMS[:1]))
+        yield stub
+
+
+@pytest.mark.usefixtures('database')
 class Test_dbservice:
 
     @classmethod
     def setup_class(cls):
-        cls.db_connection, cls.cursor = db_service.get_db_cursor()
-
+        pass
 
     @classmethod
     def teardown_class(cls):
-        cls.cursor.close()
-        cls.db_connection.close()
-        
+        pass
 
     @pytest.fixture
     def client(self):
@@ -47,27 +77,502 @@ class Test_dbservice:
         assert response.status_code == 200
         assert response.get_json() == {'message': 'User exists!', 'success': True}
     
-    def test_get_feeds(self, client):
+    def test_get_feeds(self, client, stub):
+        db_service.insert_feeds_to_db(107, stub.url('/rss'))
         token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
-        response = client.get('/feeds', json={'username': 107, 'feedUrl': 'http://www.nu.nl/rss/Algemeen', 'marked':None}, headers = {'Authorization': f'Bearer {token}'})
+        response = client.get('/feeds', query_string={'feedUrl': stub.url('/rss')}, headers = {'Authorization': f'Bearer {token}'})
         print(response.get_json())
         assert response.status_code == 200
         assert isinstance(response.get_json(), list)
         assert all(isinstance(entry, dict) for entry in response.get_json())
+        assert response.get_json()[0]['data']['title'] == 'First'
 
-    def test_add_feeds(self, client):
+    def test_add_feeds(self, client, stub):
         token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
-        response = client.post('/feeds', json={'feedUrl': 'http://www.nu.nl/rss/Algemeen'}, headers = {'Authorization': f'Bearer {token}'})
+        response = client.post('/feeds', json={'feedUrl': stub.url('/rss')}, headers = {'Authorization': f'Bearer {token}'})
         print(response.get_json())
         assert response.status_code == 200
-        assert response.get_json() == {'success': True, 'message': 'Inserted successfully'}
+        assert response.get_json()['message'] == 'Inserted successfully'
+        assert response.get_json()['inserted'] >= 1
 
         token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
-        response = client.post('/feeds', json={'feedUrl': 'http://www.nu.nl/rss/Algemeen'}, headers = {'Authorization': f'Bearer {token}'})
+        response = client.post('/feeds', json={'feedUrl': stub.url('/rss')}, headers = {'Authorization': f'Bearer {token}'})
         print(response.get_json())
         assert response.status_code == 200
         assert response.get_json() == {"success": True, 'message': 'URL already followed by user'}
 
         token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
-        response = client.post('/feeds', json={'feedUrl': 'http://www.nu.nl/rss/Algemeen'})
-        assert response.get_json() == {'message': 'Invalid token', 'success': False}
\ No newline at end of file
+        response = client.post('/feeds', json={'feedUrl': stub.url('/rss')})
+        assert response.get_json() == {'message': 'Invalid token', 'success': False}
+
+
+@pytest.mark.usefixtures('database')
+class TestFeedRefresh:
+
+    def count_unread(self, user_id, url):
+        return len(list(db_service.iter_feed_items(user_id, url, 'unread')))
+
+    def test_follow_shares_fetched_feed(self, stub):
+        assert db_service.insert_feeds_to_db(1, stub.url('/rss'))[1] == 200
+        assert db_service.insert_feeds_to_db(2, stub.url('/rss'))[1] == 200
+        assert stub.hits['/rss'] == 1
+        assert self.count_unread(1, stub.url('/rss')) == self.count_unread(2, stub.url('/rss')) == 1
+
+    def test_refresh_fans_out_new_items(self, stub):
+        db_service.insert_feeds_to_db(1, stub.url('/rss'))
+        db_service.insert_feeds_to_db(2, stub.url('/rss'))
+        hash_key = builder.generate_hash(stub.url('/rss'))
+
+        response, status = db_service.refresh_feed(hash_key)
+        assert status == 200 and response['new_items'] == 0
+
+        stub.set_feed('/rss', make_rss('Example', ITEMS))
+        response, status = db_service.refresh_feed(hash_key)
+        assert status == 200 and response['new_items'] == 1
+        assert stub.hits['/rss'] == 3
+        assert self.count_unread(1, stub.url('/rss')) == self.count_unread(2, stub.url('/rss')) == 2
+
+    def test_refresh_feeds_in_a_batch(self, stub):
+        stub.set_feed('/other', make_rss('Other', ITEMS))
+        db_service.insert_feeds_to_db(1, stub.url('/rss'))
+        db_service.insert_feeds_to_db(1, stub.url('/other'))
+        db_service.insert_feeds_to_db(1, 'http://127.0.0.1:1/down')
+        stub.set_feed('/rss', make_rss('Example', ITEMS))
+        hash_keys = [builder.generate_hash(url) for url in (stub.url('/rss'), stub.url('/other'), 'http://127.0.0.1:1/down')]
+
+        responses = db_service.refresh_feeds(hash_keys + ['missing'], parse_workers=0)
+        assert responses[hash_keys[0]] == ({"success": True, "message": "Update successful!", "new_items": 1,
+                                            "updated_items": 0}, 200)
+        assert responses[hash_keys[1]][0]['message'] == 'Feed not modified.'
+        assert responses[hash_keys[2]][1] == 502 and responses['missing'][1] == 404
+        assert self.count_unread(1, stub.url('/rss')) == 2
+
+    def test_refresh_stops_at_known_items(self, stub, monkeypatch):
+        monkeypatch.setitem(config.config, 'feed_known_streak', 5)
+        items = [(f'Item {number}', f'http://example.com/{number}', 'Summary') for number in range(100)]
+        stub.set_feed('/rss', make_rss('Example', items))
+        db_service.insert_feeds_to_db(1, stub.url('/rss'))
+        assert self.count_unread(1, stub.url('/rss')) == 100
+
+        # Only the start of the feed is diffed: the edit after the run of known items is not seen.
+        items = [('New', 'http://example.com/new', '')] + items[:50] + [('Edited', 'http://example.com/50', '')] + items[51:]
+        stub.set_feed('/rss', make_rss('Example', items))
+        response, status = db_service.refresh_feed(builder.generate_hash(stub.url('/rss')))
+        assert (response['new_items'], response['updated_items']) == (1, 0)
+
+    def test_follow_caps_entries(self, stub, monkeypatch):
+        monkeypatch.setitem(config.config, 'feed_max_entries', 3)
+        stub.set_feed('/rss', make_rss('Example', [(f'Item {number}', f'http://example.com/{number}', '') for number in range(10)]))
+        db_service.insert_feeds_to_db(1, stub.url('/rss'))
+        assert [item['data']['title'] for item in db_service.iter_feed_items(1, stub.url('/rss'))] == ['Item 0', 'Item 1', 'Item 2']
+
+    def test_follow_is_atomic(self, stub, monkeypatch):
+        stub.set_feed('/rss', make_rss('Example', ITEMS))
+        def fail(*args):
+            raise sqlite3.IntegrityError('constraint failed')
+        write_feed_items = db_service.write_feed_items
+        monkeypatch.setattr(db_service, 'write_feed_items', fail)
+        assert db_service.insert_feeds_to_db(1, stub.url('/rss'))[1] == 500
+        assert db_service.get_user_feed(1) == ([], 200)
+
+        monkeypatch.setattr(db_service, 'write_feed_items', write_feed_items)
+        response, status = db_service.insert_feeds_to_db(1, stub.url('/rss'))
+        assert status == 200 and response['inserted'] == 3
+        assert db_service.insert_feeds_to_db(1, stub.url('/rss'))[0]['message'] == 'URL already followed by user'
+        assert db_service.insert_feeds_to_db(2, stub.url('/rss'))[0]['inserted'] == 1
+
+    def test_refresh_all_feeds_fetches_each_feed_once(self, stub):
+        stub.set_feed('/other', make_rss('Other', ITEMS))
+        for user_id in (1, 2, 3):
+            db_service.insert_feeds_to_db(user_id, stub.url('/rss'))
+            db_service.insert_feeds_to_db(user_id, stub.url('/other'))
+        responses = db_service.refresh_all_feeds()
+        assert len(responses) == 2
+        assert stub.hits == {'/rss': 2, '/other': 2}
+
+    def test_refresh_diffs_items_by_identity(self, stub):
+        stub.set_feed('/rss', make_rss('Example', ITEMS))
+        db_service.insert_feeds_to_db(1, stub.url('/rss'))
+        hash_key = builder.generate_hash(stub.url('/rss'))
+        db_connection, cursor = db_service.get_db_cursor()
+        item_ids = dict(cursor.execute("SELECT title, feed_item_id FROM rss_feedData"))
+
+        reordered = [('Third', 'http://example.com/3', 'Three'), ITEMS[1], ('First', 'http://example.com/1', 'Edited')]
+        stub.set_feed('/rss', make_rss('Example', reordered))
+        response, status = db_service.refresh_feed(hash_key)
+        assert (response['new_items'], response['updated_items']) == (1, 1)
+
+        stored = dict(cursor.execute("SELECT feed_item_id, summary FROM rss_feedData"))
+        db_connection.close()
+        assert len(stored) == 3
+        assert set(item_ids.values()) < set(stored)
+        assert stored[builder.generate_item_id({'guid': 'http://example.com/1'})] == 'Edited'
+
+
+@pytest.mark.usefixtures('database')
+class TestFeedPagination:
+
+    @pytest.fixture
+    def client(self, stub):
+        stub.set_feed('/rss', make_rss('Example', [(f'Item {number}', f'http://example.com/{number}', '') for number in range(5)]))
+        db_service.insert_feeds_to_db(107, stub.url('/rss'))
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            yield client
+
+    def get(self, client, stub, **args):
+        token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
+        return client.get('/feeds', query_string=dict(feedUrl=stub.url('/rss'), **args), headers={'Authorization': f'Bearer {token}'})
+
+    def test_keyset_pagination(self, client, stub):
+        response = self.get(client, stub, limit=2)
+        first_page = response.get_json()
+        assert len(first_page) == 2
+        assert response.headers['X-Next-After'] == str(first_page[-1]['seq'])
+
+        titles = [item['data']['title'] for item in first_page]
+        after = response.headers['X-Next-After']
+        while after:
+            response = self.get(client, stub, limit=2, after=after)
+            titles += [item['data']['title'] for item in response.get_json()]
+            after = response.headers.get('X-Next-After')
+        assert titles == [f'Item {number}' for number in range(5)]
+
+    def test_marked_filter_and_invalid_cursor(self, client, stub):
+        assert len(self.get(client, stub, marked='unread').get_json()) == 5
+        assert self.get(client, stub, marked='read').get_json()['success'] is False
+        assert self.get(client, stub, after='abc').status_code == 400
+
+    def test_ndjson_stream(self, client, stub):
+        response = self.get(client, stub, format='ndjson', after=10**9)
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line)['data']['title'] for line in lines] == [f'Item {number}' for number in range(5)]
+
+    def test_ndjson_stream_pages(self, client, stub, monkeypatch):
+        monkeypatch.setattr(storage, 'FETCH_BATCH_SIZE', 2)
+        response = self.get(client, stub, format='ndjson', limit=3)
+        lines = response.response
+        assert json.loads(next(lines))['data']['title'] == 'Item 0'
+        # No connection is held between pages, however slowly the client reads.
+        assert db_pool.get_pool().in_use == 0
+        assert [json.loads(line)['data']['title'] for line in lines] == ['Item 1', 'Item 2']
+        lines = self.get(client, stub, format='ndjson').get_data(as_text=True).splitlines()
+        assert [json.loads(line)['data']['title'] for line in lines] == [f'Item {number}' for number in range(5)]
+
+    def test_order_by_published(self, client, stub):
+        dated = [{'title': f'Dated {day}', 'link': f'http://example.com/dated/{day}', 'summary': '',
+                  'published': f'{day:02d} Mar 2024 10:00:00 GMT', 'guid': None} for day in (3, 1, 2)]
+        with db_pool.writer() as (db_connection, cursor):
+            db_service.upsert_feed_items(builder.generate_hash(stub.url('/rss')), dated, cursor)
+            db_connection.commit()
+        response = self.get(client, stub, order='published', limit=4)
+        assert [item['data']['title'] for item in response.get_json()] == ['Dated 3', 'Dated 2', 'Dated 1', 'Item 0']
+        assert response.get_json()[0]['data']['published'] == 'Sun, 03 Mar 2024 10:00:00 GMT'
+        response = self.get(client, stub, order='published', after=response.headers['X-Next-After'])
+        assert [item['data']['title'] for item in response.get_json()] == [f'Item {number}' for number in range(1, 5)]
+        assert self.get(client, stub, order='title').status_code == 400
+
+    def test_pages_are_cached_and_revalidated(self, client, stub):
+        response = self.get(client, stub, marked='unread')
+        etag = response.headers['ETag']
+        hits = response_cache.cache.hits
+        assert self.get(client, stub, marked='unread').get_json() == response.get_json()
+        assert response_cache.cache.hits == hits + 1
+
+        token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
+        not_modified = client.get('/feeds', query_string={'feedUrl': stub.url('/rss'), 'marked': 'unread'},
+                                  headers={'Authorization': f'Bearer {token}', 'If-None-Match': etag})
+        assert not_modified.status_code == 304 and not_modified.headers['ETag'] == etag
+
+        # Marking an item and refreshing the feed each invalidate the cached page.
+        db_service.mark_read(107, stub.url('/rss'), [response.get_json()[0]['id']])
+        response = self.get(client, stub, marked='unread')
+        assert len(response.get_json()) == 4 and response.headers['ETag'] != etag
+        stub.set_feed('/rss', make_rss('Example', [(f'Item {number}', f'http://example.com/{number}', '') for number in range(6)]))
+        db_service.refresh_feed(builder.generate_hash(stub.url('/rss')))
+        assert len(self.get(client, stub, marked='unread').get_json()) == 5
+
+
+@pytest.mark.usefixtures('database')
+class TestMarkRead:
+
+    @pytest.fixture
+    def client(self, stub):
+        for path in ('/rss', '/other'):
+            stub.set_feed(path, make_rss(path, [(f'Item {number}', f'http://example.com{path}/{number}', '') for number in range(4)]))
+            db_service.insert_feeds_to_db(107, stub.url(path))
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            yield client
+
+    def put(self, client, path, **body):
+        token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
+        return client.put(path, json=body, headers={'Authorization': f'Bearer {token}'})
+
+    def unread_titles(self, url):
+        return [item['data']['title'] for item in db_service.iter_feed_items(107, url, 'unread')]
+
+    def test_mark_item_ids_and_up_to(self, client, stub):
+        items = list(db_service.iter_feed_items(107, stub.url('/rss')))
+        response = self.put(client, '/markread', feedUrl=stub.url('/rss'), itemId=f"{items[0]['id']},{items[3]['id']}")
+        assert response.get_json()['marked'] == 2
+        assert self.unread_titles(stub.url('/rss')) == ['Item 1', 'Item 2']
+
+        # Items are listed newest first: up to Item 2 covers Item 2 and the older Item 3.
+        response = self.put(client, '/markread', feedUrl=stub.url('/rss'), upTo=items[2]['id'])
+        assert response.get_json()['marked'] == 1
+        assert self.unread_titles(stub.url('/rss')) == ['Item 1']
+
+    def test_mark_feeds_read_and_unread(self, client, stub):
+        urls = [stub.url('/rss'), stub.url('/other')]
+        assert self.put(client, '/markread', feedUrls=urls).get_json()['marked'] == 8
+        assert self.unread_titles(urls[0]) == self.unread_titles(urls[1]) == []
+        assert self.put(client, '/markunread', feedUrl=urls[1]).get_json()['marked'] == 4
+        assert len(self.unread_titles(urls[1])) == 4
+
+    def test_mark_unknown_feed(self, client, stub):
+        assert self.put(client, '/markread', feedUrls=[stub.url('/rss'), stub.url('/missing')]).status_code == 404
+        assert self.put(client, '/markread', itemId='1').status_code == 400
+
+
+@pytest.mark.usefixtures('database')
+class TestLogin:
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        monkeypatch.setattr(auth_service, 'login_throttle', auth_service.LoginThrottle(per_user=2, per_ip=4, window=60))
+        monkeypatch.setattr(app_main, 'login_throttle', auth_service.login_throttle)
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            yield client
+
+    def stored_hash(self, user_id):
+        with db_pool.cursor() as (db_connection, cursor):
+            return cursor.execute("SELECT password FROM user WHERE user_id=?;", (user_id,)).fetchone()[0]
+
+    def test_login_rehashes_when_the_cost_changes(self, client, monkeypatch):
+        monkeypatch.setitem(config.config, 'password_hash_method', 'pbkdf2:sha256:1000')
+        client.post('/user', json={'username': 11, 'password': 'secret'})
+        assert self.stored_hash(11).startswith('pbkdf2:sha256:1000$')
+
+        monkeypatch.setitem(config.config, 'password_hash_method', 'pbkdf2:sha256:2000')
+        assert client.post('/login', json={'username': 11, 'password': 'secret'}).status_code == 200
+        assert self.stored_hash(11).startswith('pbkdf2:sha256:2000$')
+        assert client.post('/login', json={'username': 11, 'password': 'secret'}).status_code == 200
+
+    def test_login_holds_no_connection_while_hashing(self, client, monkeypatch):
+        monkeypatch.setitem(config.config, 'password_hash_method', 'pbkdf2:sha256:1000')
+        client.post('/user', json={'username': 15, 'password': 'secret'})
+        hasher = password_hasher.get_hasher()
+        in_use = []
+        check = hasher.check
+        def recording_check(*args):
+            in_use.append(db_pool.get_pool().in_use)
+            return check(*args)
+        monkeypatch.setattr(hasher, 'check', recording_check)
+        assert client.post('/login', json={'username': 15, 'password': 'secret'}).status_code == 200
+        assert in_use == [0]
+
+    def test_failed_logins_are_throttled(self, client, monkeypatch):
+        monkeypatch.setitem(config.config, 'password_hash_method', 'pbkdf2:sha256:1000')
+        client.post('/user', json={'username': 12, 'password': 'secret'})
+        assert client.post('/login', json={'username': 12, 'password': 'wrong'}).status_code == 401
+        assert client.post('/login', json={'username': 12, 'password': 'secret'}).status_code == 200
+        for _ in range(2):
+            assert client.post('/login', json={'username': 12, 'password': 'wrong'}).status_code == 401
+        response = client.post('/login', json={'username': 12, 'password': 'secret'})
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 0
+
+        # The address has one failure left before it is throttled for every user.
+        assert client.post('/login', json={'username': 13, 'password': 'secret'}).status_code == 404
+        assert client.post('/login', json={'username': 14, 'password': 'secret'}).status_code == 429
+
+
+@pytest.mark.usefixtures('database')
+class TestSearch:
+
+    @pytest.fixture
+    def client(self, stub):
+        stub.set_feed('/rss', make_rss('News', [('Rust compiler released', 'http://example.com/rust', 'A new compiler'),
+                                                ('Python news', 'http://example.com/python', 'Compilers and interpreters'),
+                                                ('Weather', 'http://example.com/weather', 'Sunny')]))
+        stub.set_feed('/other', make_rss('Other', [('Compiler of another user', 'http://example.com/other', '')]))
+        db_service.insert_feeds_to_db(107, stub.url('/rss'))
+        db_service.insert_feeds_to_db(108, stub.url('/other'))
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            yield client
+
+    def search(self, client, **args):
+        token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
+        return client.get('/search', query_string=args, headers={'Authorization': f'Bearer {token}'})
+
+    def test_search_ranks_and_pages_followed_items(self, client, stub):
+        response = self.search(client, q='compil*', limit=1)
+        first_page = response.get_json()
+        assert [item['data']['title'] for item in first_page] == ['Rust compiler released']
+        assert first_page[0]['snippet'] == 'Rust <b>compiler</b> released'
+
+        response = self.search(client, q='compil*', limit=1, after=response.headers['X-Next-After'])
+        assert [item['data']['title'] for item in response.get_json()] == ['Python news']
+        response = self.search(client, q='compil*', limit=1, after=response.headers['X-Next-After'])
+        assert response.get_json() == []
+
+    def test_search_follows_updates_and_rejects_bad_input(self, client, stub):
+        stub.set_feed('/rss', make_rss('News', [('Weather', 'http://example.com/weather', 'Rain "expected" (later')]))
+        db_service.refresh_feed(builder.generate_hash(stub.url('/rss')))
+        assert [item['data']['title'] for item in self.search(client, q='"rain" (').get_json()] == ['Weather']
+        assert self.search(client, q='sunny').get_json() == []
+        assert self.search(client, q='').status_code == 400
+        assert self.search(client, q='rain', after='nonsense').status_code == 400
+
+
+@pytest.mark.usefixtures('database')
+class TestRefreshJobs:
+
+    @pytest.fixture
+    def client(self, stub, monkeypatch):
+        broker = StubBroker()
+        broker.declare_actor(app_main.update_feeds)
+        monkeypatch.setattr(app_main.update_feeds, 'broker', broker)
+        db_service.insert_feeds_to_db(107, stub.url('/rss'))
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            yield client
+
+    def put(self, client, url, user_id=107):
+        token = jwt.encode({'user_id': user_id}, config.config['secret_key'], algorithm='HS256')
+        return client.put('/update', json={'feedUrl': url}, headers={'Authorization': f'Bearer {token}'})
+
+    def test_pending_refresh_absorbs_requests(self, client, stub, monkeypatch):
+        monkeypatch.setitem(config.config, 'refresh_min_interval', 0)
+        task_ids = {self.put(client, stub.url('/rss')).get_json()['task_id'] for _ in range(5)}
+        assert len(task_ids) == 1
+        assert app_main.update_feeds.broker.queues['default'].qsize() == 1
+        assert self.put(client, stub.url('/missing')).status_code == 404
+
+        db_service.force_feed_update(builder.generate_hash(stub.url('/rss')))
+        assert self.put(client, stub.url('/rss')).get_json()['task_id'] not in task_ids
+
+    def test_recently_fetched_feed_is_not_refreshed(self, client, stub, monkeypatch):
+        monkeypatch.setitem(config.config, 'refresh_min_interval', 60)
+        response = self.put(client, stub.url('/rss'))
+        assert response.status_code == 429
+        assert 0 < int(response.headers['Retry-After']) <= 60
+
+    def test_only_followers_refresh_a_feed(self, client, stub, monkeypatch):
+        monkeypatch.setitem(config.config, 'refresh_min_interval', 0)
+        assert self.put(client, stub.url('/rss'), user_id=2).status_code == 404
+        assert app_main.update_feeds.broker.queues['default'].qsize() == 0
+        assert self.put(client, stub.url('/rss')).status_code == 200
+
+
+@pytest.mark.usefixtures('database')
+class TestOPML:
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        broker = StubBroker()
+        broker.declare_actor(app_main.import_opml)
+        monkeypatch.setattr(app_main.import_opml, 'broker', broker)
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            yield client
+
+    def headers(self):
+        return {'Authorization': f"Bearer {jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')}"}
+
+    def test_import_and_export(self, client, stub):
+        stub.set_feed('/other', make_rss('Other', ITEMS))
+        db_service.insert_feeds_to_db(2, stub.url('/rss'))
+        urls = [stub.url('/rss'), stub.url('/other'), stub.url('/missing'), stub.url('/rss')]
+        document = ''.join(opml.iter_opml([(url, None) for url in urls], 'Subscriptions'))
+        response = client.post('/opml/import', data=document, content_type='text/x-opml', headers=self.headers())
+        assert response.status_code == 200 and response.get_json()['total'] == 3
+        job_id = response.get_json()['job_id']
+        assert client.get(f'/opml/import/{job_id}', headers=self.headers()).get_json()['status'] == 'queued'
+
+        message = Message.decode(app_main.import_opml.broker.queues['default'].get())
+        db_service.import_opml(*message.args, parse_workers=0)
+        progress = client.get(f'/opml/import/{job_id}', headers=self.headers()).get_json()
+        assert (progress['status'], progress['done'], progress['failed']) == ('done', 3, 1)
+        assert progress['errors'][0]['url'] == stub.url('/missing')
+        assert stub.hits['/rss'] == 1
+        assert len(list(db_service.iter_feed_items(107, stub.url('/other')))) == 2
+
+        response = client.get('/opml/export', headers=self.headers())
+        assert response.mimetype == 'text/x-opml'
+        assert [url for url, _ in opml.parse_opml(response.data)] == urls[:3]
+        assert client.get(f'/opml/import/{job_id}', headers={}).get_json()['success'] is False
+
+    def test_import_rejects_bad_documents(self, client, monkeypatch):
+        assert client.post('/opml/import', data='<opml>', headers=self.headers()).status_code == 400
+        assert client.post('/opml/import', data='<opml><body/></opml>', headers=self.headers()).status_code == 400
+        monkeypatch.setitem(config.config, 'opml_max_bytes', 10)
+        assert client.post('/opml/import', data='<opml><body/></opml>', headers=self.headers()).status_code == 413
+        assert client.get('/opml/import/unknown', headers=self.headers()).status_code == 404
+
+
+@pytest.mark.usefixtures('database')
+class TestMetrics:
+
+    def test_metrics_endpoint(self, stub):
+        app.config['TESTING'] = True
+        token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
+        with app.test_client() as client:
+            client.post('/feeds', json={'feedUrl': stub.url('/rss')}, headers={'Authorization': f'Bearer {token}'})
+            response = client.get('/metrics')
+        assert response.status_code == 200 and response.mimetype == 'text/plain'
+        text = response.get_data(as_text=True)
+        assert 'rss_db_statement_seconds_count{statement="insert rss_feeds"}' in text
+        assert 'rss_feed_fetch_seconds_count{source="stream"}' in text
+        assert 'rss_http_request_seconds_count{endpoint="add_feed",method="POST",status="200"}' in text
+        assert 'rss_db_pool_connections{state="size"}' in text
+        assert 'rss_jobs_pending{kind="refresh"} 0' in text
+
+
+@pytest.mark.usefixtures('database')
+class TestStream:
+
+    @pytest.fixture
+    def client(self, stub):
+        db_service.insert_feeds_to_db(107, stub.url('/rss'))
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            yield client
+        # The watcher started by the stream would go on polling the default database.
+        notifier.notifier.stop()
+
+    def headers(self, **headers):
+        token = jwt.encode({'user_id': 107}, config.config['secret_key'], algorithm='HS256')
+        return dict(headers, Authorization=f'Bearer {token}')
+
+    def test_long_poll_returns_new_items(self, client, stub):
+        response = client.get('/feeds/stream', query_string={'mode': 'poll', 'timeout': 0.1}, headers=self.headers())
+        assert response.get_json() == []
+        after = response.headers['X-Next-After']
+
+        stub.set_feed('/rss', make_rss('Example', ITEMS))
+        threading.Timer(0.2, db_service.refresh_feed, [builder.generate_hash(stub.url('/rss'))]).start()
+        started = time.monotonic()
+        response = client.get('/feeds/stream', query_string={'mode': 'poll', 'after': after, 'timeout': 10},
+                              headers=self.headers())
+        assert time.monotonic() - started < 5
+        assert [item['data']['title'] for item in response.get_json()] == ['Second']
+        assert response.headers['X-Next-After'] == str(response.get_json()[0]['seq'])
+
+    def test_event_stream_resumes_from_last_event_id(self, client, stub):
+        stub.set_feed('/rss', make_rss('Example', ITEMS))
+        db_service.refresh_feed(builder.generate_hash(stub.url('/rss')))
+        response = client.get('/feeds/stream', headers=self.headers(**{'Accept': 'text/event-stream', 'Last-Event-ID': '0'}),
+                              buffered=False)
+        assert response.mimetype == 'text/event-stream'
+        events = (event.decode() for event in response.response)
+        assert next(events).startswith('retry:')
+        first, second = next(events), next(events)
+        assert first.startswith('id: ') and '"First"' in first and '"Second"' in second
+        assert notifier.notifier.count == 1
+        response.close()
+        assert notifier.notifier.count == 0
@@ -0,0 +1,113 @@
+import sys
+import os
+import asyncio
+import gzip
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import builder
+import fetcher
+from feed_stub import FeedStub, make_rss
+
+ITEMS = [('First', 'http://example.com/1', 'One'), ('Second', 'http://example.com/2', 'Two')]
+
+
+class TestFetcher:
+
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_fetch_feeds(self):
+        with FeedStub() as stub:
+            urls = [stub.url(f'/rss/{number}') for number in range(20)]
+            for number in range(20):
+                stub.set_feed(f'/rss/{number}', make_rss(f'Feed {number}', ITEMS))
+            results = dict(fetcher.fetch_feeds(urls + [stub.url('/missing')], per_host_limit=3, parse_workers=2))
+        assert set(results) == {builder.generate_hash(url) for url in urls}
+        assert all([entry['title'] for entry in feed_data] == ['First', 'Second'] for feed_data in results.values())
+        assert stub.connections <= 3
+
+    def test_fetch_many_conditional(self):
+        async def run(urls, validators):
+            async with fetcher.AsyncFeedFetcher(parse_workers=0) as feed_fetcher:
+                results = [result async for result in feed_fetcher.fetch_many(urls, validators)]
+                return results, feed_fetcher
+
+        with FeedStub() as stub:
+            stub.set_feed('/rss', make_rss('Example', ITEMS))
+            url = stub.url('/rss')
+            results, feed_fetcher = asyncio.run(run([url], {}))
+            assert len(results[0][1]) == 2
+            validators = feed_fetcher.validators[builder.generate_hash(url)]
+
+            results, _ = asyncio.run(run([url], {url: validators}))
+        assert results == [(builder.generate_hash(url), None)]
+
+    def test_fetch_timeout(self):
+        async def run():
+            async with fetcher.AsyncFeedFetcher(timeout=0.2, parse_workers=0) as feed_fetcher:
+                server = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', 0)
+                port = server.sockets[0].getsockname()[1]
+                results = [result async for result in feed_fetcher.fetch_many([f'http://127.0.0.1:{port}/rss'])]
+                server.close()
+                return results, feed_fetcher.errors
+
+        results, errors = asyncio.run(run())
+        assert results == []
+        assert isinstance(list(errors.values())[0], fetcher.FetchError)
+
+    def test_fetch_queued_per_host(self):
+        # 4 rounds of 0.3 s on one host: only the time after a request got its host slot counts against the timeout.
+        with FeedStub(delay=0.3) as stub:
+            urls = [stub.url(f'/rss/{number}') for number in range(8)]
+            for number in range(8):
+                stub.set_feed(f'/rss/{number}', make_rss(f'Feed {number}', ITEMS))
+            results = dict(fetcher.fetch_feeds(urls, per_host_limit=2, timeout=1, parse_workers=0))
+        assert set(results) == {builder.generate_hash(url) for url in urls}
+
+    def test_read_response_caps_body(self):
+        async def read(response):
+            reader = asyncio.StreamReader()
+            reader.feed_data(response)
+            reader.feed_eof()
+            return await fetcher.read_response(reader, 1000)
+
+        bomb = gzip.compress(b'0' * 10 ** 7)
+        responses = [
+            b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Length: %d\r\n\r\n" % len(bomb) + bomb,
+            b"HTTP/1.1 200 OK\r\nContent-Length: 5000\r\n\r\n" + b'x' * 5000,
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n800\r\n" + b'x' * 2048 + b"\r\n0\r\n\r\n",
+            b"HTTP/1.0 200 OK\r\n\r\n" + b'x' * 5000,
+        ]
+        for response in responses:
+            status, headers, body, reusable = asyncio.run(read(response))
+            assert len(body) == 1000 and not reusable
+        small = b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Length: %d\r\n\r\n" % len(gzip.compress(b'feed'))
+        assert asyncio.run(read(small + gzip.compress(b'feed')))[2:] == (b'feed', True)
+
+    def test_fetch_many_keeps_going_after_bad_feeds(self, monkeypatch):
+        async def truncated(reader, writer):
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n<rss>")
+            await writer.drain()
+            writer.close()
+
+        async def run(urls):
+            server = await asyncio.start_server(truncated, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            async with fetcher.AsyncFeedFetcher(parse_workers=0) as feed_fetcher:
+                results = dict([result async for result in feed_fetcher.fetch_many(urls + [f'http://127.0.0.1:{port}/rss'])])
+            server.close()
+            return results, feed_fetcher.errors
+
+        parse_feed = builder.parse_feed
+        monkeypatch.setattr(builder, 'parse_feed', lambda body: parse_feed(body) if b'Example' in body else 1 / 0)
+        with FeedStub() as stub:
+            stub.set_feed('/rss', make_rss('Example', ITEMS))
+            stub.set_feed('/broken', make_rss('Broken', ITEMS))
+            results, errors = asyncio.run(run([stub.url('/rss'), stub.url('/broken')]))
+        assert list(results) == [builder.generate_hash(stub.url('/rss'))]
+        assert len(errors) == 2 and all(isinstance(error, (EOFError, fetcher.FetchError)) for error in errors.values())
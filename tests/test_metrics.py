@@ -0,0 +1,71 @@
+import sys
+import os
+import urllib.request
+import pytest
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import config
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    # Rendering calls every registered gauge, some of which query the database.
+    monkeypatch.setitem(config.config, 'db_path', str(tmp_path / 'rss_feeds.db'))
+
+
+class TestMetrics:
+
+    def teardown_method(self):
+        for name in [name for name in metrics.registry if name.startswith('test_')]:
+            del metrics.registry[name]
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram('test_seconds', "Test.", ['stage'], buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, 'fetch')
+        histogram.observe(0.5, 'parse')
+        assert histogram.snapshot()[('fetch',)] == [2, 3, 4, 2.65]
+        lines = histogram.render()
+        assert 'test_seconds_bucket{stage="fetch",le="0.1"} 2' in lines
+        assert 'test_seconds_bucket{stage="fetch",le="+Inf"} 4' in lines
+        assert 'test_seconds_count{stage="parse"} 1' in lines
+        assert 'test_seconds_sum{stage="fetch"} 2.65' in lines
+
+    def test_timer(self):
+        histogram = metrics.Histogram('test_timer_seconds', "Test.", ['kind'])
+
+        @histogram.time('decorated')
+        def function(value):
+            if value is None:
+                raise ValueError
+            return value
+
+        assert function(1) == 1
+        try:
+            function(None)
+        except ValueError:
+            pass
+        with histogram.time('block'):
+            pass
+        series = histogram.snapshot()
+        assert series[('decorated',)][-2] == 2 and series[('block',)][-2] == 1
+
+    def test_gauges(self):
+        gauge = metrics.Gauge('test_connections', "Test.", ['state'], lambda: {('in_use',): 2, ('size',): 8})
+        metrics.Gauge('test_broken', "Test.", function=lambda: 1 / 0)
+        value = metrics.Gauge('test_value', 'Test "quoted".')
+        value.set(1.5)
+        text = metrics.render()
+        assert 'test_connections{state="in_use"} 2\n' in text
+        assert 'test_value 1.5\n' in text
+        assert 'test_broken' not in text
+
+    def test_serve(self):
+        metrics.Gauge('test_served', "Test.").set(3)
+        server = metrics.serve(0, '127.0.0.1')
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+                assert 'test_served 3' in response.read().decode()
+        finally:
+            server.shutdown()
@@ -0,0 +1,129 @@
+import sys
+import os
+import sqlite3
+import pytest
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import db_pool
+import migrations
+import storage
+
+SQLITE = storage.SQLiteStorage()
+# The hot queries, run through the backend methods that issue them, so that the plans checked are the ones of the real SQL.
+HOT_QUERIES = {
+    'iter_items': lambda cursor: list(SQLITE.iter_items(1, 'url', cursor, after=100, limit=10)),
+    'iter_items_by_published': lambda cursor: list(SQLITE.iter_items(1, 'url', cursor, after=100, limit=10, order='published')),
+    'iter_items_unread': lambda cursor: list(SQLITE.iter_items(1, 'url', cursor, marked='unread', limit=10)),
+    'iter_items_read': lambda cursor: list(SQLITE.iter_items(1, 'url', cursor, marked='read', limit=10)),
+    'get_user_feed_ids': lambda cursor: SQLITE.get_user_feed_ids(1, cursor),
+    'get_user_feed_ids_of_urls': lambda cursor: SQLITE.get_user_feed_ids(1, cursor, ['url', 'other']),
+    'get_read_state': lambda cursor: SQLITE.get_read_state(1, 'f', cursor),
+    'get_item_nos': lambda cursor: SQLITE.get_item_nos('f', ['i'], cursor),
+    'mark_feeds_read': lambda cursor: SQLITE.mark_feeds(1, ['f', 'g'], True, cursor),
+    'count_items': lambda cursor: SQLITE.count_items(1, ['f', 'g'], False, cursor),
+    'is_feed_followed': lambda cursor: SQLITE.is_feed_followed('f', cursor),
+    'get_feed_url': lambda cursor: SQLITE.get_feed_url('f', cursor),
+    'get_stored_items': lambda cursor: SQLITE.get_stored_items('f', ['i', 'j'], cursor),
+    'write_items': lambda cursor: SQLITE.write_items('f', [('i', ('t', 'l', 's', 0, 'g'), b'')],
+                                                     [('j', ('t', 'l', 's', 0, 'g'), b'')], cursor),
+    'get_new_item_feeds': lambda cursor: SQLITE.get_new_item_feeds(100, cursor),
+}
+
+
+class PlanCursor:
+    """
+    A cursor recording the EXPLAIN QUERY PLAN of each statement before running it.
+    """
+
+    def __init__(self, db_connection):
+        self.db_connection = db_connection
+        self.cursor = db_connection.cursor()
+        self.plans = []
+
+    def explain(self, query: str, parameters) -> None:
+        self.plans.append([row[3] for row in self.db_connection.execute(f"EXPLAIN QUERY PLAN {query}", parameters)])
+
+    def execute(self, query: str, parameters=()):
+        self.explain(query, parameters)
+        self.cursor.execute(query, parameters)
+        return self
+
+    def executemany(self, query: str, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        if seq_of_parameters:
+            self.explain(query, seq_of_parameters[0])
+        self.cursor.executemany(query, seq_of_parameters)
+        return self
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def slow_steps(plan: list) -> list:
+    """
+    Returns the steps of a query plan scanning or sorting a table. Scanning and grouping the rows that a subquery has
+    already narrowed down with an index is fine.
+    """
+    narrowed = {step.split()[1] for step in plan if step.startswith('MATERIALIZE')}
+    return [step for step in plan
+            if step.startswith('SCAN') and step.split()[1] not in narrowed
+            or 'TEMP B-TREE' in step and not (narrowed and step == 'USE TEMP B-TREE FOR GROUP BY')]
+
+
+class TestMigrations:
+
+    @pytest.fixture
+    def db_connection(self, tmp_path):
+        db_connection = sqlite3.connect(str(tmp_path / 'rss_feeds.db'))
+        yield db_connection
+        db_connection.close()
+
+    def test_migrate_is_idempotent(self, db_connection):
+        latest = migrations.available_migrations()[-1][0]
+        assert migrations.migrate(db_connection)[-1] == latest
+        assert migrations.migrate(db_connection) == []
+        assert migrations.current_version(db_connection) == latest
+
+    def test_migrate_converts_dates_to_epoch(self, db_connection):
+        migrations.migrate(db_connection, target=1)
+        db_connection.execute("INSERT INTO rss_feeds VALUES (1, 'url', 'f', '2023-03-06 10:00:00')")
+        db_connection.commit()
+        migrations.migrate(db_connection)
+        assert db_connection.execute("SELECT updated_date FROM rss_feeds").fetchone()[0] == 1678096800
+
+    @pytest.mark.parametrize('name', HOT_QUERIES)
+    def test_hot_queries_use_indexes(self, tmp_path, name):
+        # The connection of the application, which registers the functions the queries use.
+        db_connection = db_pool.connect(str(tmp_path / 'rss_feeds.db'))
+        try:
+            migrations.migrate(db_connection)
+            cursor = PlanCursor(db_connection)
+            HOT_QUERIES[name](cursor)
+        finally:
+            db_connection.close()
+        assert cursor.plans
+        for plan in cursor.plans:
+            assert not slow_steps(plan), plan
+
+    def test_migrate_compacts_marked_status(self, db_connection):
+        migrations.migrate(db_connection, target=3)
+        db_connection.executemany("INSERT INTO rss_feedData (feed_id, feed_item_id, feed_item) VALUES ('f', ?, '{}')",
+                                  [(str(number),) for number in range(1, 6)])
+        db_connection.executemany("INSERT INTO rss_marked_status VALUES (1, ?, ?, 'f', 0)",
+                                  [('1', 1), ('2', 1), ('3', 0), ('4', 1), ('5', 0)])
+        db_connection.commit()
+        migrations.migrate(db_connection)
+        assert db_connection.execute("SELECT read_hwm, read_bitmap FROM rss_read_state").fetchone() == (2, b'\x0b')
+        assert db_connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='rss_marked_status'").fetchone()[0] == 0
+
+    def test_migrate_splits_feed_items_into_columns(self, db_connection):
+        migrations.migrate(db_connection, target=4)
+        db_connection.execute("""INSERT INTO rss_feedData (feed_id, feed_item_id, feed_item, item_no) VALUES ('f', 'i', ?, 1)""",
+                              ('{"title": "T", "summary": "S", "link": "L", "published": "Mon, 06 Mar 2023 10:00:00 GMT", "guid": null}',))
+        db_connection.commit()
+        migrations.migrate(db_connection)
+        assert db_connection.execute("SELECT title, link, summary, published, guid FROM rss_feedData").fetchone() == \
+            ('T', 'L', 'S', 1678096800, None)
+        assert 'feed_item' not in [column[1] for column in db_connection.execute("PRAGMA table_info(rss_feedData)")]
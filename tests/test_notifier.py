@@ -0,0 +1,51 @@
+import sys
+import os
+import threading
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import notifier
+
+
+class TestFeedNotifier:
+
+    def test_publish_wakes_subscriptions_of_the_feed(self):
+        feeds = notifier.FeedNotifier()
+        first, second = feeds.subscribe(['a', 'b']), feeds.subscribe(['b'])
+        assert not first.wait(0)
+        feeds.publish('a')
+        assert first.wait(0) and not second.wait(0)
+        # A publication before the wait is not lost.
+        feeds.publish('b')
+        assert first.wait(0) and second.wait(0)
+        assert not first.wait(0)
+
+        threading.Timer(0.05, feeds.publish, ['b']).start()
+        started = time.monotonic()
+        assert second.wait(5) and time.monotonic() - started < 1
+
+    def test_unsubscribe(self):
+        feeds = notifier.FeedNotifier()
+        with feeds.subscribe(['a']) as subscription:
+            assert feeds.count == 1
+        subscription.close()
+        assert feeds.count == 0 and feeds._subscriptions == {}
+        feeds.publish('a')
+        assert not subscription.wait(0)
+
+    def test_watcher_publishes_polled_feeds(self):
+        feeds = notifier.FeedNotifier()
+        subscription = feeds.subscribe(['a'])
+        calls = []
+
+        def poll(last_seq):
+            calls.append(last_seq)
+            return (['a'], 2) if last_seq == 1 else ([], last_seq or 1)
+
+        feeds.watch(poll, 0.01)
+        feeds.watch(poll, 0.01)
+        assert subscription.wait(5)
+        assert calls[:2] == [None, 1]
+        feeds.stop()
+        polled = len(calls)
+        time.sleep(0.05)
+        assert len(calls) == polled
@@ -0,0 +1,32 @@
+import sys
+import os
+import pytest
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import opml
+
+DOCUMENT = b"""<?xml version="1.0"?>
+<opml version="1.0"><head><title>Subscriptions</title></head><body>
+<outline text="News">
+  <outline text="Example" type="rss" xmlUrl="http://example.com/rss"/>
+  <outline text="Other" type="rss" xmlUrl=" http://example.com/other "/>
+</outline>
+<outline title="Example again" type="rss" xmlUrl="http://example.com/rss"/>
+<outline text="Not a feed" htmlUrl="http://example.com/"/>
+</body></opml>"""
+
+
+class TestOPML:
+
+    def test_parse_opml(self):
+        assert opml.parse_opml(DOCUMENT) == [('http://example.com/rss', 'Example'), ('http://example.com/other', 'Other')]
+
+    def test_parse_opml_rejects_other_documents(self):
+        with pytest.raises(opml.OPMLError):
+            opml.parse_opml(b'<opml><body>')
+        with pytest.raises(opml.OPMLError):
+            opml.parse_opml(b'<rss><channel/></rss>')
+
+    def test_iter_opml_round_trip(self):
+        feeds = [('http://example.com/rss?a=1&b=2', 'Tom & "Jerry"'), ('http://example.com/other', None)]
+        document = ''.join(opml.iter_opml(feeds, 'Feeds <1>')).encode()
+        assert opml.parse_opml(document) == [feeds[0], ('http://example.com/other', 'http://example.com/other')]
@@ -0,0 +1,31 @@
+import sys
+import os
+import threading
+import pytest
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import password_hasher
+
+
+class TestPasswordHasher:
+
+    def test_hash_check_and_rehash(self):
+        hasher = password_hasher.PasswordHasher(workers=2, max_queue=4, method='pbkdf2:sha256:1000')
+        pwhash = hasher.hash('secret')
+        assert hasher.check(pwhash, 'secret') and not hasher.check(pwhash, 'wrong')
+        assert not hasher.needs_rehash(pwhash)
+        assert password_hasher.PasswordHasher(1, 1, 'pbkdf2:sha256:2000').needs_rehash(pwhash)
+        hasher.shutdown()
+
+    def test_full_queue_is_refused(self):
+        hasher = password_hasher.PasswordHasher(workers=1, max_queue=1, method='pbkdf2:sha256:1000')
+        started, release = threading.Event(), threading.Event()
+        blocked = threading.Thread(target=hasher._run, args=(lambda: started.set() or release.wait(),))
+        blocked.start()
+        started.wait()
+        with pytest.raises(password_hasher.HasherBusy):
+            hasher.hash('secret')
+        release.set()
+        blocked.join()
+        assert hasher.pending == 0
+        assert hasher.check(hasher.hash('secret'), 'secret')
+        hasher.shutdown()
@@ -0,0 +1,70 @@
+import sys
+import os
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import queue_listener
+from broker_stub import BrokerStub
+
+
+def message(number):
+    return json.dumps({'message_id': number, 'args': [f'feed{number}']}).encode()
+
+
+class TestQueueWorker:
+
+    def worker(self, broker, handler, workers=4, prefetch=4):
+        return queue_listener.QueueWorker(broker, broker.channel(), ThreadPoolExecutor(max_workers=workers), prefetch,
+                                          handler=handler)
+
+    def test_messages_are_processed_concurrently(self):
+        broker = BrokerStub([message(number) for number in range(8)])
+
+        def handler(body):
+            time.sleep(0.2)
+            if json.loads(body)['message_id'] == 3:
+                raise ValueError("invalid feed")
+            return json.loads(body)['message_id']
+
+        def stop_when_done():
+            while len(broker.acked) + len(broker.rejected) < 8:
+                time.sleep(0.01)
+            worker.stop()
+
+        worker = self.worker(broker, handler)
+        threading.Thread(target=stop_when_done, daemon=True).start()
+        started = time.monotonic()
+        worker.run()
+        assert time.monotonic() - started < 1.2
+        assert broker.max_unacked == 4
+        assert len(broker.acked) == 7 and broker.rejected == [message(3)]
+        assert broker.errors == []
+
+    def test_stop_drains_messages_in_flight(self):
+        broker = BrokerStub([message(number) for number in range(10)])
+        release = threading.Event()
+        worker = self.worker(broker, lambda body: release.wait(5), workers=2, prefetch=3)
+        consumer = threading.Thread(target=worker.run)
+        consumer.start()
+        while len(broker.unacked) < 3:
+            time.sleep(0.01)
+        worker.stop()
+        time.sleep(0.1)
+        assert consumer.is_alive()
+        release.set()
+        consumer.join(5)
+
+        assert not consumer.is_alive()
+        assert len(broker.acked) == 3 and len(broker.messages) == 7
+        assert broker.errors == []
+
+    def test_message_is_requeued_when_it_cannot_be_submitted(self):
+        broker = BrokerStub([message(number) for number in range(3)])
+        worker = self.worker(broker, lambda body: None)
+        worker.executor.shutdown()
+        worker.run()
+        assert broker.nacked == [message(0)] and list(broker.messages) == [message(number) for number in range(3)]
+        assert worker.in_flight == 0 and broker.consumer is None
+        assert broker.errors == []
@@ -0,0 +1,28 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import read_state
+
+
+class TestReadState:
+
+    def test_reading_in_order_only_moves_the_high_water_mark(self):
+        read = read_state.mark_up_to(0, 5000, True)
+        assert read_state.encode(read) == (5000, 0, None)
+        read = read_state.mark(read, [5001, 5002], True)
+        assert read_state.encode(read) == (5002, 0, None)
+
+    def test_items_read_out_of_order_go_to_the_bitmap(self):
+        read = read_state.mark(read_state.mark_up_to(0, 20, True), [23, 30], True)
+        read_hwm, bitmap_base, read_bitmap = read_state.encode(read)
+        assert (read_hwm, bitmap_base, len(read_bitmap)) == (20, 16, 2)
+        assert read_state.decode(read_hwm, bitmap_base, read_bitmap) == read
+        assert [item_no for item_no in range(1, 32) if item_no > read_hwm and
+                read_state.read_bit(read_bitmap, bitmap_base, item_no)] == [23, 30]
+
+    def test_mark_unread_lowers_the_high_water_mark(self):
+        read = read_state.mark(read_state.mark_up_to(0, 10, True), [4], False)
+        read_hwm, bitmap_base, read_bitmap = read_state.encode(read)
+        assert read_hwm == 3
+        assert [item_no for item_no in range(1, 12) if item_no <= read_hwm or
+                read_state.read_bit(read_bitmap, bitmap_base, item_no)] == [1, 2, 3, 5, 6, 7, 8, 9, 10]
@@ -0,0 +1,28 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import response_cache
+
+
+class TestResponseCache:
+
+    def test_memory_backend_evicts_least_recently_used(self):
+        backend = response_cache.MemoryBackend(max_bytes=10)
+        backend.set('a', 'A', 4, ttl=60)
+        backend.set('b', 'B', 4, ttl=60)
+        assert backend.get('a') == 'A'
+        backend.set('c', 'C', 4, ttl=60)
+        assert (backend.get('a'), backend.get('b'), backend.get('c')) == ('A', None, 'C')
+        assert backend.size == 8
+        backend.set('expired', 'E', 1, ttl=0)
+        assert backend.get('expired') is None
+
+    def test_invalidation_is_precise(self):
+        cache = response_cache.ResponseCache(response_cache.MemoryBackend(max_bytes=1000), ttl=60)
+        keys = {(user_id, feed_id): cache.key(user_id, feed_id, ['unread', 100, None]) for user_id in (1, 2) for feed_id in ('x', 'y')}
+        for key in keys.values():
+            cache.set(key, b'[]', {})
+
+        cache.invalidate_user(1, ['x'])
+        cache.invalidate_feed('y')
+        assert {user_feed for user_feed in keys if cache.get(cache.key(*user_feed, ['unread', 100, None]))} == {(2, 'x')}
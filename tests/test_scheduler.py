@@ -0,0 +1,107 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import asyncio
+import config
+import db_service
+from scheduler import BatchRefresher, FeedScheduler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduler:
+
+    def setup_method(self):
+        self.clock = Clock()
+        self.responses = {}
+        self.refreshed = []
+        self.scheduler = FeedScheduler(refresh=self.refresh, list_feeds=lambda: ['a', 'b'], clock=self.clock)
+        self.scheduler.start_jitter = 0
+        self.scheduler.sync_feeds()
+
+    def refresh(self, hash_keys):
+        self.refreshed.append(hash_keys)
+        return {hash_key: self.responses.get(hash_key, ({"success": True, "new_items": 0}, 200)) for hash_key in hash_keys}
+
+    def test_due_feeds_are_refreshed_in_order(self):
+        self.scheduler.add_feed('c', due=self.clock.now - 10)
+        self.scheduler.add_feed('d', due=self.clock.now + 10)
+        assert self.scheduler.run_due() == 3
+        assert self.refreshed == [['c', 'a', 'b']]
+        self.clock.now += 10
+        assert self.scheduler.run_due() == 1
+        assert self.scheduler.run_due() == 0
+
+    def test_interval_adapts_to_publish_rate(self):
+        min_interval = config.config['scheduler_min_interval']
+        self.scheduler.run_due()
+        assert self.scheduler.feeds['a']['interval'] == min_interval * config.config['scheduler_backoff']
+
+        self.responses['a'] = ({"success": True, "new_items": 1}, 200)
+        self.clock.now = self.scheduler.next_due()
+        self.scheduler.run_due()
+        assert self.scheduler.feeds['a']['interval'] == min_interval * config.config['scheduler_backoff']
+
+        self.responses['a'] = ({"success": True, "new_items": 0}, 200)
+        for _ in range(50):
+            self.clock.now = self.scheduler.feeds['a']['due']
+            self.scheduler.run_due()
+        assert self.scheduler.feeds['a']['interval'] == config.config['scheduler_max_interval']
+
+    def test_failures_back_off_and_unfollowed_feeds_are_dropped(self):
+        self.responses['a'] = ({"success": False}, 502)
+        self.responses['b'] = ({"success": False}, 404)
+        self.scheduler.run_due()
+        first_delay = self.scheduler.feeds['a']['due'] - self.clock.now
+        self.clock.now = self.scheduler.feeds['a']['due']
+        self.scheduler.run_due()
+        assert self.scheduler.feeds['a']['due'] - self.clock.now == 2 * first_delay
+        assert 'b' not in self.scheduler.feeds
+
+    def test_initial_due_times_are_jittered(self):
+        scheduler = FeedScheduler(refresh=self.refresh, list_feeds=lambda: [str(number) for number in range(100)], clock=self.clock)
+        scheduler.sync_feeds()
+        due = [feed['due'] for feed in scheduler.feeds.values()]
+        assert all(self.clock.now <= time <= self.clock.now + scheduler.start_jitter for time in due)
+        assert len(set(due)) > 1
+
+    def test_failed_batch_backs_off(self):
+        def fail(hash_keys):
+            raise OSError('network down')
+        self.scheduler.refresh = fail
+        assert self.scheduler.run_due() == 2
+        assert all(feed['failures'] == 1 for feed in self.scheduler.feeds.values())
+
+    def test_feeds_due_within_the_window_are_batched(self):
+        self.scheduler.batch_window = 5
+        self.scheduler.add_feed('c', due=self.clock.now + 4)
+        self.scheduler.add_feed('d', due=self.clock.now + 6)
+        assert self.scheduler.run_due() == 3
+        assert self.refreshed == [['a', 'b', 'c']]
+        self.clock.now += 4
+        assert self.scheduler.run_due() == 0
+        self.clock.now += 2
+        assert self.scheduler.run_due() == 1
+
+
+def test_batch_refresher_reuses_loop_and_fetcher(monkeypatch):
+    batches = []
+
+    async def refresh_feed_batch(hash_keys, feed_fetcher):
+        batches.append((asyncio.get_running_loop(), feed_fetcher))
+        return {hash_key: ({"success": True}, 200) for hash_key in hash_keys}
+
+    monkeypatch.setattr(db_service, 'refresh_feed_batch', refresh_feed_batch)
+    refresher = BatchRefresher(parse_workers=0)
+    assert refresher(['a']) == {'a': ({"success": True}, 200)}
+    refresher(['b'])
+    loop = refresher.loop
+    refresher.close()
+    assert batches == [(loop, batches[0][1])] * 2
+    assert loop.is_closed() and refresher.fetcher is None
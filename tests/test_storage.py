@@ -0,0 +1,156 @@
+import sys
+import os
+import threading
+import uuid
+import pytest
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+import builder
+import config
+import db_service
+import read_state
+import response_cache
+import storage
+from feed_stub import FeedStub, make_rss
+
+# PostgreSQL database to run the tests against as well, e.g. "host=127.0.0.1 user=postgres password=rss", see
+# postgres_storage.py. Each test runs in a schema of its own, dropped afterwards.
+POSTGRES_DSN = os.environ.get('RSS_TEST_POSTGRES_DSN')
+ITEMS = [(f'Item {number}', f'http://example.com/{number}', f'Summary {number}') for number in range(10)]
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def backend(request, tmp_path, monkeypatch):
+    monkeypatch.setitem(config.config, 'db_path', str(tmp_path / 'rss_feeds.db'))
+    monkeypatch.setitem(config.config, 'password_hash_method', 'pbkdf2:sha256:1000')
+    response_cache.cache.backend.clear()
+    if request.param == 'sqlite':
+        backend = storage.SQLiteStorage()
+    else:
+        if not POSTGRES_DSN:
+            pytest.skip("RSS_TEST_POSTGRES_DSN is not set")
+        psycopg2 = pytest.importorskip('psycopg2')
+        import postgres_storage
+        schema = f'rss_test_{uuid.uuid4().hex}'
+        db_connection = psycopg2.connect(POSTGRES_DSN)
+        db_connection.autocommit = True
+        db_connection.cursor().execute(f'CREATE SCHEMA {schema}')
+        backend = postgres_storage.PostgresStorage(f"{POSTGRES_DSN} options='-c search_path={schema}'", 4)
+    monkeypatch.setattr(storage, 'backend', backend)
+    yield backend
+    if request.param == 'postgres':
+        backend.close()
+        db_connection.cursor().execute(f'DROP SCHEMA {schema} CASCADE')
+        db_connection.close()
+
+
+@pytest.fixture
+def feed(backend):
+    with FeedStub() as stub:
+        stub.set_feed('/rss', make_rss('Example', ITEMS))
+        yield stub
+
+
+def titles(items):
+    return [item['data']['title'] for item in items]
+
+
+class TestStorage:
+
+    def test_users(self, backend):
+        assert db_service.create_user(1, 'secret') == ({"success": True, "message": "User has been created!"}, 200)
+        assert db_service.create_user(1, 'other')[0]['message'] == 'User exists!'
+        assert db_service.token_validator(1, 'secret')[1] == 200
+        assert db_service.token_validator(1, 'other')[1] == 401
+        assert db_service.token_validator(2, 'secret')[1] == 404
+
+    def test_follow_and_list(self, backend, feed):
+        url = feed.url('/rss')
+        assert db_service.insert_feeds_to_db(1, url)[0]['inserted'] == 11
+        assert db_service.insert_feeds_to_db(1, url)[0]['message'] == 'URL already followed by user'
+        assert db_service.insert_feeds_to_db(2, url)[0]['inserted'] == 1
+        assert list(db_service.iter_followed_feeds(1)) == [(url, None)]
+        assert db_service.get_followed_feed_ids() == [builder.generate_hash(url)]
+
+        items = list(db_service.iter_feed_items(1, url))
+        assert titles(items) == [f'Item {number}' for number in range(10)]
+        assert titles(db_service.iter_feed_items(1, url, after=items[3]['seq'], limit=2)) == ['Item 4', 'Item 5']
+        assert titles(db_service.get_items_after(2, items[2]['seq'], 2)) == ['Item 1', 'Item 0']
+        assert list(db_service.iter_feed_items(3, url)) == []
+
+    def test_read_state(self, backend, feed):
+        url = feed.url('/rss')
+        db_service.insert_feeds_to_db(1, url)
+        db_service.insert_feeds_to_db(2, url)
+        items = {item['data']['title']: item['id'] for item in db_service.iter_feed_items(1, url)}
+
+        assert db_service.mark_items(1, [url], True, up_to=items['Item 7'])[0]['marked'] == 3
+        assert db_service.mark_read(1, url, [items['Item 2'], items['Item 0']])[0]['marked'] == 2
+        assert titles(db_service.iter_feed_items(1, url, 'read')) == ['Item 0', 'Item 2', 'Item 7', 'Item 8', 'Item 9']
+        assert titles(db_service.iter_feed_items(1, url, 'unread')) == ['Item 1', 'Item 3', 'Item 4', 'Item 5', 'Item 6']
+        assert db_service.mark_items(1, [url], False, item_ids=[items['Item 8']])[0]['marked'] == 1
+        assert 'Item 8' in titles(db_service.iter_feed_items(1, url, 'unread'))
+
+        assert db_service.mark_items(1, [url], True)[0]['marked'] == 6
+        assert list(db_service.iter_feed_items(1, url, 'unread')) == []
+        assert len(list(db_service.iter_feed_items(2, url, 'unread'))) == 10
+        assert db_service.mark_items(1, [url], False)[0]['marked'] == 10
+        assert db_service.mark_items(1, ['http://example.com/none'], True)[1] == 404
+
+    def test_concurrent_marks(self, backend, feed):
+        url = feed.url('/rss')
+        hash_key = builder.generate_hash(url)
+        db_service.insert_feeds_to_db(1, url)
+        items = {item['data']['title']: item['id'] for item in db_service.iter_feed_items(1, url)}
+
+        with backend.writer() as (db_connection, cursor):
+            backend.get_user_feed_ids(1, cursor, [url], lock=True)
+            read = read_state.decode(*backend.get_read_state(1, hash_key, cursor))
+            item_nos = backend.get_item_nos(hash_key, [items['Item 0']], cursor)
+            backend.save_read_state(1, hash_key, read_state.encode(read_state.mark(read, item_nos, True)), cursor)
+            # Waits for this transaction, instead of reading the read state before it commits.
+            other = threading.Thread(target=db_service.mark_read, args=(1, url, [items['Item 1']]))
+            other.start()
+            other.join(0.5)
+            db_connection.commit()
+        other.join()
+        assert titles(db_service.iter_feed_items(1, url, 'read')) == ['Item 0', 'Item 1']
+
+    def test_refresh(self, backend, feed, monkeypatch):
+        url = feed.url('/rss')
+        hash_key = builder.generate_hash(url)
+        db_service.insert_feeds_to_db(1, url)
+        assert db_service.refresh_feed(hash_key)[0]['message'] == 'Feed not modified.'
+
+        # Above the threshold, PostgreSQL loads the new items with COPY.
+        monkeypatch.setattr(backend, 'copy_threshold', 5, raising=False)
+        changed = [(title + ' changed', link, summary) for title, link, summary in ITEMS[:1]]
+        added = [(f'New {number}', f'http://example.com/new/{number}', 'Tab\tand\nnew line\\') for number in range(6)]
+        feed.set_feed('/rss', make_rss('Example', added + changed + ITEMS[1:]))
+        response = db_service.refresh_feed(hash_key)[0]
+        assert (response['new_items'], response['updated_items']) == (6, 1)
+
+        items = list(db_service.iter_feed_items(1, url, limit=8))
+        assert titles(items) == [f'New {number}' for number in range(6)] + ['Item 0 changed', 'Item 1']
+        assert items[0]['data']['summary'] == 'Tab\tand\nnew line\\'
+        db_service.mark_items(1, [url], True, up_to=items[0]['id'])
+        assert list(db_service.iter_feed_items(1, url, 'unread')) == []
+
+    def test_concurrent_writers_commit_in_seq_order(self, backend):
+        def write(feed_id):
+            with backend.writer() as (db_connection, cursor):
+                backend.write_items(feed_id, [(feed_id, ('Title', None, None, 0, None), None)], [], cursor)
+                db_connection.commit()
+
+        with backend.writer() as (first_connection, first_cursor):
+            backend.write_items('first', [('first', ('Title', None, None, 0, None), None)], [], first_cursor)
+            second = threading.Thread(target=write, args=('second',))
+            second.start()
+            # The second writer waits for the first to commit, it must not commit a higher item_seq meanwhile.
+            second.join(0.5)
+            with backend.cursor() as (db_connection, cursor):
+                assert backend.get_new_item_feeds(0, cursor) == []
+            first_connection.commit()
+        second.join()
+        with backend.cursor() as (db_connection, cursor):
+            seqs = dict(backend.get_new_item_feeds(0, cursor))
+        assert seqs['first'] < seqs['second']